@@ -0,0 +1,121 @@
+import mmap
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+# Prepares WAV files for the Speech API without a decode/re-encode round
+# trip: the file is memory-mapped, its int16 frames are downmixed to mono
+# and resampled to 16 kHz with NumPy one fixed-size window at a time, and
+# the result is handed over as raw LINEAR16 bytes.
+TARGET_RATE = 16000
+WINDOW_SECONDS = 10
+# Low-pass taps applied before downsampling, so high frequencies don't alias
+FILTER_TAPS = 63
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+WavInfo = namedtuple('WavInfo', 'rate channels frames data_offset')
+
+
+def read_header(buffer):
+    """Finds the fmt and data chunks of a 16-bit PCM WAV held in buffer."""
+    if buffer[:4] != b'RIFF' or buffer[8:12] != b'WAVE':
+        raise ValueError("not a RIFF/WAVE file")
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(buffer):
+        chunk_id = buffer[offset:offset + 4]
+        size = struct.unpack_from('<I', buffer, offset + 4)[0]
+        body = offset + 8
+        if chunk_id == b'fmt ':
+            audio_format, channels, rate, _, _, bits = struct.unpack_from('<HHIIHH', buffer, body)
+            if audio_format == WAVE_FORMAT_EXTENSIBLE and size >= 26:
+                audio_format = struct.unpack_from('<H', buffer, body + 24)[0]
+            if audio_format != WAVE_FORMAT_PCM or bits != 16:
+                raise ValueError("only 16-bit PCM WAV files are supported")
+            fmt = (rate, channels)
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise ValueError("data chunk before fmt chunk")
+            rate, channels = fmt
+            # Some writers leave the size at 0 or too large for streamed files
+            size = min(size, len(buffer) - body) if size else len(buffer) - body
+            return WavInfo(rate, channels, size // (2 * channels), body)
+        offset = body + size + (size & 1)  # chunks are padded to an even length
+    raise ValueError("no data chunk found")
+
+
+def lowpass_filter(rate, cutoff, taps=FILTER_TAPS):
+    """Windowed-sinc FIR low-pass coefficients."""
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = np.sinc(2 * cutoff / rate * n) * np.hamming(taps)
+    return kernel / kernel.sum()
+
+
+def iter_linear16(path, target_rate=TARGET_RATE, window_seconds=WINDOW_SECONDS):
+    """
+    Yields the file as mono 16-bit little-endian samples at target_rate,
+    one window_seconds window at a time, so memory use doesn't grow with
+    the length of the recording.
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        info = read_header(mm)
+        frames = np.frombuffer(mm, dtype='<i2', count=info.frames * info.channels,
+                               offset=info.data_offset).reshape(-1, info.channels)
+        window = int(info.rate * window_seconds)
+        try:
+            if info.rate == target_rate and info.channels == 1:
+                for start in range(0, info.frames, window):
+                    yield frames[start:start + window].tobytes()
+                return
+            yield from _resample_windows(frames, info.rate, target_rate, window)
+        finally:
+            # The array views the mapping, which can't close while they exist
+            del frames
+
+
+def _resample_windows(frames, rate, target_rate, window):
+    step = rate / target_rate
+    taps = lowpass_filter(rate, 0.45 * target_rate) if rate > target_rate else None
+    # The filter delays the signal by half its length; sample that much later to undo it
+    delay = (len(taps) - 1) // 2 if taps is not None else 0
+    history = np.zeros(len(taps) - 1) if taps is not None else None
+    carry = None  # last filtered sample of the previous window, for interpolation across the edge
+    filtered_start = 0
+    next_output = 0
+    total = len(frames)
+    for start in range(0, total, window):
+        final = start + window >= total
+        block = frames[start:start + window]
+        # Integer sum, then one scale: cheaper than a float mean over int16 frames
+        mono = block.sum(axis=1, dtype=np.int32) * (1 / block.shape[1])
+        if taps is not None:
+            if final:
+                # Flush the samples still inside the filter
+                mono = np.concatenate([mono, np.zeros(delay)])
+            padded = np.concatenate([history, mono])
+            history = padded[len(padded) - len(history):]
+            mono = np.convolve(padded, taps, mode='valid')
+        buffer = mono if carry is None else np.concatenate([carry, mono])
+        base = filtered_start - (0 if carry is None else 1)
+        last = (filtered_start + len(mono) - 1 - delay) / step  # last output position available
+        end_output = int(last) + 1 if final else int(np.ceil(last))
+        positions = np.arange(next_output, end_output) * step + delay - base
+        samples = np.interp(positions, np.arange(len(buffer)), buffer)
+        next_output = end_output
+        filtered_start += len(mono)
+        carry = mono[-1:]
+        yield np.clip(np.rint(samples), -32768, 32767).astype('<i2').tobytes()
+
+
+def to_linear16(path, target_rate=TARGET_RATE):
+    """The whole file as raw LINEAR16 bytes at target_rate, for the synchronous API."""
+    return b''.join(iter_linear16(path, target_rate))
+
+
+def duration_seconds(path):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        info = read_header(mm)
+    return info.frames / info.rate
@@ -0,0 +1,94 @@
+"""
+Benchmark: the old pydub path (decode, downmix, re-encode to an in-memory
+WAV, read back) against audio_preprocess on a multi-minute 44.1 kHz stereo
+recording made by looping voice_data/harvard.wav.
+
+    python bench_audio_preprocess.py [minutes]
+
+Peak memory is what tracemalloc sees; the memory-mapped file itself is
+file-backed and not counted.
+"""
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+
+from pydub import AudioSegment
+
+import audio_preprocess
+
+SOURCE = os.path.join(os.path.dirname(__file__), "voice_data", "harvard.wav")
+
+
+def long_recording(minutes, path):
+    with wave.open(SOURCE, "rb") as source:
+        params = source.getparams()
+        frames = source.readframes(source.getnframes())
+    loops = int(minutes * 60 * params.framerate / params.nframes) + 1
+    with wave.open(path, "wb") as out:
+        out.setparams(params)
+        for _ in range(loops):
+            out.writeframes(frames)
+    return path
+
+
+def pydub_mono(path):
+    # What testing_nlp.convert_to_mono + transcribe_audio used to do
+    audio = AudioSegment.from_wav(path)
+    audio = audio.set_channels(1)
+    mono_audio = io.BytesIO()
+    audio.export(mono_audio, format="wav")
+    mono_audio.seek(0)
+    return mono_audio.read()
+
+
+def pydub_mono_16k(path):
+    # The same, also resampled to 16 kHz
+    audio = AudioSegment.from_wav(path).set_channels(1).set_frame_rate(16000)
+    mono_audio = io.BytesIO()
+    audio.export(mono_audio, format="wav")
+    mono_audio.seek(0)
+    return mono_audio.read()
+
+
+def windows_only(path):
+    # Streaming use: each window is sent and dropped, never joined
+    size = 0
+    for window in audio_preprocess.iter_linear16(path):
+        size += len(window)
+    return size
+
+
+def measure(fn, path):
+    start = time.perf_counter()
+    fn(path)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    minutes = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as tmp:
+        path = long_recording(minutes, os.path.join(tmp, "long.wav"))
+        print(f"recording: {audio_preprocess.duration_seconds(path) / 60:.1f} min, "
+              f"{os.path.getsize(path) / 2 ** 20:.0f} MB, 44.1 kHz stereo")
+        cases = [
+            ("pydub mono WAV round trip (old)", pydub_mono),
+            ("pydub mono + 16 kHz round trip", pydub_mono_16k),
+            ("audio_preprocess.to_linear16", audio_preprocess.to_linear16),
+            ("audio_preprocess windows", windows_only),
+        ]
+        for name, fn in cases:
+            elapsed, peak = measure(fn, path)
+            print(f"{name:34s} {elapsed * 1000:8.0f} ms  peak {peak / 2 ** 20:7.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import queue
+import threading
+import wave
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("google.cloud.speech")
+
+import voice_input  # noqa: E402
+from voice_input import AUDIO_GAP, CHUNK_SECONDS, RATE  # noqa: E402
+
+
+class FakeRecognizer:
+    """
+    Stands in for SpeechClient.streaming_recognize: reads every request of
+    an utterance, then answers with one final result saying how many
+    chunks it heard.
+    """
+
+    def __init__(self):
+        self.utterances = []
+
+    def streaming_recognize(self, config, requests):
+        chunks = [request.audio_content for request in requests]
+        self.utterances.append(chunks)
+        alternative = SimpleNamespace(transcript=f"utterance {len(self.utterances)}: {len(chunks)} chunks")
+        return [SimpleNamespace(results=[SimpleNamespace(is_final=True, alternatives=[alternative])])]
+
+
+def tone(seconds, rate=RATE):
+    t = np.arange(int(seconds * rate)) / rate
+    return (8000 * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+
+
+def silence(seconds, rate=RATE):
+    return np.zeros(int(seconds * rate), dtype=np.int16)
+
+
+def write_wav(path, samples, rate=RATE, channels=1):
+    with wave.open(str(path), 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(samples.tobytes())
+
+
+def chunks_of(seconds):
+    return round(seconds / CHUNK_SECONDS)
+
+
+def test_wav_is_transcribed_utterance_by_utterance(tmp_path):
+    path = tmp_path / 'speech.wav'
+    write_wav(path, np.concatenate([silence(0.5), tone(1.0), silence(1.0), tone(0.8), silence(0.3)]))
+    rate, chunks = voice_input.wav_source(str(path))
+    chunk_queue, stats = voice_input.start_capture(chunks)
+    recognizer = FakeRecognizer()
+
+    transcripts = list(voice_input.stream_transcripts(chunk_queue, recognizer, rate))
+
+    assert rate == RATE
+    assert stats == {'captured': 36, 'dropped': 0, 'gaps': 0}
+    assert len(recognizer.utterances) == 2
+    # The chunk before speech, the speech, then SILENCE_SECONDS of silence
+    silence_chunks = chunks_of(voice_input.SILENCE_SECONDS)
+    assert len(recognizer.utterances[0]) == 1 + chunks_of(1.0) + silence_chunks
+    # The second utterance runs into the end of the file before enough silence
+    assert len(recognizer.utterances[1]) == 1 + chunks_of(0.8) + chunks_of(0.3)
+    assert transcripts == [(True, "utterance 1: 16 chunks"), (True, "utterance 2: 12 chunks")]
+
+
+def test_stereo_wav_is_mixed_to_mono(tmp_path):
+    path = tmp_path / 'stereo.wav'
+    left = tone(0.3)
+    write_wav(path, np.stack([left, left], axis=1).reshape(-1), channels=2)
+    _, chunks = voice_input.wav_source(str(path))
+    assert b''.join(chunks) == left.tobytes()
+
+
+def test_full_queue_drops_chunks_and_marks_the_gap(monkeypatch):
+    monkeypatch.setattr(voice_input, 'MAX_QUEUED_CHUNKS', 5)
+    drained = threading.Event()
+    loud = [tone(CHUNK_SECONDS).tobytes()] * 13
+
+    def microphone():
+        # Ten chunks arrive while nobody reads the queue, the rest after it was drained
+        yield from loud[:10]
+        drained.wait(5)
+        yield from loud[10:]
+
+    chunk_queue, stats = voice_input.start_capture(microphone(), drop_when_full=True)
+    first = [chunk_queue.get(timeout=5) for _ in range(5)]
+    drained.set()
+    rest = []
+    while True:
+        item = chunk_queue.get(timeout=5)
+        if item is None:
+            break
+        rest.append(item)
+
+    assert first == loud[:5]
+    assert rest == [AUDIO_GAP] + loud[10:]
+    assert stats == {'captured': 8, 'dropped': 5, 'gaps': 1}
+
+
+def test_a_gap_ends_the_utterance():
+    loud = tone(CHUNK_SECONDS).tobytes()
+    quiet = silence(CHUNK_SECONDS).tobytes()
+    chunk_queue = queue.Queue()
+    for item in [quiet, loud, loud, loud, AUDIO_GAP, loud, loud, None]:
+        chunk_queue.put(item)
+    recognizer = FakeRecognizer()
+
+    list(voice_input.stream_transcripts(chunk_queue, recognizer))
+
+    # Audio on either side of the hole is never sent as one utterance
+    assert [len(chunks) for chunks in recognizer.utterances] == [4, 2]
@@ -1,9 +1,7 @@
 import os
-import wave
-import io
 from google.cloud import speech
-from pydub import AudioSegment
 from dotenv import load_dotenv
+import audio_preprocess
 
 # Load environment variables from .env file
 load_dotenv(dotenv_path='../.env')
@@ -11,26 +9,19 @@ load_dotenv(dotenv_path='../.env')
 # Set up Google Cloud credentials
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.path.join(os.path.dirname(__file__), "hacknyu.json")
 
-# Audio recording parameters
-RATE = 44100
+# Audio recording parameters: files are resampled to the rate the recognizer is told
+RATE = audio_preprocess.TARGET_RATE
 CHUNK = int(RATE / 10)  # 100ms
 
 def convert_to_mono(audio_path):
-    # Load the audio file
-    audio = AudioSegment.from_wav(audio_path)
-    # Convert to mono
-    audio = audio.set_channels(1)
-    # Export the audio to a BytesIO object
-    mono_audio = io.BytesIO()
-    audio.export(mono_audio, format="wav")
-    mono_audio.seek(0)
-    return mono_audio
+    # Mono 16 kHz LINEAR16 samples, straight from the memory-mapped WAV
+    return audio_preprocess.to_linear16(audio_path, RATE)
 
 def transcribe_audio(audio_content):
     print("Starting transcription...")
     client = speech.SpeechClient()
 
-    audio = speech.RecognitionAudio(content=audio_content.read())
+    audio = speech.RecognitionAudio(content=audio_content)
     config = speech.RecognitionConfig(
         encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
         sample_rate_hertz=RATE,
@@ -53,5 +44,5 @@ if __name__ == "__main__":
     audio_path = "./voice_data/harvard.wav"
     mono_audio = convert_to_mono(audio_path)
 
-    print("Audio content length:", len(mono_audio.getvalue()))
+    print("Audio content length:", len(mono_audio))
     transcribe_audio(mono_audio)
\ No newline at end of file
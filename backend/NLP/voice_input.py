@@ -1,6 +1,11 @@
 import os
 import io
-import pyaudio
+import sys
+import queue
+import threading
+import time
+import wave
+import numpy as np
 from google.cloud import speech
 from dotenv import load_dotenv
 
@@ -12,9 +17,23 @@ os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.path.join(os.path.dirname(__fi
 
 # Audio recording parameters
 RATE = 16000
-CHUNK = int(RATE / 10)  # 100ms
+CHUNK_SECONDS = 0.1
+CHUNK = int(RATE * CHUNK_SECONDS)  # 100ms
+
+# Streaming mode: chunks waiting for the recognizer (about 5 seconds of audio).
+# When it falls behind, the microphone drops chunks rather than growing memory,
+# and the utterance being sent ends where the audio has a hole in it.
+MAX_QUEUED_CHUNKS = 50
+# Queued in place of dropped audio
+AUDIO_GAP = object()
+# An utterance ends after this much silence; int16 RMS below SILENCE_RMS is silence
+SILENCE_RMS = 500
+SILENCE_SECONDS = 0.5
+# Streaming recognition sessions are limited to about five minutes
+MAX_UTTERANCE_SECONDS = 240
 
 def record_audio():
+    import pyaudio
     p = pyaudio.PyAudio()
 
     # Print available audio input devices
@@ -74,7 +93,187 @@ def transcribe_audio(audio_content):
         for result in response.results:
             print('Transcript: {}'.format(result.alternatives[0].transcript))
 
+def is_silent(chunk, threshold=SILENCE_RMS):
+    """RMS of the 16-bit samples in chunk, compared to the silence threshold."""
+    samples = np.frombuffer(chunk, dtype=np.int16).astype(np.float32)
+    if samples.size == 0:
+        return True
+    return float(np.sqrt(np.mean(samples * samples))) < threshold
+
+def microphone_chunks(stop_event, device_index=1):
+    """Yields 100ms chunks of 16 kHz mono audio from the microphone until stop_event is set."""
+    import pyaudio
+    p = pyaudio.PyAudio()
+    stream = p.open(format=pyaudio.paInt16,
+                    channels=1,
+                    rate=RATE,
+                    input=True,
+                    input_device_index=device_index,
+                    frames_per_buffer=CHUNK)
+    try:
+        while not stop_event.is_set():
+            yield stream.read(CHUNK, exception_on_overflow=False)
+    finally:
+        stream.stop_stream()
+        stream.close()
+        p.terminate()
+
+def wav_source(path, realtime=False):
+    """
+    Returns (sample rate, chunk generator) for a 16-bit WAV file, so the
+    streaming path can be run without a microphone. Stereo is averaged to
+    mono; with realtime=True chunks arrive at the speed they'd be spoken.
+    """
+    with wave.open(path, 'rb') as wav:
+        rate = wav.getframerate()
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"{path}: only 16-bit WAV files are supported")
+
+    def chunks():
+        with wave.open(path, 'rb') as wav:
+            channels = wav.getnchannels()
+            frames_per_chunk = int(rate * CHUNK_SECONDS)
+            while True:
+                data = wav.readframes(frames_per_chunk)
+                if not data:
+                    break
+                if channels > 1:
+                    samples = np.frombuffer(data, dtype=np.int16).reshape(-1, channels)
+                    data = samples.mean(axis=1).astype(np.int16).tobytes()
+                yield data
+                if realtime:
+                    time.sleep(CHUNK_SECONDS)
+
+    return rate, chunks()
+
+def start_capture(chunks, drop_when_full=False):
+    """
+    Moves chunks from a source into a bounded queue on a background thread.
+    A None in the queue marks the end of the audio. A file source simply
+    waits for room. A live source can't, so when the queue is full it
+    drops chunks, and an AUDIO_GAP goes in where they were so the
+    recognizer never hears audio spliced across the hole.
+    """
+    chunk_queue = queue.Queue(maxsize=MAX_QUEUED_CHUNKS)
+    stats = {'captured': 0, 'dropped': 0, 'gaps': 0}
+
+    def run():
+        gap = False
+        for chunk in chunks:
+            if not drop_when_full:
+                chunk_queue.put(chunk)
+                stats['captured'] += 1
+                continue
+            try:
+                if gap:
+                    chunk_queue.put_nowait(AUDIO_GAP)
+                    stats['gaps'] += 1
+                    gap = False
+                chunk_queue.put_nowait(chunk)
+                stats['captured'] += 1
+            except queue.Full:
+                gap = True
+                stats['dropped'] += 1
+        chunk_queue.put(None)
+
+    thread = threading.Thread(target=run, name='audio-capture', daemon=True)
+    thread.start()
+    return chunk_queue, stats
+
+def _wait_for_speech(chunk_queue):
+    # Skip leading silence, but keep the chunk before speech so the first word isn't clipped
+    previous = None
+    while True:
+        chunk = chunk_queue.get()
+        if chunk is None:
+            return None
+        if chunk is AUDIO_GAP:
+            previous = None
+            continue
+        if not is_silent(chunk):
+            return [c for c in (previous, chunk) if c is not None]
+        previous = chunk
+
+def _utterance(first_chunks, chunk_queue, state):
+    """Yields one utterance's chunks, ending on enough silence, a gap or the end of the audio."""
+    silence_chunks = round(SILENCE_SECONDS / CHUNK_SECONDS)
+    max_chunks = round(MAX_UTTERANCE_SECONDS / CHUNK_SECONDS)
+    sent = 0
+    silent = 0
+    for chunk in first_chunks:
+        yield chunk
+        sent += 1
+    while sent < max_chunks:
+        chunk = chunk_queue.get()
+        if chunk is None:
+            state['ended'] = True
+            return
+        if chunk is AUDIO_GAP:
+            return
+        yield chunk
+        sent += 1
+        silent = silent + 1 if is_silent(chunk) else 0
+        if silent >= silence_chunks:
+            return
+
+def stream_transcripts(chunk_queue, recognizer=None, rate=RATE):
+    """
+    Feeds queued audio to a streaming recognizer one utterance at a time and
+    yields (is_final, transcript) as results arrive. recognizer is anything
+    with SpeechClient's streaming_recognize(config, requests); by default a
+    SpeechClient.
+    """
+    recognizer = recognizer or speech.SpeechClient()
+    streaming_config = speech.StreamingRecognitionConfig(
+        config=speech.RecognitionConfig(
+            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=rate,
+            language_code='en-US'
+        ),
+        interim_results=True
+    )
+    state = {'ended': False}
+    while not state['ended']:
+        first_chunks = _wait_for_speech(chunk_queue)
+        if first_chunks is None:
+            return
+        requests = (
+            speech.StreamingRecognizeRequest(audio_content=chunk)
+            for chunk in _utterance(first_chunks, chunk_queue, state)
+        )
+        for response in recognizer.streaming_recognize(streaming_config, requests):
+            for result in response.results:
+                if result.alternatives:
+                    yield result.is_final, result.alternatives[0].transcript
+
+def stream_from_microphone(recognizer=None):
+    stop_event = threading.Event()
+    chunk_queue, stats = start_capture(microphone_chunks(stop_event), drop_when_full=True)
+    print("Streaming... press Ctrl-C to stop")
+    try:
+        for is_final, transcript in stream_transcripts(chunk_queue, recognizer):
+            print(('Transcript: {}' if is_final else '  ...{}').format(transcript))
+    except KeyboardInterrupt:
+        print("Recording stopped")
+    finally:
+        stop_event.set()
+    print(f"Captured {stats['captured']} chunks, dropped {stats['dropped']} in {stats['gaps']} gaps")
+
+def stream_from_wav(path, recognizer=None, realtime=False):
+    rate, chunks = wav_source(path, realtime)
+    chunk_queue, _ = start_capture(chunks)
+    for is_final, transcript in stream_transcripts(chunk_queue, recognizer, rate):
+        print(('Transcript: {}' if is_final else '  ...{}').format(transcript))
+
 if __name__ == "__main__":
-    audio_content = record_audio()
-    print("Audio content length:", len(audio_content))
-    transcribe_audio(audio_content)
\ No newline at end of file
+    # python voice_input.py --stream [file.wav] streams instead of recording until Ctrl-C
+    if '--stream' in sys.argv:
+        args = [arg for arg in sys.argv[1:] if arg != '--stream']
+        if args:
+            stream_from_wav(args[0], realtime=True)
+        else:
+            stream_from_microphone()
+    else:
+        audio_content = record_audio()
+        print("Audio content length:", len(audio_content))
+        transcribe_audio(audio_content)
\ No newline at end of file
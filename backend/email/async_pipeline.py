@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# A fetch runs as a chain of stages (fetch -> decode -> OCR -> extract)
+# connected by bounded queues, so messages flow through concurrently:
+# while one message is being OCR'd the next is already downloading. Each
+# stage has its own worker count, and a full queue makes the stage feeding
+# it wait (backpressure), so a large mailbox never piles up in memory.
+DEFAULT_QUEUE_SIZE = 16
+
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of the pipeline. fn is an async callable taking a list of
+    up to batch_size items and returning a list of items for the next
+    stage (which may be longer, shorter or empty). When batch_size > 1 a
+    worker waits up to linger seconds for a batch to fill.
+    """
+
+    def __init__(self, name, fn, concurrency=1, batch_size=1, linger=0.0):
+        self.name = name
+        self.fn = fn
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+        self.linger = linger
+
+
+def _new_stage_stats():
+    return {"items_in": 0, "items_out": 0, "calls": 0, "failures": 0, "busy_seconds": 0.0, "max_queue_depth": 0}
+
+
+async def _next_batch(stage, inbox):
+    """Up to batch_size items, and whether the input is exhausted."""
+    item = await inbox.get()
+    if item is _DONE:
+        await inbox.put(_DONE)  # let the other workers of this stage see it too
+        return [], True
+    batch = [item]
+    deadline = time.monotonic() + stage.linger
+    while len(batch) < stage.batch_size:
+        try:
+            if stage.linger > 0:
+                item = await asyncio.wait_for(inbox.get(), max(0.0, deadline - time.monotonic()))
+            else:
+                item = inbox.get_nowait()
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            break
+        if item is _DONE:
+            await inbox.put(_DONE)
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+
+async def _worker(stage, inbox, outbox, stats):
+    done = False
+    while not done:
+        batch, done = await _next_batch(stage, inbox)
+        if not batch:
+            continue
+        stats["items_in"] += len(batch)
+        stats["calls"] += 1
+        start = time.perf_counter()
+        try:
+            outputs = await stage.fn(batch)
+        except Exception:
+            # One bad message shouldn't stop the rest of the fetch
+            logger.exception("Pipeline stage %s failed for %d items", stage.name, len(batch))
+            stats["failures"] += 1
+            outputs = []
+        stats["busy_seconds"] += time.perf_counter() - start
+        for output in outputs or []:
+            stats["items_out"] += 1
+            await outbox.put(output)
+            stats["max_queue_depth"] = max(stats["max_queue_depth"], outbox.qsize())
+
+
+async def _feed(items, queue):
+    for item in items:
+        await queue.put(item)
+    await queue.put(_DONE)
+
+
+async def _run_stage(stage, inbox, outbox, stats):
+    await asyncio.gather(*(_worker(stage, inbox, outbox, stats) for _ in range(stage.concurrency)))
+    await outbox.put(_DONE)
+
+
+async def run_pipeline(items, stages, queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    Pushes items through the stages and returns (outputs of the last
+    stage, per-stage stats). Outputs come back in completion order.
+    """
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    stats = {stage.name: _new_stage_stats() for stage in stages}
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(_feed(items, queues[0]))]
+    for i, stage in enumerate(stages):
+        tasks.append(asyncio.create_task(_run_stage(stage, queues[i], queues[i + 1], stats[stage.name])))
+
+    outputs = []
+    while True:
+        item = await queues[-1].get()
+        if item is _DONE:
+            break
+        outputs.append(item)
+    await asyncio.gather(*tasks)
+    stats["wall_seconds"] = time.perf_counter() - start
+    return outputs, stats
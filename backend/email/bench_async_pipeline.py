@@ -0,0 +1,183 @@
+"""
+Benchmark: wall-clock time of a backfill through the serial
+get_newest_emails against the async stage pipeline. Gmail, OCR and Gemini
+are replaced by fakes that sleep for a fixed latency, so the numbers show
+how much of that waiting each path overlaps. Caches start empty.
+
+    python bench_async_pipeline.py [--messages N]
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import time
+import types
+
+GMAIL_LATENCY = 0.15  # per HTTP round trip (a batch counts as one)
+OCR_LATENCY = 0.3  # per image
+LLM_LATENCY = 1.0  # per model call
+
+os.chdir(tempfile.mkdtemp(prefix="bench_pipeline_"))
+with open("client_secrets.json", "w") as f:
+    f.write("{}")
+os.environ["OAUTH2_CLIENT_SECRETS_FILE"] = "client_secrets.json"
+os.environ["OCR_WARM_ON_STARTUP"] = "0"
+os.environ["RULE_FAST_PATH"] = "0"  # every email goes to the (fake) model
+
+import google.generativeai as genai  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+import imageOCR  # noqa: E402
+
+
+def fake_ocr_image(image):
+    time.sleep(OCR_LATENCY)
+    return {"text": "USE CODE BANNER50", "blocks": [([[0, 0], [10, 0], [10, 10], [0, 10]], "USE CODE BANNER50", 0.9)]}
+
+
+class FakeModel:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def generate_content(self, prompt):
+        time.sleep(LLM_LATENCY)
+        numbers = re.findall(r"=== EMAIL (\d+) ===\n", prompt)
+        if numbers:
+            return types.SimpleNamespace(text=json.dumps([{"Email": int(n), "Company": f"Shop {n}"} for n in numbers]))
+        return types.SimpleNamespace(text=json.dumps({"Company": "Shop"}))
+
+
+# OCR workers are forked from this process, so they inherit the fake
+imageOCR.ocr_image = fake_ocr_image
+genai.GenerativeModel = FakeModel
+
+import deep_search  # noqa: E402
+import ocr_engine  # noqa: E402
+
+WORDS = ("deal sale jacket boots summer winter spring dress shirt member bonus points free shipping "
+         "weekend only online store new arrivals limited exclusive early access gift card style").split()
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def banner(seed):
+    image = Image.new("RGB", (600, 300), "white")
+    draw = ImageDraw.Draw(image)
+    for y in range(20, 280, 30):
+        draw.text((20, y), f"SAVE {seed} ON EVERYTHING WITH CODE X{seed}", fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def make_mailbox(prefix, count):
+    rng = random.Random(prefix)
+    messages, attachments = {}, {}
+    for i in range(count):
+        message_id = f"{prefix}{i}"
+        body = " ".join(rng.choice(WORDS) for _ in range(60))
+        attachments[message_id] = b64(banner(message_id))
+        messages[message_id] = {
+            "id": message_id,
+            "labelIds": ["CATEGORY_PROMOTIONS"],
+            "payload": {
+                "mimeType": "multipart/mixed", "body": {},
+                "headers": [{"name": "From", "value": f"Shop {i} <news@shop{i}.example.com>"}],
+                "parts": [
+                    {"mimeType": "text/plain", "filename": "", "body": {"data": b64(body.encode())}},
+                    {"mimeType": "image/png", "filename": "banner.png", "body": {"attachmentId": f"att{i}"}},
+                ],
+            },
+        }
+    return messages, attachments
+
+
+class FakeGmail:
+    """Just enough of the Gmail client for list, get, attachments and batches."""
+
+    def __init__(self, messages, attachments):
+        self.messages_by_id = messages
+        self.attachment_data = attachments
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def attachments(self):
+        return self
+
+    def list(self, userId, q=None, maxResults=100, pageToken=None):
+        # The whole backfill comes back in one page
+        return Call(lambda: {"messages": [{"id": message_id} for message_id in self.messages_by_id]}, GMAIL_LATENCY)
+
+    def get(self, userId, id, format=None, metadataHeaders=None, messageId=None):
+        if messageId:
+            return Call(lambda: {"data": self.attachment_data[messageId]})
+        message = self.messages_by_id[id]
+        return Call(lambda: message if format == "full" else {"id": id, "labelIds": message["labelIds"]})
+
+    def new_batch_http_request(self, callback):
+        return Batch(callback)
+
+
+class Call:
+    def __init__(self, fn, latency=0.0):
+        self.fn = fn
+        self.latency = latency
+
+    def execute(self):
+        time.sleep(self.latency)
+        return self.fn()
+
+
+class Batch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.calls = []
+
+    def add(self, call, request_id):
+        self.calls.append((request_id, call))
+
+    def execute(self):
+        time.sleep(GMAIL_LATENCY)
+        for request_id, call in self.calls:
+            self.callback(request_id, call.execute(), None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=" ".join(__doc__.split("\n\n")[0].split()))
+    parser.add_argument("--messages", type=int, default=50, help="messages in each fake mailbox")
+    count = parser.parse_args().messages
+    ocr_engine.warm_workers()
+    serial_box = make_mailbox("s", count)
+    async_box = make_mailbox("a", count)
+
+    start = time.perf_counter()
+    serial = deep_search.get_newest_emails(FakeGmail(*serial_box))
+    serial_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pipelined = deep_search.asyncio.run(deep_search.get_newest_emails_async(lambda: FakeGmail(*async_box)))
+    async_seconds = time.perf_counter() - start
+
+    print(f"messages: {count}, OCR workers: {ocr_engine.OCR_WORKERS}, "
+          f"latency gmail/ocr/llm: {GMAIL_LATENCY}/{OCR_LATENCY}/{LLM_LATENCY}s")
+    print(f"{'serial get_newest_emails':30s} {serial_seconds:7.2f} s  {len(serial)} promotions")
+    print(f"{'async pipeline':30s} {async_seconds:7.2f} s  {len(pipelined)} promotions")
+    for name, stats in deep_search.get_pipeline_stats()['last']['stages'].items():
+        if isinstance(stats, dict):
+            print(f"  {name:8s} calls {stats['calls']:3d}  busy {stats['busy_seconds']:6.2f} s  "
+                  f"max queue {stats['max_queue_depth']}")
+    ocr_engine.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark: parse time and peak memory of the old BeautifulSoup path against
+the single-pass extract_html on a synthetic large marketing email.
+
+    python bench_html_extract.py [target_kb]
+"""
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+import html_extract
+from html_extract import extract_html
+
+
+def synthetic_email(target_kb):
+    css = "".join(
+        f".c{i} {{ font-family: Helvetica, Arial, sans-serif; color: #{i % 0xFFFFFF:06x}; "
+        f"padding: {i % 20}px; mso-line-height-rule: exactly; }}\n"
+        for i in range(target_kb * 3)
+    )
+    rows = []
+    i = 0
+    while sum(len(row) for row in rows) + len(css) < target_kb * 1024:
+        rows.append(
+            f'<tr><td class="c{i}" style="padding:0 10px;background:#fff" align="center">'
+            f'<table role="presentation" width="100%"><tr><td>'
+            f'<a href="https://shop.example.com/p/{i}?utm_source=email&amp;utm_medium={i}">'
+            f'<img src="https://cdn.example.com/img/{i}.jpg" width="300" height="200" alt="Product {i}"></a>'
+            f'<p style="margin:0;font-size:14px">Item {i} now 20% off with code SAVE{i}</p>'
+            f'</td></tr></table></td></tr>\n'
+        )
+        i += 1
+    return (
+        f"<html><head><style>{css}</style></head><body>"
+        f'<table width="600">{"".join(rows)}</table>'
+        f'<a href="https://shop.example.com/unsubscribe">Unsubscribe</a></body></html>'
+    )
+
+
+def old_images_only(html):
+    soup = BeautifulSoup(html, "html.parser")
+    return [img.get("src") for img in soup.find_all("img")]
+
+
+def old_full(html):
+    # What the BeautifulSoup path would need to also get links and text
+    soup = BeautifulSoup(html, "html.parser")
+    images = [img.get("src") for img in soup.find_all("img")]
+    links = [(a.get("href"), a.get_text(" ", strip=True)) for a in soup.find_all("a")]
+    for tag in soup(["style", "script", "head"]):
+        tag.decompose()
+    return images, links, soup.get_text("\n", strip=True)
+
+
+def measure(fn, html, runs=3):
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(html)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    fn(html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    target_kb = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    html = synthetic_email(target_kb)
+    cases = [
+        ("bs4 html.parser, images only (old)", old_images_only),
+        ("bs4 html.parser, images+links+text", old_full),
+        ("extract_html, stdlib parser", lambda h: extract_html(h, use_lxml=False)),
+    ]
+    if html_extract.etree is not None:
+        cases.append(("extract_html, lxml parser", extract_html))
+    print(f"email size: {len(html) / 1024:.0f} KB, images: {len(extract_html(html).images)}")
+    for name, fn in cases:
+        seconds, peak = measure(fn, html)
+        print(f"{name:40s} {seconds * 1000:8.1f} ms  peak {peak / 1024 / 1024:7.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Micro-benchmark: the old per-word regex promo code extraction against the
+precompiled single-pass scanner in imageOCR, on synthetic OCR blocks.
+
+    python bench_promo_scanner.py [n_blocks]
+"""
+import random
+import re
+import sys
+import timeit
+
+from imageOCR import scan_promo_codes
+
+
+def legacy_is_likely_promo_code(text):
+    patterns = [
+        r"^[A-Z0-9]{4,}$",
+        r"^[A-Z]{2,}\d+$",
+        r"^[A-Z0-9]+OFF$",
+        r"^SAVE\d+$",
+        r"^\d+OFF$",
+        r"^[A-Z]+\d+[A-Z]+$",
+    ]
+    text = text.strip().upper()
+    return any(re.match(pattern, text) for pattern in patterns)
+
+
+def legacy_extract_promo_codes(text_blocks):
+    promo_codes = []
+    promo_indicators = [
+        "code", "coupon", "promo", "use", "enter", "discount",
+        "save", "off", "extra", "special", "offer",
+    ]
+    for bbox, text, prob in text_blocks:
+        words = text.strip().split()
+        for i, word in enumerate(words):
+            word = re.sub(r"[^\w\s-]", "", word).strip()
+            if not word:
+                continue
+            if legacy_is_likely_promo_code(word):
+                promo_codes.append(word.upper())
+                continue
+            if i > 0 and words[i - 1].lower() in promo_indicators:
+                if len(word) >= 4:
+                    promo_codes.append(word.upper())
+            elif i < len(words) - 1 and words[i + 1].lower() in promo_indicators:
+                if len(word) >= 4:
+                    promo_codes.append(word.upper())
+    return promo_codes
+
+
+WORDS = (
+    "shop the spring sale today and get free shipping on all orders over "
+    "fifty dollars limited time only while supplies last terms apply"
+).split()
+CODES = ["SAVE20", "SPRING30", "FREESHIP", "20OFF", "WELCOME-15"]
+
+
+def synthetic_blocks(n_blocks, seed=0):
+    rng = random.Random(seed)
+    blocks = []
+    for i in range(n_blocks):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(4, 14))]
+        if rng.random() < 0.2:
+            words.insert(rng.randint(0, len(words)), "use code " + rng.choice(CODES))
+        if rng.random() < 0.5:
+            words = [word.upper() for word in words]
+        height = rng.choice([12, 18, 40])
+        bbox = [[0, i * 50], [300, i * 50], [300, i * 50 + height], [0, i * 50 + height]]
+        blocks.append((bbox, " ".join(words) + ".", rng.uniform(0.4, 1.0)))
+    return blocks
+
+
+def main():
+    n_blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    blocks = synthetic_blocks(n_blocks)
+    body = " ".join(text for _, text, _ in synthetic_blocks(n_blocks // 4, seed=1))
+    runs = 5
+
+    legacy = min(timeit.repeat(
+        lambda: (legacy_extract_promo_codes(blocks), legacy_extract_promo_codes([(None, body, 1.0)])),
+        number=1, repeat=runs))
+    scanner = min(timeit.repeat(lambda: scan_promo_codes([blocks], body_text=body), number=1, repeat=runs))
+
+    print(f"blocks: {n_blocks}, body chars: {len(body)}")
+    print(f"legacy extract_promo_codes: {legacy * 1000:8.2f} ms")
+    print(f"scan_promo_codes:           {scanner * 1000:8.2f} ms  ({legacy / scanner:.1f}x)")
+    print(f"top codes: {scan_promo_codes([blocks], body_text=body)[:5]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,743 @@
+"""
+Replay benchmark: runs recorded Gmail messages through the whole
+extraction pipeline (get_newest_emails -> attachments and inline images ->
+OCR -> rules and model) with no network, and reports throughput, p50/p95
+latency of every stage and peak RSS as JSON, so runs on two commits can be
+compared.
+
+    python bench_replay.py generate FIXTURES [--messages 60]
+    python bench_replay.py record FIXTURES [--messages 50]
+    python bench_replay.py run FIXTURES [--pipeline async|serial] [--runs 3] [--out results.json]
+    python bench_replay.py compare OLD.json NEW.json [--threshold 0.1]
+
+generate writes synthetic fixtures: large HTML, many inline images on a
+few hosts, tracking pixels, data URIs and attachments. record saves
+promotions from the real mailbox (OAUTH2_CLIENT_SECRETS_FILE) with
+their attachments and inline images; those are personal mail, so keep
+them out of git (bench_fixtures/ is ignored). run replays the fixtures against local fakes for the
+Gmail API, the image hosts and the Gemini model, each with its own
+simulated latency (--gmail-latency, --image-latency, --llm-latency).
+OCR is faked too (--ocr-latency per image) unless --real-ocr is given.
+
+Each run is a fresh process with empty caches. Stage latencies come from
+the metrics spans. A stage's peak RSS is the highest RSS sampled while it
+was running, counting the OCR worker processes. RSS is read from /proc,
+so it is only reported on Linux.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import defaultdict
+from contextlib import contextmanager
+
+DEFAULT_GMAIL_LATENCY = 0.1  # per HTTP round trip (a batch counts as one)
+DEFAULT_IMAGE_LATENCY = 0.05  # per image request
+DEFAULT_LLM_LATENCY = 1.0  # per model call
+DEFAULT_OCR_LATENCY = 0.2  # per image
+HISTORY_PAGE_SIZE = 100
+RSS_SAMPLE_SECONDS = 0.01
+# compare ignores stage changes smaller than this, whatever the ratio
+COMPARE_MIN_SECONDS = 0.001
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).decode()
+
+
+# Fixtures: messages/<id>.json holds {"message": <messages.get format=full>,
+# "attachments": {attachment id: base64url data}}; images/index.json maps
+# each inline image URL to a file in images/ and its content type.
+
+def write_fixtures(fixture_dir, messages, attachments, images, source):
+    os.makedirs(os.path.join(fixture_dir, 'messages'), exist_ok=True)
+    os.makedirs(os.path.join(fixture_dir, 'images'), exist_ok=True)
+    for msg in messages:
+        with open(os.path.join(fixture_dir, 'messages', msg['id'] + '.json'), 'w') as f:
+            json.dump({'message': msg, 'attachments': attachments.get(msg['id'], {})}, f)
+    index = {}
+    for url, (content_type, body) in images.items():
+        name = hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+        with open(os.path.join(fixture_dir, 'images', name), 'wb') as f:
+            f.write(body)
+        index[url] = {'file': name, 'content_type': content_type}
+    with open(os.path.join(fixture_dir, 'images', 'index.json'), 'w') as f:
+        json.dump(index, f)
+    with open(os.path.join(fixture_dir, 'manifest.json'), 'w') as f:
+        json.dump({'source': source, 'messages': len(messages), 'images': len(images),
+                   'created_at': time.strftime('%Y-%m-%dT%H:%M:%S')}, f)
+
+
+def load_fixtures(fixture_dir):
+    """(raw message JSON by id in file order, attachments by (message id, attachment id), images by URL, manifest)."""
+    messages = {}
+    attachments = {}
+    message_dir = os.path.join(fixture_dir, 'messages')
+    for name in sorted(os.listdir(message_dir)):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(message_dir, name)) as f:
+            fixture = json.load(f)
+        msg = fixture['message']
+        # Kept as text so every get parses it again, like the real client
+        messages[msg['id']] = json.dumps(msg)
+        for attachment_id, data in fixture.get('attachments', {}).items():
+            attachments[(msg['id'], attachment_id)] = data
+    images = {}
+    with open(os.path.join(fixture_dir, 'images', 'index.json')) as f:
+        for url, entry in json.load(f).items():
+            with open(os.path.join(fixture_dir, 'images', entry['file']), 'rb') as image:
+                images[url] = (entry['content_type'], image.read())
+    with open(os.path.join(fixture_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    return messages, attachments, images, manifest
+
+
+# generate
+
+WORDS = ("deal sale jacket boots summer winter spring dress shirt member bonus points free shipping "
+         "weekend only online store new arrivals limited exclusive early access gift card style").split()
+
+
+def make_image(rng, size, lines=(), fmt='PNG'):
+    from PIL import Image, ImageDraw
+
+    image = Image.new('RGB', size, tuple(rng.randrange(180, 256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.ellipse((x, y, x + size[0] // 4, y + size[1] // 4), fill=tuple(rng.randrange(256) for _ in range(3)))
+    for i, line in enumerate(lines):
+        draw.text((12, 12 + 24 * i), line, fill='black')
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **({'quality': 85} if fmt == 'JPEG' else {}))
+    return buffer.getvalue()
+
+
+def synthetic_html(rng, index, image_urls, data_uris, target_kb):
+    css = ''.join(f'.c{i} {{ font-family: Helvetica, Arial, sans-serif; padding: {i % 20}px; }}\n'
+                  for i in range(target_kb * 2))
+    rows = []
+    for i, url in enumerate(image_urls):
+        rows.append(f'<tr><td class="c{i}"><a href="https://shop{index}.example.com/p/{i}?utm_source=email">'
+                    f'<img src="{url}" width="300" alt="Item {i}"></a></td></tr>')
+    for uri in data_uris:
+        rows.append(f'<tr><td><img src="{uri}" width="120"></td></tr>')
+    i = 0
+    while sum(len(row) for row in rows) + len(css) < target_kb * 1024:
+        words = ' '.join(rng.choice(WORDS) for _ in range(20))
+        rows.append(f'<tr><td class="c{i}" style="padding:0 10px"><p style="margin:0">{words}</p>'
+                    f'<a href="https://shop{index}.example.com/c/{i}">Shop now</a></td></tr>')
+        i += 1
+    return (f'<html><head><style>{css}</style></head><body><table width="600">{"".join(rows)}</table>'
+            f'<a href="https://shop{index}.example.com/deal/{index}">See the deal</a></body></html>')
+
+
+def generate(fixture_dir, count, seed=1):
+    """Synthetic promotions in three shapes: standard, large HTML and image-heavy."""
+    rng = random.Random(seed)
+    hosts = ['cdn.shop-a.example', 'img.mailer.example', 'images.store-c.example', 'static.brand-d.example']
+    images = {}
+    shared = []  # logos and footers that recur across emails
+    for i in range(8):
+        url = f'https://{hosts[i % len(hosts)]}/brand/logo{i}.png'
+        images[url] = ('image/png', make_image(rng, (200, 60), [f'BRAND {i}']))
+        shared.append(url)
+    pixel = 'https://track.mailer.example/open.gif'
+    images[pixel] = ('image/gif', base64.b64decode('R0lGODlhAQABAIAAAAAAAP///ywAAAAAAQABAAACAUwAOw=='))
+
+    messages, attachments = [], {}
+    for index in range(count):
+        shape = ('standard', 'large_html', 'image_heavy')[index % 3]
+        code = f'SAVE{index}'
+        remote = {'standard': 4, 'large_html': 6, 'image_heavy': 30}[shape]
+        urls = []
+        for i in range(remote):
+            if i % 5 == 4:
+                urls.append(shared[rng.randrange(len(shared))])
+                continue
+            url = f'https://{hosts[i % len(hosts)]}/m{index}/img{i}.jpg'
+            lines = [f'USE CODE {code}'] if i == 0 else []
+            images[url] = ('image/jpeg', make_image(rng, (600, 300) if i == 0 else (300, 300), lines, 'JPEG'))
+            urls.append(url)
+        urls.append(pixel)
+        data_uris = []
+        if shape == 'image_heavy':
+            for i in range(2):
+                data_uris.append('data:image/png;base64,' + base64.b64encode(
+                    make_image(rng, (160, 80), [f'{10 + i}% OFF'])).decode())
+        html = synthetic_html(rng, index, urls, data_uris, {'standard': 20, 'large_html': 500, 'image_heavy': 40}[shape])
+        # Some bodies are clear enough for the rules, the rest need the model
+        if index % 2:
+            text = f'Use code {code} for 20% off everything. Offer expires 2030-03-{index % 28 + 1:02d}.'
+        else:
+            text = ' '.join(rng.choice(WORDS) for _ in range(80))
+
+        message_id = f'{index:016x}'
+        parts = [{
+            'partId': '0', 'mimeType': 'multipart/alternative', 'filename': '', 'headers': [], 'body': {'size': 0},
+            'parts': [
+                {'partId': '0.0', 'mimeType': 'text/plain', 'filename': '',
+                 'body': {'size': len(text), 'data': b64url(text.encode())}},
+                {'partId': '0.1', 'mimeType': 'text/html', 'filename': '',
+                 'body': {'size': len(html), 'data': b64url(html.encode())}},
+            ],
+        }]
+        message_attachments = {}
+        for i in range({'standard': 1, 'large_html': 0, 'image_heavy': 3}[shape]):
+            data = make_image(rng, (600, 400), [f'COUPON {code}', 'SHOW IN STORE'])
+            part = {'partId': str(i + 1), 'mimeType': 'image/png', 'filename': f'coupon{i}.png', 'headers': []}
+            if i == 2:
+                part['body'] = {'size': len(data), 'data': b64url(data)}  # small ones can come inline
+            else:
+                attachment_id = f'ANGjdJ{index}x{i}'
+                part['body'] = {'size': len(data), 'attachmentId': attachment_id}
+                message_attachments[attachment_id] = b64url(data)
+            parts.append(part)
+        messages.append({
+            'id': message_id, 'threadId': message_id, 'labelIds': ['CATEGORY_PROMOTIONS', 'UNREAD'],
+            'snippet': text[:100], 'historyId': str(index + 1), 'internalDate': str(1700000000000 + index),
+            'sizeEstimate': len(html) + len(text),
+            'payload': {
+                'partId': '', 'mimeType': 'multipart/mixed', 'filename': '', 'body': {'size': 0},
+                'headers': [
+                    {'name': 'From', 'value': f'Shop {index} <news@shop{index}.example.com>'},
+                    {'name': 'Subject', 'value': f'{shape} offer {index}'},
+                    {'name': 'Date', 'value': 'Mon, 1 Jan 2024 10:00:00 +0000'},
+                ],
+                'parts': parts,
+            },
+        })
+        attachments[message_id] = message_attachments
+    write_fixtures(fixture_dir, messages, attachments, images, 'synthetic')
+    return len(messages), len(images)
+
+
+# record
+
+def record(fixture_dir, count):
+    """Saves the newest promotions from the real mailbox, with attachments and inline images."""
+    import requests
+
+    import gmail_auth
+    import gmail_fetch
+    import gmail_sync
+    from html_extract import extract_html
+    from mime_walker import MessageParts
+
+    service = gmail_auth.get_service(os.environ['OAUTH2_CLIENT_SECRETS_FILE'])
+    listed = service.users().messages().list(
+        userId='me', q=gmail_sync.PROMOTIONS_QUERY, maxResults=count).execute().get('messages', [])
+    messages, failed = gmail_fetch.fetch_messages(service, [m['id'] for m in listed])
+    attachment_data, failed_attachments = gmail_fetch.fetch_attachments(service, messages)
+    if failed or failed_attachments:
+        # A partial recording would replay as a different workload
+        sys.exit(f"{len(failed)} messages and {len(failed_attachments)} attachments failed to download")
+    attachments = defaultdict(dict)
+    for (message_id, attachment_id), data in attachment_data.items():
+        attachments[message_id][attachment_id] = data
+    images = {}
+    session = requests.Session()
+    for msg in messages:
+        for src in extract_html(MessageParts(msg).text('text/html')).images:
+            if not src.startswith('http') or src in images:
+                continue
+            try:
+                response = session.get(src, timeout=10)
+            except requests.RequestException:
+                continue
+            if response.status_code == 200:
+                images[src] = (response.headers.get('Content-Type', 'application/octet-stream'), response.content)
+    write_fixtures(fixture_dir, messages, attachments, images, 'gmail')
+    return len(messages), len(images)
+
+
+# fakes
+
+class FakeRequest:
+    def __init__(self, method_id, fn, latency):
+        self.methodId = method_id
+        self.fn = fn
+        self.latency = latency
+
+    def execute(self):
+        time.sleep(self.latency)
+        return self.fn()
+
+
+class FakeBatch:
+    def __init__(self, callback, latency):
+        self.callback = callback
+        self.latency = latency
+        self.calls = []
+
+    def add(self, request, request_id):
+        self.calls.append((request_id, request))
+
+    def execute(self):
+        time.sleep(self.latency)
+        for request_id, request in self.calls:
+            self.callback(request_id, request.fn(), None)
+
+
+class FakeGmail:
+    """The Gmail API calls the pipeline makes, answered from the fixtures."""
+
+    def __init__(self, messages, attachments, latency):
+        self.raw_messages = messages
+        self.attachment_data = attachments
+        self.message_ids = list(messages)
+        self.latency = latency
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return self
+
+    def attachments(self):
+        return self
+
+    def getProfile(self, userId):
+        return FakeRequest('gmail.users.getProfile', lambda: {'historyId': str(len(self.message_ids))}, self.latency)
+
+    def list(self, userId, startHistoryId=None, historyTypes=None, labelId=None, pageToken=None,
+             q=None, maxResults=100):
+        if startHistoryId is None:
+            ids = self.message_ids[:maxResults]
+            return FakeRequest('gmail.users.messages.list',
+                               lambda: {'messages': [{'id': message_id} for message_id in ids]}, self.latency)
+        start = int(pageToken or startHistoryId)
+        end = min(start + HISTORY_PAGE_SIZE, len(self.message_ids))
+
+        def page():
+            response = {
+                'history': [{'messagesAdded': [{'message': {'id': message_id}}]}
+                            for message_id in self.message_ids[start:end]],
+                'historyId': str(len(self.message_ids)),
+            }
+            if end < len(self.message_ids):
+                response['nextPageToken'] = str(end)
+            return response
+        return FakeRequest('gmail.users.history.list', page, self.latency)
+
+    def get(self, userId, id=None, format=None, metadataHeaders=None, messageId=None):
+        if messageId is not None:
+            data = self.attachment_data[(messageId, id)]
+            return FakeRequest('gmail.users.messages.attachments.get',
+                               lambda: {'size': len(data), 'data': data}, self.latency)
+
+        def message():
+            msg = json.loads(self.raw_messages[id])
+            if format == 'metadata':
+                headers = [h for h in msg['payload'].get('headers', []) if h['name'] in (metadataHeaders or [])]
+                return {'id': msg['id'], 'labelIds': msg.get('labelIds', []), 'payload': {'headers': headers}}
+            return msg
+        return FakeRequest('gmail.users.messages.get', message, self.latency)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(callback, self.latency)
+
+
+def fake_image_hosts(images, latency):
+    """A requests transport adapter serving the recorded images."""
+    import requests
+    from requests.adapters import BaseAdapter
+    from requests.structures import CaseInsensitiveDict
+
+    class FakeImageHosts(BaseAdapter):
+        def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+            time.sleep(latency)
+            found = images.get(request.url)
+            response = requests.Response()
+            response.request = request
+            response.url = request.url
+            response.status_code = 200 if found else 404
+            response.reason = 'OK' if found else 'Not Found'
+            body = found[1] if found else b''
+            response.headers = CaseInsensitiveDict({
+                'Content-Type': found[0] if found else 'text/plain',
+                'Content-Length': str(len(body)),
+                'Cache-Control': 'max-age=3600',
+            })
+            response.raw = io.BytesIO(body)
+            return response
+
+        def close(self):
+            pass
+
+    return FakeImageHosts()
+
+
+class FakeModel:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate_content(self, prompt):
+        import re
+
+        time.sleep(self.latency)
+        numbers = re.findall(r'=== EMAIL (\d+) ===\n', prompt)
+        if numbers:
+            text = json.dumps([{'Email': int(n), 'Company': f'Shop {n}', 'Category': 'misc'} for n in numbers])
+        else:
+            text = json.dumps({'Company': 'Shop', 'Category': 'misc'})
+        return types.SimpleNamespace(text=text)
+
+
+FAKE_OCR_LATENCY = DEFAULT_OCR_LATENCY
+
+
+def fake_ocr_image(image):
+    time.sleep(FAKE_OCR_LATENCY)
+    text = 'USE CODE SAVE20'
+    return {'text': text, 'blocks': [([[0, 0], [120, 0], [120, 20], [0, 20]], text, 0.9)]}
+
+
+# measuring
+
+def rss_bytes(pid='self'):
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class StageProbe:
+    """Collects every span's duration and the peak RSS seen while each stage was running."""
+
+    def __init__(self, worker_pids):
+        self.worker_pids = worker_pids
+        self.samples = defaultdict(list)
+        self.peak_rss = defaultdict(int)
+        self.active = defaultdict(int)
+        self.lock = threading.Lock()
+        self.peak_total = 0
+        self.peak_workers = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @contextmanager
+    def running(self, stage):
+        with self.lock:
+            self.active[stage] += 1
+        # Short stages would slip between the sampler's ticks
+        self.sample()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active[stage] -= 1
+
+    def install(self, metrics, deep_search):
+        observe = metrics.observe
+        span = metrics.span
+        probe = self
+
+        def recording_observe(stage, seconds):
+            with probe.lock:
+                probe.samples[stage].append(seconds)
+            observe(stage, seconds)
+
+        @contextmanager
+        def tracked_span(stage, **fields):
+            with probe.running(stage), span(stage, **fields):
+                yield
+
+        # OCR runs in the worker processes and is recorded after the fact, so mark it here
+        ocr_images = deep_search.ocr_images
+        ocr_images_async = deep_search.ocr_images_async
+
+        def tracked_ocr_images(images):
+            with probe.running('ocr'):
+                return ocr_images(images)
+
+        async def tracked_ocr_images_async(images):
+            with probe.running('ocr'):
+                return await ocr_images_async(images)
+
+        metrics.observe = recording_observe
+        metrics.span = tracked_span
+        deep_search.ocr_images = tracked_ocr_images
+        deep_search.ocr_images_async = tracked_ocr_images_async
+
+    def sample(self):
+        workers = sum(rss_bytes(pid) for pid in self.worker_pids)
+        total = rss_bytes() + workers
+        with self.lock:
+            self.peak_total = max(self.peak_total, total)
+            self.peak_workers = max(self.peak_workers, workers)
+            for stage, count in self.active.items():
+                if count:
+                    self.peak_rss[stage] = max(self.peak_rss[stage], total)
+
+    def _loop(self):
+        while not self._stop.wait(RSS_SAMPLE_SECONDS):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='rss-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+def replay_once(args):
+    """One cold run in this process; returns its raw measurements."""
+    global FAKE_OCR_LATENCY
+    messages, attachments, images, manifest = load_fixtures(os.path.abspath(args.fixtures))
+
+    # Caches, sync state and stores start empty in a scratch directory
+    os.chdir(tempfile.mkdtemp(prefix='bench_replay_'))
+    with open('client_secrets.json', 'w') as f:
+        f.write('{}')
+    os.environ['OAUTH2_CLIENT_SECRETS_FILE'] = 'client_secrets.json'
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if not args.real_ocr:
+        os.environ['OCR_WARM_ON_STARTUP'] = '0'
+        FAKE_OCR_LATENCY = args.ocr_latency
+        import imageOCR
+        # OCR workers are forked from this process, so they inherit the fake
+        imageOCR.ocr_image = fake_ocr_image
+
+    import deep_search
+    import gmail_sync
+    import image_downloader
+    import message_processing
+    import metrics
+    import ocr_engine
+
+    message_processing._model = FakeModel(args.llm_latency)
+    hosts = fake_image_hosts(images, args.image_latency)
+    session = image_downloader.get_session()
+    session.mount('http://', hosts)
+    session.mount('https://', hosts)
+    ocr_engine.warm_workers()
+    # A stored historyId before the first message makes the incremental sync list every fixture
+    gmail_sync.save_history_id('0')
+
+    probe = StageProbe(list(ocr_engine.get_executor()._processes))
+    probe.install(metrics, deep_search)
+    rss_baseline = rss_bytes()
+    probe.start()
+    start = time.perf_counter()
+    if args.pipeline == 'serial':
+        promotions = deep_search.get_newest_emails(
+            FakeGmail(messages, attachments, args.gmail_latency), incremental=True)
+    else:
+        promotions = asyncio.run(deep_search.get_newest_emails_async(
+            lambda: FakeGmail(messages, attachments, args.gmail_latency), incremental=True))
+    wall = time.perf_counter() - start
+    probe.stop()
+    ocr_engine.shutdown()
+    last_run = deep_search.get_pipeline_stats()['last']
+
+    return {
+        'fixtures': manifest,
+        'messages': len(messages),
+        'promotions': len(promotions),
+        'wall_seconds': wall,
+        'rss_baseline_bytes': rss_baseline,
+        'rss_peak_bytes': probe.peak_total,
+        'rss_peak_ocr_workers_bytes': probe.peak_workers,
+        # ru_maxrss is in kilobytes on Linux
+        'maxrss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'stages': {stage: {'samples': samples, 'peak_rss_bytes': probe.peak_rss.get(stage, 0)}
+                   for stage, samples in probe.samples.items()},
+        'pipeline': {name: stats for name, stats in (last_run['stages'] if last_run else {}).items()
+                     if isinstance(stats, dict)},
+    }
+
+
+# reporting
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def summarize(runs, args):
+    walls = [run['wall_seconds'] for run in runs]
+    messages = runs[0]['messages']
+    stages = {}
+    for name in sorted({stage for run in runs for stage in run['stages']}):
+        samples = [s for run in runs for s in run['stages'].get(name, {}).get('samples', [])]
+        stages[name] = {
+            'count': len(samples) / len(runs),
+            'total_seconds': sum(samples) / len(runs),
+            'p50_seconds': percentile(samples, 0.5),
+            'p95_seconds': percentile(samples, 0.95),
+            'max_seconds': max(samples) if samples else 0.0,
+            'peak_rss_bytes': max(run['stages'].get(name, {}).get('peak_rss_bytes', 0) for run in runs),
+        }
+    return {
+        'commit': git_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'config': {
+            'pipeline': args.pipeline,
+            'runs': len(runs),
+            'fixtures': runs[0]['fixtures'],
+            'gmail_latency': args.gmail_latency,
+            'image_latency': args.image_latency,
+            'llm_latency': args.llm_latency,
+            'ocr_latency': None if args.real_ocr else args.ocr_latency,
+        },
+        'end_to_end': {
+            'messages': messages,
+            'promotions': runs[-1]['promotions'],
+            'p50_seconds': percentile(walls, 0.5),
+            'p95_seconds': percentile(walls, 0.95),
+            'min_seconds': min(walls),
+            'messages_per_second': messages / percentile(walls, 0.5),
+            'rss_baseline_bytes': max(run['rss_baseline_bytes'] for run in runs),
+            'rss_peak_bytes': max(run['rss_peak_bytes'] for run in runs),
+            'rss_peak_ocr_workers_bytes': max(run['rss_peak_ocr_workers_bytes'] for run in runs),
+            'maxrss_bytes': max(run['maxrss_bytes'] for run in runs),
+        },
+        'stages': stages,
+        'pipeline': runs[-1]['pipeline'],
+    }
+
+
+def mb(value):
+    return value / 2 ** 20
+
+
+def print_summary(results):
+    e2e = results['end_to_end']
+    config = results['config']
+    print(f"{config['fixtures']['source']} fixtures: {e2e['messages']} messages, "
+          f"{config['fixtures']['images']} hosted images; {config['pipeline']} pipeline, {config['runs']} runs")
+    print(f"end to end  p50 {e2e['p50_seconds']:7.2f} s  p95 {e2e['p95_seconds']:7.2f} s  "
+          f"{e2e['messages_per_second']:6.1f} msg/s  {e2e['promotions']} promotions")
+    print(f"peak RSS    {mb(e2e['rss_peak_bytes']):7.1f} MB (OCR workers {mb(e2e['rss_peak_ocr_workers_bytes']):.1f} MB, "
+          f"before the run {mb(e2e['rss_baseline_bytes']):.1f} MB)")
+    print(f"{'stage':18s} {'count':>7s} {'total s':>9s} {'p50 ms':>9s} {'p95 ms':>9s} {'peak RSS MB':>12s}")
+    for name, stage in results['stages'].items():
+        print(f"{name:18s} {stage['count']:7.0f} {stage['total_seconds']:9.2f} {stage['p50_seconds'] * 1000:9.1f} "
+              f"{stage['p95_seconds'] * 1000:9.1f} {mb(stage['peak_rss_bytes']):12.1f}")
+
+
+def run(args):
+    runs = []
+    for number in range(args.runs):
+        command = [sys.executable, os.path.abspath(__file__), '_replay', args.fixtures,
+                   '--pipeline', args.pipeline, '--gmail-latency', str(args.gmail_latency),
+                   '--image-latency', str(args.image_latency), '--llm-latency', str(args.llm_latency),
+                   '--ocr-latency', str(args.ocr_latency)] + (['--real-ocr'] if args.real_ocr else [])
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        completed = subprocess.run(command, capture_output=True, text=True, env=env)
+        if completed.returncode != 0:
+            sys.stderr.write(completed.stderr)
+            sys.exit(f"run {number + 1} failed")
+        runs.append(json.loads(completed.stdout.splitlines()[-1]))
+    results = summarize(runs, args)
+    print_summary(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"results written to {args.out}")
+
+
+def compare(args):
+    """Prints old vs new for the headline numbers; exits 1 if any got worse by more than the threshold."""
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows = [
+        ('end to end p50 s', old['end_to_end']['p50_seconds'], new['end_to_end']['p50_seconds'], False),
+        ('end to end p95 s', old['end_to_end']['p95_seconds'], new['end_to_end']['p95_seconds'], False),
+        ('messages/s', old['end_to_end']['messages_per_second'], new['end_to_end']['messages_per_second'], True),
+        ('peak RSS MB', mb(old['end_to_end']['rss_peak_bytes']), mb(new['end_to_end']['rss_peak_bytes']), False),
+    ]
+    for name in sorted(set(old['stages']) & set(new['stages'])):
+        for key in ('p50_seconds', 'p95_seconds'):
+            rows.append((f"{name} {key[:3]} s", old['stages'][name][key], new['stages'][name][key], False))
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    if old['config'] != new['config']:
+        print("note: the runs used different settings or fixtures")
+    regressions = 0
+    for name, before, after, higher_is_better in rows:
+        change = (after - before) / before if before else 0.0
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > args.threshold and (name.startswith(('end', 'messages', 'peak')) or
+                                       abs(after - before) >= COMPARE_MIN_SECONDS):
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{name:28s} {before:10.4f} {after:10.4f} {change * 100:+7.1f}%{flag}")
+    sys.exit(1 if regressions else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name in ('generate', 'record'):
+        command = commands.add_parser(name)
+        command.add_argument('fixtures')
+        command.add_argument('--messages', type=int, default=60 if name == 'generate' else 50)
+    for name in ('run', '_replay'):
+        command = commands.add_parser(name)
+        command.add_argument('fixtures')
+        command.add_argument('--pipeline', choices=('async', 'serial'), default='async')
+        command.add_argument('--runs', type=int, default=3)
+        command.add_argument('--gmail-latency', type=float, default=DEFAULT_GMAIL_LATENCY)
+        command.add_argument('--image-latency', type=float, default=DEFAULT_IMAGE_LATENCY)
+        command.add_argument('--llm-latency', type=float, default=DEFAULT_LLM_LATENCY)
+        command.add_argument('--ocr-latency', type=float, default=DEFAULT_OCR_LATENCY)
+        command.add_argument('--real-ocr', action='store_true', help='run EasyOCR instead of the fake')
+        command.add_argument('--out', help='write the results as JSON here')
+    command = commands.add_parser('compare')
+    command.add_argument('old')
+    command.add_argument('new')
+    command.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        print("wrote %d messages and %d hosted images" % generate(args.fixtures, args.messages))
+    elif args.command == 'record':
+        print("recorded %d messages and %d hosted images" % record(args.fixtures, args.messages))
+    elif args.command == 'run':
+        run(args)
+    elif args.command == '_replay':
+        # Child process of run: the last line of stdout is the measurement
+        print(json.dumps(replay_once(args)))
+    else:
+        compare(args)
+
+
+if __name__ == '__main__':
+    main()
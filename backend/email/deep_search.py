@@ -1,231 +1,655 @@
 import os
-import pickle
+import asyncio
 import base64
+import datetime
 import json
+import logging
 import re
-import requests  # Added for processing external image URLs
+import sys
+import threading
+import time
 import email
 from email import policy
 from email.parser import BytesParser
-from collections import defaultdict
-from bs4 import BeautifulSoup
+from collections import defaultdict, deque
 
-from flask import Flask, request, jsonify
+# Startup timings: how long the imports below take, and how long until the first request is answered
+_import_started = time.perf_counter()
+
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from dotenv import load_dotenv
-from imageOCR import classify_words  
-from message_processing import process_message 
+import extraction_cache
+import gmail_auth
+import gmail_backfill
+import gmail_fetch
+import gmail_sync
+from async_pipeline import Stage, run_pipeline
+from mime_walker import MessageParts, decode_base64url
+from html_extract import extract_html
+from image_downloader import download_images, get_download_stats
+import image_triage
+from imageOCR import format_detected_codes, scan_promo_codes
+from mailbox_scheduler import MailboxScheduler
+import metrics
+from message_processing import LLM_BATCH_MAX_EMAILS, PROMPT_VERSION, process_messages_batch
+import ocr_cache
+from ocr_engine import OCR_WORKERS, get_engine_stats, ocr_images, ocr_images_async, warm_workers
+import promo_dedup
+import promotion_store
+import rule_extractor
+
+startup_timings = {
+    'import_seconds': time.perf_counter() - _import_started,
+    'ready_seconds': None,
+    'first_request_seconds': None,
+}
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 load_dotenv()
 
+# Message bodies and OCR text are only ever logged as sizes; LOG_LEVEL=DEBUG adds timing spans
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
 # Get the OAuth 2.0 client secrets file path from environment variables
 OAUTH2_CLIENT_SECRETS_FILE = os.getenv('OAUTH2_CLIENT_SECRETS_FILE')
 
 if not OAUTH2_CLIENT_SECRETS_FILE or not os.path.exists(OAUTH2_CLIENT_SECRETS_FILE):
     raise FileNotFoundError(f'OAuth 2.0 client secrets file not found: {OAUTH2_CLIENT_SECRETS_FILE}')
 
-SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
+# Most links from an HTML email to pass along to the model
+MAX_PROMPT_LINKS = 10
 
-def get_service():
-    creds = None
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                OAUTH2_CLIENT_SECRETS_FILE, SCOPES)
-            creds = flow.run_local_server(port=8080)
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-
-    service = build('gmail', 'v1', credentials=creds)
-    return service
-
-def get_message_body(msg):
-    # Retrieve the plain text part of the email.
-    if 'data' in msg['payload']['body']:
-        body = msg['payload']['body']['data']
-    else:
-        parts = msg['payload'].get('parts', [])
-        for part in parts:
-            if part['mimeType'] == 'text/plain':
-                body = part['body']['data']
-                break
-        else:
-            body = ''
-    return base64.urlsafe_b64decode(body).decode('utf-8')
+# Skip the LLM for promotions the rule-based extractor is confident about
+RULE_FAST_PATH = os.getenv('RULE_FAST_PATH', '1') == '1'
+
+# 'async' runs fetches through the staged pipeline, 'serial' through get_newest_emails
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'async')
+# Workers per pipeline stage; a full queue between stages holds back the one before it
+PIPELINE_FETCH_CONCURRENCY = int(os.getenv('PIPELINE_FETCH_CONCURRENCY', '2'))
+PIPELINE_DECODE_CONCURRENCY = int(os.getenv('PIPELINE_DECODE_CONCURRENCY', '4'))
+PIPELINE_OCR_CONCURRENCY = int(os.getenv('PIPELINE_OCR_CONCURRENCY', str(OCR_WORKERS)))
+PIPELINE_EXTRACT_CONCURRENCY = int(os.getenv('PIPELINE_EXTRACT_CONCURRENCY', '2'))
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '16'))
+# How long the extract stage waits to fill a model batch
+PIPELINE_EXTRACT_LINGER_SECONDS = float(os.getenv('PIPELINE_EXTRACT_LINGER_SECONDS', '2.0'))
+# Stage stats of this many recent pipeline runs are kept for /stats
+PIPELINE_STATS_HISTORY = int(os.getenv('PIPELINE_STATS_HISTORY', '20'))
+
+# Several fetches can run at once, so each run's stats are kept whole, newest last
+_pipeline_runs = deque(maxlen=PIPELINE_STATS_HISTORY)
+_pipeline_runs_lock = threading.Lock()
+
+def get_service(account=gmail_auth.DEFAULT_ACCOUNT):
+    # Credentials and the Gmail client are cached; this is cheap after the first call
+    return gmail_auth.get_service(OAUTH2_CLIENT_SECRETS_FILE, gmail_auth.token_path_for(account))
+
+def get_message_body(msg, parts=None):
+    # Retrieve the plain text part of the email, wherever it is nested.
+    parts = parts or MessageParts(msg)
+    return parts.text('text/plain')
+
+def get_header(msg, name):
+    for header in msg['payload'].get('headers', []):
+        if header['name'].lower() == name.lower():
+            return header['value']
+    return ''
 
 # NEW FUNCTION: Extract HTML body from the email if available.
-def get_html_body(msg):
+def get_html_body(msg, parts=None):
     """
     Extracts the HTML portion of the email message.
     """
-    html = ''
-    if msg['payload'].get('mimeType') == 'text/html' and 'data' in msg['payload']['body']:
-         html = base64.urlsafe_b64decode(msg['payload']['body']['data']).decode('utf-8')
-    else:
-         parts = msg['payload'].get('parts', [])
-         for part in parts:
-              if part['mimeType'] == 'text/html' and 'data' in part['body']:
-                  html = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                  break
-    return html
+    parts = parts or MessageParts(msg)
+    return parts.text('text/html')
 
-def check_image_size(file_path):
+def save_debug_copy(store_dir, name, data):
     """
-    Check if an image file is larger than 275KB
+    Images stay in memory through OCR; when a debug directory is
+    configured, a copy is also written there for inspection.
     """
-    MIN_SIZE_BYTES = 275 * 1024  # 250KB in bytes
-    try:
-        file_size = os.path.getsize(file_path)
-        return file_size >= MIN_SIZE_BYTES
-    except OSError:
-        return False
-
-# MODIFIED FUNCTION: Process attachments and return OCR text output.
-def process_attachments(service, msg, store_dir):
-    """
-    Processes image attachments: saves them, runs OCR/classification,
-    and returns the combined classified text.
-    """
-    classified_texts = ""
-    if 'parts' in msg['payload']:
-        for part in msg['payload']['parts']:
-            if part['filename']:
-                if 'data' in part['body']:
-                    data = part['body']['data']
-                else:
-                    att_id = part['body']['attachmentId']
-                    att = service.users().messages().attachments().get(userId='me', messageId=msg['id'], id=att_id).execute()
-                    data = att['data']
-                file_data = base64.urlsafe_b64decode(data.encode('UTF-8'))
-                path = os.path.join(store_dir, part['filename'])
-                with open(path, 'wb') as f:
-                    f.write(file_data)
-                print(f'Saved attachment: {path}')
-                # Process image attachments if the mime type is image and size > 250KB
-                if part['mimeType'].startswith('image/'):
-                    if check_image_size(path):
-                        result = classify_words(path)
-                        print(f"Classified attachment image text: {result}")
-                        if result:
-                            classified_texts += "\n" + result
-                    else:
-                        print(f"Skipping OCR for {path} - file size below 275KB")
-    return classified_texts
-
-# MODIFIED FUNCTION: Process inline images in HTML and return OCR text output.
-def process_inline_images(html_content, store_dir):
-    """
-    Parses the HTML to find inline images, processes them,
-    and returns the combined classified text output.
-    """
-    classified_texts = ""
-    soup = BeautifulSoup(html_content, 'html.parser')
-    img_tags = soup.find_all('img')
-    for i, img in enumerate(img_tags):
-        src = img.get('src')
-        if not src:
-            continue
+    if not store_dir:
+        return
+    path = os.path.join(store_dir, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    logger.debug('Saved debug copy: %s', path)
+
+def queue_for_ocr(ocr_jobs, name, image_data):
+    """
+    Adds an OCR job for an image. If the same image bytes were OCR'd before,
+    the job already carries the cached result and won't be sent to OCR again.
+    """
+    digest = ocr_cache.image_digest(image_data)
+    result = ocr_cache.get(digest)
+    if result is None:
+        # Only images that look like they contain text are worth the OCR model
+        passed, reason = image_triage.should_ocr(image_data)
+        if not passed:
+            logger.debug("Skipping OCR for %s - %s", name, reason)
+            return
+    ocr_jobs.append({
+        'name': name,
+        'digest': digest,
+        # Cache hits don't need the bytes any more
+        'data': image_data if result is None else None,
+        'result': result,
+    })
+
+# MODIFIED FUNCTION: Process attachments and return their OCR jobs.
+def process_attachments(service, msg, store_dir=None, attachment_data=None, parts=None):
+    """
+    Decodes the message's image attachments and returns OCR jobs for the
+    ones that should go through OCR. attachment_data holds attachment
+    bodies already fetched in a batch, keyed by (message id, attachment id).
+    Other attachments are never fetched or decoded.
+    """
+    attachment_data = attachment_data or {}
+    parts = parts or MessageParts(msg)
+    ocr_jobs = []
+    for part in parts.attachments('image/'):
+        if part.has_data:
+            file_data = part.data
+        else:
+            data = attachment_data.get((msg['id'], part.attachment_id))
+            if data is None:
+                with metrics.span('attachment_fetch'):
+                    att = gmail_fetch.execute(
+                        service.users().messages().attachments().get(userId='me', messageId=msg['id'], id=part.attachment_id))
+                data = att['data']
+            file_data = decode_base64url(data)
+        name = f"{msg['id']}_{part.filename}"
+        save_debug_copy(store_dir, name, file_data)
+        # Queue image attachments for OCR
+        queue_for_ocr(ocr_jobs, name, file_data)
+    return ocr_jobs
+
+# MODIFIED FUNCTION: Process inline images from the HTML and return their OCR jobs.
+def process_inline_images(image_sources, store_dir=None, prefix=''):
+    """
+    Decodes or downloads the email's inline images (the img src values
+    collected by extract_html) and returns OCR jobs for the images that
+    should go through OCR.
+    """
+    images = []  # (position in the email, name, bytes)
+    remote = []  # (position in the email, name, url)
+    for i, src in enumerate(image_sources):
         # Process data URI images
         if src.startswith('data:'):
             try:
                 header, encoded = src.split(',', 1)
                 match = re.search(r'data:image/(\w+);base64', header)
                 ext = match.group(1) if match else 'png'
-                image_data = base64.b64decode(encoded)
-                filename = os.path.join(store_dir, f'inline_image_{i}.{ext}')
-                with open(filename, 'wb') as f:
-                    f.write(image_data)
-                print(f"Saved inline image from data URI: {filename}")
-                if check_image_size(filename):
-                    result = classify_words(filename)
-                    print(f"Classified inline data URI image text: {result}")
-                    if result:
-                        classified_texts += "\n" + result
-                else:
-                    print(f"Skipping OCR for {filename} - file size below 275KB")
+                with metrics.span('base64_decode'):
+                    image_data = base64.b64decode(encoded)
+                images.append((i, f'{prefix}inline_image_{i}.{ext}', image_data))
             except Exception as e:
-                print(f"Failed to process inline data URI image. Error: {str(e)}")
-        # Process external URL images
+                logger.warning("Failed to process inline data URI image. Error: %s", e)
+        # Collect external URL images to download together
         elif src.startswith('http'):
-            try:
-                response = requests.get(src)
-                if response.status_code == 200:
-                    ext_candidate = src.split('.')[-1].split('?')[0]
-                    ext = ext_candidate.lower() if ext_candidate.lower() in ['jpg', 'jpeg', 'png', 'gif', 'bmp'] else 'jpg'
-                    filename = os.path.join(store_dir, f'inline_image_{i}.{ext}')
-                    with open(filename, 'wb') as f:
-                        f.write(response.content)
-                    print(f"Saved inline image from URL: {filename}")
-                    if check_image_size(filename):
-                        result = classify_words(filename)
-                        print(f"Classified inline URL image text: {result}")
-                        if result:
-                            classified_texts += "\n" + result
-                    else:
-                        print(f"Skipping OCR for {filename} - file size below 275KB")
-                else:
-                    print(f"Failed to download image from {src}: HTTP {response.status_code}")
-            except Exception as e:
-                print(f"Failed to download inline image from URL: {src}. Error: {str(e)}")
-    return classified_texts
+            ext_candidate = src.split('.')[-1].split('?')[0]
+            ext = ext_candidate.lower() if ext_candidate.lower() in ['jpg', 'jpeg', 'png', 'gif', 'bmp'] else 'jpg'
+            remote.append((i, f'{prefix}inline_image_{i}.{ext}', src))
 
-def get_newest_emails(service, store_dir):
-    results = service.users().messages().list(userId='me', maxResults=3, q='category:promotions').execute()
-    messages = results.get('messages', [])
+    downloaded = download_images([src for _, _, src in remote])
+    for (i, name, _), image_data in zip(remote, downloaded):
+        if image_data is not None:
+            images.append((i, name, image_data))
+
+    ocr_jobs = []
+    for _, name, image_data in sorted(images, key=lambda image: image[0]):
+        save_debug_copy(store_dir, name, image_data)
+        queue_for_ocr(ocr_jobs, name, image_data)
+    return ocr_jobs
+
+def run_ocr_jobs(ocr_jobs):
+    """
+    OCRs every job that missed the cache in one batched run and stores
+    the new results in the cache. Failed OCR isn't cached, so the image
+    is tried again on the next fetch.
+    """
+    # The same banner often appears in several emails of one fetch; OCR it once
+    pending = {}
+    for job in ocr_jobs:
+        if job['result'] is None:
+            pending.setdefault(job['digest'], []).append(job)
+    digests = list(pending)
+    results = ocr_images([pending[digest][0]['data'] for digest in digests])
+    for digest, result in zip(digests, results):
+        for job in pending[digest]:
+            job['result'] = result
+            job['data'] = None
+        if not result.get('error'):
+            ocr_cache.put(digest, result)
+
+async def run_ocr_jobs_async(ocr_jobs, inflight):
+    """
+    run_ocr_jobs for the async pipeline. inflight maps image digests to
+    futures shared across the messages of a fetch, so an image that is
+    already being OCR'd for another message is awaited, not OCR'd again.
+    """
+    loop = asyncio.get_running_loop()
+    own = {}
+    futures = {}
+    for job in ocr_jobs:
+        if job['result'] is None:
+            if job['digest'] not in inflight:
+                inflight[job['digest']] = loop.create_future()
+                own[job['digest']] = job['data']
+            futures[job['digest']] = inflight[job['digest']]
+    if own:
+        try:
+            results = await ocr_images_async(list(own.values()))
+        except Exception as e:
+            for digest in own:
+                inflight.pop(digest).set_exception(e)
+            raise
+        for digest, result in zip(own, results):
+            if result.get('error'):
+                # Messages already waiting get the failure; later ones OCR the image again
+                inflight.pop(digest).set_result(result)
+                continue
+            inflight[digest].set_result(result)
+            ocr_cache.put(digest, result)
+    for job in ocr_jobs:
+        if job['result'] is None:
+            job['result'] = await futures[job['digest']]
+            job['data'] = None
+
+def join_ocr_texts(ocr_jobs):
+    """Combine OCR output the same way the per-image loop used to."""
+    return "".join("\n" + job['result']['text'] for job in ocr_jobs if job['result']['text'])
+
+def body_for_prompt(plain_text, html):
+    """
+    The text the model sees: the text/plain part, or the visible HTML text
+    for HTML-only emails, plus the email's links when the text has none.
+    """
+    text = plain_text if plain_text.strip() else html.text
+    if 'http' not in text:
+        links = [f"{label or 'link'}: {href}" for href, label in html.links[:MAX_PROMPT_LINKS] if href.startswith('http')]
+        if links:
+            text += "\nLinks:\n" + "\n".join(links)
+    return text
+
+def is_promotion(metadata):
+    """Only promotions need their full body; history can race with relabeling."""
+    return 'CATEGORY_PROMOTIONS' in metadata.get('labelIds', [])
+
+def list_messages(service, incremental=False, account=gmail_auth.DEFAULT_ACCOUNT):
+    """
+    The messages to process: new history in incremental mode, else the
+    newest promotions. Returns (messages, historyId to commit once they
+    are processed); the historyId is None outside incremental mode.
+    """
+    with metrics.span('gmail_list'):
+        if incremental:
+            message_ids, history_id = gmail_sync.list_new_message_ids(service, gmail_sync.state_path_for(account))
+            return [{'id': message_id} for message_id in message_ids], history_id
+        results = gmail_fetch.execute(service.users().messages().list(userId='me', maxResults=3, q='category:promotions'))
+    return results.get('messages', []), None
+
+def commit_sync(history_id, account=gmail_auth.DEFAULT_ACCOUNT):
+    """Marks the mailbox synced up to history_id, after its messages were processed."""
+    if history_id is not None:
+        gmail_sync.commit_history_id(history_id, gmail_sync.state_path_for(account))
+
+def fetch_full_messages(service, message_ids):
+    """
+    Pull messages and their attachments with batched Gmail requests.
+    Returns (messages, attachment data, ids of the messages that couldn't
+    be fetched whole). A message missing an attachment is still returned.
+    """
+    counts = gmail_fetch.new_counts()
+    with metrics.span('gmail_get', messages=len(message_ids)):
+        full_messages, failed = gmail_fetch.fetch_messages(
+            service, message_ids, needs_full=is_promotion, counts=counts)
+    with metrics.span('attachment_fetch'):
+        attachment_data, failed_attachments = gmail_fetch.fetch_attachments(service, full_messages, counts=counts)
+    failed = list(dict.fromkeys(failed + [message_id for message_id, _ in failed_attachments]))
+    logger.info("Gmail requests for this fetch: %s", counts)
+    if failed:
+        logger.warning("%d messages couldn't be fetched whole", len(failed))
+    return full_messages, attachment_data, failed
+
+def prepare_message(service, msg, store_dir=None, attachment_data=None):
+    """
+    Decodes one message: its prompt text, links and the OCR jobs for its
+    images. Returns (id, sender, text, links, attachment jobs, inline jobs).
+    """
+    # Walk the MIME tree once; parts are only decoded when read
+    parts = MessageParts(msg)
+    msg_str = get_message_body(msg, parts)
+    logger.debug("Message %s: %d chars of text", msg['id'], len(msg_str))
+
+    attachment_jobs = process_attachments(service, msg, store_dir, attachment_data, parts)
+
+    # One pass over the HTML gives the images, links and visible text
+    html_body = get_html_body(msg, parts)
+    with metrics.span('html_parse', chars=len(html_body)):
+        html = extract_html(html_body)
+    inline_jobs = process_inline_images(html.images, store_dir, prefix=f"{msg['id']}_")
+    msg_str = body_for_prompt(msg_str, html)
+
+    return (msg['id'], get_header(msg, 'From'), msg_str, html.links, attachment_jobs, inline_jobs)
+
+def extract_promotions(fetched, account=gmail_auth.DEFAULT_ACCOUNT):
+    """
+    Turns prepared messages (with their OCR done) into promotions: repeats
+    reuse what was extracted before, easy ones go through the rules and the
+    rest through batched model calls. Stores them under account and
+    returns (promotions, ids of the messages extraction failed for).
+    """
+    promotions = [None] * len(fetched)
+    combined_messages = []
+    llm_indexes = []
+    signatures = []
+    offers = []  # (introduced codes, discounts) of each email
+    repeats = {}
+    for index, (message_id, sender, msg_str, links, attachment_jobs, inline_jobs) in enumerate(fetched):
+        attachments_text = join_ocr_texts(attachment_jobs)
+        inline_images_text = join_ocr_texts(inline_jobs)
 
-    if not messages:
-        print("No messages found.")
-        return []
-    
-    processed_promotions = []
-    for message in messages:
-        msg = service.users().messages().get(userId='me', id=message['id'], format='full').execute()
-        msg_str = get_message_body(msg)
-        print("Message: %s" % msg_str)
-        
-        # Process attachments and capture OCR results
-        attachments_text = process_attachments(service, msg, store_dir)
-        
-        # Process inline HTML images and capture OCR results
-        html_content = get_html_body(msg)
-        inline_images_text = ""
-        if html_content:
-            inline_images_text = process_inline_images(html_content, store_dir)
-        
         # Combine the original message text with classified image text
         combined_text = msg_str + "\n" + attachments_text + "\n" + inline_images_text
-        
-        # Process the combined message text with the AI message processor
-        processed_promotion = process_message(combined_text)
-        if processed_promotion:
-            processed_promotions.extend(processed_promotion if isinstance(processed_promotion, list) else [processed_promotion])
-    
-    return processed_promotions
+
+        # Point the model at likely promo codes from the images and body
+        detected = scan_promo_codes(
+            [job['result']['blocks'] for job in attachment_jobs + inline_jobs], body_text=msg_str)
+        codes = {code for code, _ in detected if rule_extractor.is_introduced_code(code, combined_text)}
+
+        # A resend of an offer already seen reuses its promotion instead of costing a model call.
+        # Similar emails can still be different offers, so the code and discount must match too.
+        signature = promo_dedup.signature_for(msg_str)
+        signatures.append(signature)
+        offers.append((codes, promo_dedup.discounts(combined_text)))
+        if signature is not None:
+            earlier = promo_dedup.find_similar(
+                signature, [other if other and offers[position] == offers[index] else []
+                            for position, other in enumerate(signatures[:index])])
+            if earlier is not None:
+                repeats[index] = earlier
+                promo_dedup.record_in_fetch_duplicate()
+                continue
+        duplicate = promo_dedup.find_duplicate(signature, exclude_message_id=message_id, account=account)
+        if duplicate:
+            known = promotion_store.get_many(duplicate[1])
+            if known and not all(promo_dedup.same_offer(promotion, combined_text, codes) for promotion in known):
+                promo_dedup.record_offer_mismatch()
+            elif known:
+                update = {
+                    'Expiration Date': rule_extractor.find_expiration(combined_text),
+                    'Link to Promo': rule_extractor.find_cta_link(links, combined_text),
+                }
+                promotions[index] = [promo_dedup.merge(promotion, update) for promotion in known]
+                continue
+
+        # Easy promotions are filled in by rules; only unclear ones need the model
+        if RULE_FAST_PATH:
+            start = time.perf_counter()
+            promotion, confidence = rule_extractor.extract(sender, combined_text, links, detected)
+            if confidence >= rule_extractor.RULE_MIN_CONFIDENCE:
+                promotions[index] = promotion
+                rule_extractor.record_path('rule', time.perf_counter() - start)
+                continue
+            rule_extractor.record_path('rule_miss', time.perf_counter() - start)
+
+        hint = format_detected_codes([code for code, _ in detected])
+        if hint:
+            combined_text += "\n" + hint
+        combined_messages.append((message_id, combined_text))
+        llm_indexes.append(index)
+
+    # Extract the remaining promotions with batched model calls
+    if combined_messages:
+        start = time.perf_counter()
+        for index, promotion in zip(llm_indexes, process_messages_batch(combined_messages)):
+            promotions[index] = promotion
+        rule_extractor.record_path('llm', time.perf_counter() - start, count=len(combined_messages))
+
+    # Repeats within this fetch share the promotion of the first copy
+    for index, earlier in repeats.items():
+        promotions[index] = promotions[earlier]
+
+    processed_promotions = []
+    stored = []
+    failed = []
+    for (message_id, *_), processed_promotion in zip(fetched, promotions):
+        if processed_promotion is None:
+            # The model call or its JSON failed
+            failed.append(message_id)
+        elif processed_promotion:
+            found = processed_promotion if isinstance(processed_promotion, list) else [processed_promotion]
+            processed_promotions.extend(found)
+            stored.extend((message_id, promotion) for promotion in found)
+
+    # Keep the results so /promotions can serve them without re-running the pipeline;
+    # repeats of a stored offer are merged into it
+    keys = promotion_store.save(stored, account)
+    keys_by_message = defaultdict(list)
+    for (message_id, _), key in zip(stored, keys):
+        keys_by_message[message_id].append(key)
+    for (message_id, *_), signature in zip(fetched, signatures):
+        promo_dedup.remember(message_id, signature, keys_by_message.get(message_id), account)
+
+    if failed:
+        logger.warning("Extraction failed for %d messages", len(failed))
+    return processed_promotions, failed
+
+def get_newest_emails(service, store_dir=None, incremental=False, account=gmail_auth.DEFAULT_ACCOUNT):
+    """
+    Processes the newest promotions. In incremental mode only the messages
+    added since the last sync (by Gmail historyId) are fetched.
+    """
+    messages, history_id = list_messages(service, incremental, account)
+    if not messages:
+        logger.info("No messages found.")
+        commit_sync(history_id, account)
+        return []
+
+    promotions, failures = process_message_ids(service, [message['id'] for message in messages], store_dir, account)
+    if failures:
+        # The stored promotions dedupe, so the next sync can safely list these again
+        logger.warning("%d messages failed; historyId %s not committed", failures, history_id)
+    else:
+        commit_sync(history_id, account)
+    return promotions
+
+def process_message_ids(service, message_ids, store_dir=None, account=gmail_auth.DEFAULT_ACCOUNT):
+    """
+    Fetches the given messages and extracts and stores their promotions.
+    Returns (promotions, number of messages that failed to fetch or extract).
+    """
+    full_messages, attachment_data, fetch_failed = fetch_full_messages(service, message_ids)
+
+    # First pass: collect the images each message needs OCR'd
+    fetched = [prepare_message(service, msg, store_dir, attachment_data) for msg in full_messages]
+
+    # Second pass: OCR every uncached image from the fetch in one batched, parallel run
+    run_ocr_jobs([job for item in fetched for job in item[4] + item[5]])
+
+    promotions, extract_failed = extract_promotions(fetched, account)
+    return promotions, len(set(fetch_failed + extract_failed))
+
+async def get_newest_emails_async(service_factory, store_dir=None, incremental=False,
+                                  account=gmail_auth.DEFAULT_ACCOUNT):
+    """
+    get_newest_emails as a pipeline of concurrent stages: fetch (batched
+    Gmail calls), decode (MIME, HTML, image downloads), OCR (process pool)
+    and extract (rules, then batched model calls). service_factory builds
+    a Gmail service; each worker thread gets its own because the Gmail
+    client's HTTP connection isn't thread-safe.
+    """
+    messages, history_id = await asyncio.to_thread(lambda: list_messages(service_factory(), incremental, account))
+    if not messages:
+        logger.info("No messages found.")
+        commit_sync(history_id, account)
+        return []
+    promotions, stats = await run_message_pipeline(
+        service_factory, [message['id'] for message in messages], store_dir, account)
+    if pipeline_failures(stats):
+        # The stored promotions dedupe, so the next sync can safely list these again
+        logger.warning("Some messages failed; historyId %s not committed", history_id)
+    else:
+        commit_sync(history_id, account)
+    return promotions
+
+async def process_message_ids_async(service_factory, message_ids, store_dir=None,
+                                    account=gmail_auth.DEFAULT_ACCOUNT):
+    """process_message_ids through the async pipeline."""
+    promotions, stats = await run_message_pipeline(service_factory, message_ids, store_dir, account)
+    return promotions, pipeline_failures(stats)
+
+async def run_message_pipeline(service_factory, message_ids, store_dir=None,
+                               account=gmail_auth.DEFAULT_ACCOUNT):
+    """
+    Runs the async pipeline; returns (promotions, per-stage stats).
+    stats['failed_messages'] counts messages that failed to fetch or
+    extract without failing their stage.
+    """
+    local = threading.local()
+    failed = set()
+
+    def thread_service():
+        if not hasattr(local, 'service'):
+            local.service = service_factory()
+        return local.service
+
+    async def fetch(message_ids):
+        full_messages, attachment_data, fetch_failed = await asyncio.to_thread(
+            lambda: fetch_full_messages(thread_service(), message_ids))
+        failed.update(fetch_failed)
+        return [(msg, attachment_data) for msg in full_messages]
+
+    async def decode(batch):
+        return [
+            await asyncio.to_thread(lambda: prepare_message(thread_service(), msg, store_dir, attachment_data))
+            for msg, attachment_data in batch
+        ]
+
+    inflight = {}
+
+    async def ocr(batch):
+        for item in batch:
+            await run_ocr_jobs_async(item[4] + item[5], inflight)
+        return batch
+
+    async def extract(batch):
+        promotions, extract_failed = await asyncio.to_thread(extract_promotions, batch, account)
+        failed.update(extract_failed)
+        return [promotions]
+
+    stages = [
+        Stage('fetch', fetch, PIPELINE_FETCH_CONCURRENCY, batch_size=gmail_fetch.GMAIL_BATCH_SIZE),
+        Stage('decode', decode, PIPELINE_DECODE_CONCURRENCY),
+        Stage('ocr', ocr, PIPELINE_OCR_CONCURRENCY),
+        Stage('extract', extract, PIPELINE_EXTRACT_CONCURRENCY, batch_size=LLM_BATCH_MAX_EMAILS,
+              linger=PIPELINE_EXTRACT_LINGER_SECONDS),
+    ]
+    results, stats = await run_pipeline(message_ids, stages, PIPELINE_QUEUE_SIZE)
+    stats['failed_messages'] = len(failed)
+    logger.info("Pipeline stages for this fetch: %s", stats)
+    record_pipeline_run(account, len(message_ids), stats)
+    return [promotion for promotions in results for promotion in promotions], stats
+
+def pipeline_failures(stats):
+    """Failed messages plus failed stage calls; nonzero means some messages may be missing."""
+    return stats['failed_messages'] + sum(stage['failures'] for stage in stats.values() if isinstance(stage, dict))
+
+def record_pipeline_run(account, messages, stats):
+    with _pipeline_runs_lock:
+        _pipeline_runs.append({'account': account, 'messages': messages, 'finished_at': time.time(), 'stages': stats})
+
+def get_pipeline_stats():
+    """The most recent pipeline runs, newest last, and the newest on its own."""
+    with _pipeline_runs_lock:
+        runs = list(_pipeline_runs)
+    return {'last': runs[-1] if runs else None, 'recent': runs}
+
+def get_debug_dir():
+    # Images are processed in memory; set ATTACHMENTS_DEBUG_DIR to also keep copies on disk
+    store_dir = os.getenv('ATTACHMENTS_DEBUG_DIR')
+    if store_dir and not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    return store_dir
+
+def fetch_promotions(incremental=False, account=gmail_auth.DEFAULT_ACCOUNT):
+    return get_newest_emails(get_service(account), get_debug_dir(), incremental=incremental, account=account)
+
+async def fetch_promotions_async(incremental=False, account=gmail_auth.DEFAULT_ACCOUNT):
+    return await get_newest_emails_async(lambda: get_service(account), get_debug_dir(),
+                                         incremental=incremental, account=account)
+
+def sync_account(account):
+    """
+    Syncs just what was added to account's mailbox. Returns the Gmail
+    quota units it used, which the scheduler charges to the account.
+    """
+    # Every account's fetch runs on the same OCR processes and model call slots
+    with gmail_fetch.metered(gmail_fetch.GMAIL_USER_UNITS_PER_SECOND, account) as meter:
+        if PIPELINE_MODE == 'serial':
+            promotions = fetch_promotions(incremental=True, account=account)
+        else:
+            promotions = asyncio.run(fetch_promotions_async(incremental=True, account=account))
+    logger.info("Processed %d promotions (%d quota units)", len(promotions), meter['units'])
+    return meter['units']
+
+def run_backfill(stop_event=None):
+    """Imports every existing promotion, a chunk at a time, resuming from the last checkpoint."""
+    service = get_service()
+    store_dir = get_debug_dir()
+
+    def process_chunk(message_ids):
+        # The failure count tells the backfill to retry the chunk
+        if PIPELINE_MODE == 'serial':
+            _, failures = process_message_ids(service, message_ids, store_dir)
+        else:
+            _, failures = asyncio.run(process_message_ids_async(get_service, message_ids, store_dir))
+        return failures
+
+    return gmail_backfill.run_backfill(service, process_chunk, stop_event=stop_event)
+
+backfill_stop = threading.Event()
+backfill_thread = None
+
+def run_backfill_in_background():
+    try:
+        run_backfill(backfill_stop)
+    except Exception:
+        logger.exception("Backfill stopped with an error")
+
+scheduler = MailboxScheduler(sync_account)
+
+def start_scheduler():
+    scheduler.start()
+    for account in gmail_auth.list_accounts():
+        scheduler.add_account(account)
+
+@app.before_request
+def start_request_timer():
+    request.started_at = time.perf_counter()
+
+@app.after_request
+def record_first_request(response):
+    if startup_timings['first_request_seconds'] is None:
+        startup_timings['first_request_seconds'] = time.perf_counter() - request.started_at
+        logger.info("First request (%s) took %.3fs", request.path, startup_timings['first_request_seconds'])
+    return response
 
 @app.route('/fetch-emails', methods=['GET'])
-def fetch_emails():
+async def fetch_emails():
     try:
-        service = get_service()
-        store_dir = 'attachments'
-        if not os.path.exists(store_dir):
-            os.makedirs(store_dir)
-        promotions = get_newest_emails(service, store_dir)
-        print("Processed promotions:", promotions)  # Debug log
+        incremental = request.args.get('mode') == 'incremental'
+        if request.args.get('pipeline', PIPELINE_MODE) == 'serial':
+            promotions = await asyncio.to_thread(fetch_promotions, incremental)
+        else:
+            promotions = await fetch_promotions_async(incremental)
+        logger.info("Processed %d promotions", len(promotions))
         return jsonify(promotions)
     except Exception as e:
-        print(f"Error in fetch_emails: {str(e)}")
+        logger.exception("Error in fetch_emails")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/gmail-webhook', methods=['POST'])
@@ -241,11 +665,116 @@ def gmail_webhook():
 
     # Decode the Pub/Sub message
     pubsub_message = base64.urlsafe_b64decode(message['data']).decode('utf-8')
-    print(f'Received message: {pubsub_message}')
-    fetch_emails()
+    logger.debug('Received Pub/Sub message %s', message.get('messageId'))
+    try:
+        mailbox = json.loads(pubsub_message).get('emailAddress', 'me')
+    except ValueError:
+        mailbox = 'me'
+
+    account = gmail_auth.account_for(mailbox)
+    if account is None:
+        # Ack anyway, or Pub/Sub keeps redelivering it
+        logger.warning('Webhook notification for a mailbox without a token')
+        return 'OK', 200
+
+    # Ack right away; the sync runs on a background worker so Pub/Sub never
+    # waits on Gmail, OCR and Gemini (and never redelivers because of them)
+    scheduler.start()
+    status = scheduler.push(account, message.get('messageId'))
+    logger.info('Webhook notification: %s', status)
 
     return 'OK', 200
 
+@app.route('/promotions', methods=['GET'])
+def list_promotions():
+    """
+    Serves stored promotions. Optional filters: account, company, category,
+    code, expires_after (YYYY-MM-DD, defaults to today); paginate with
+    limit/offset.
+    """
+    try:
+        promotions, next_offset = promotion_store.query(
+            company=request.args.get('company'),
+            category=request.args.get('category'),
+            promo_code=request.args.get('code'),
+            expires_after=request.args.get('expires_after', datetime.date.today().isoformat()),
+            limit=request.args.get('limit', 20),
+            offset=request.args.get('offset', 0),
+            account=request.args.get('account'),
+        )
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+    return jsonify({'promotions': promotions, 'next_offset': next_offset})
+
+@app.route('/backfill', methods=['GET', 'POST', 'DELETE'])
+def backfill():
+    """
+    POST starts (or resumes) importing the whole promotions label in the
+    background, DELETE stops it after the current chunk, GET reports progress.
+    """
+    global backfill_thread
+    running = backfill_thread is not None and backfill_thread.is_alive()
+    if request.method == 'POST':
+        if running:
+            return jsonify({'status': 'running'}), 409
+        backfill_stop.clear()
+        backfill_thread = threading.Thread(target=run_backfill_in_background, name='backfill', daemon=True)
+        backfill_thread.start()
+        return jsonify({'status': 'started'}), 202
+    if request.method == 'DELETE':
+        backfill_stop.set()
+        return jsonify({'status': 'stopping' if running else 'idle'})
+    return jsonify(gmail_backfill.get_backfill_stats())
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Per-stage latency histograms in the Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        'ocr': get_engine_stats(),
+        'ocr_cache': ocr_cache.get_cache_stats(),
+        'extraction_cache': extraction_cache.get_cache_stats(),
+        'scheduler': scheduler.get_stats(),
+        'image_downloads': get_download_stats(),
+        'image_triage': image_triage.get_triage_stats(),
+        'extraction_paths': rule_extractor.get_path_stats(),
+        'promotion_store': promotion_store.get_store_stats(),
+        'dedup': promo_dedup.get_dedup_stats(),
+        'pipeline': get_pipeline_stats(),
+        'backfill': gmail_backfill.get_backfill_stats(),
+        'gmail_auth': gmail_auth.get_auth_stats(),
+        'startup': startup_timings,
+    })
+
 if __name__ == '__main__':
-    print("Starting Flask server...")
-    app.run(debug=True, port=5000, host='127.0.0.1')
+    if sys.argv[1:] == ['backfill']:
+        # python deep_search.py backfill: run the import in the foreground; rerun to resume
+        run_backfill()
+        sys.exit(0)
+    if sys.argv[1:] == ['add-account']:
+        # python deep_search.py add-account: authorize another mailbox (needs GMAIL_TOKENS_DIR)
+        logger.info("Added account %s", gmail_auth.authorize_account(OAUTH2_CLIENT_SECRETS_FILE))
+        sys.exit(0)
+    logger.info("Starting Flask server...")
+    # Drop cached extractions made with an older prompt template
+    extraction_cache.invalidate(PROMPT_VERSION)
+    # Start the OCR workers (each loads its models once) so the first request doesn't pay for it
+    if os.getenv('OCR_WARM_ON_STARTUP', '1') == '1':
+        warm_workers()
+    start_scheduler()
+    promotion_store.start_evictor()
+    startup_timings['ready_seconds'] = time.perf_counter() - _import_started
+    logger.info("Ready in %.2fs (imports %.2fs)", startup_timings['ready_seconds'], startup_timings['import_seconds'])
+    if os.getenv('SERVER') == 'uvicorn':
+        # Serve through an ASGI server. Flask stays a WSGI app: WsgiToAsgi runs
+        # it on a thread pool, and Flask 2.0 runs each async view with
+        # asgiref's async_to_sync on an event loop of its own for that
+        # request, not on uvicorn's loop
+        import uvicorn
+        from asgiref.wsgi import WsgiToAsgi
+        uvicorn.run(WsgiToAsgi(app), port=5000, host='127.0.0.1')
+    else:
+        app.run(debug=True, port=5000, host='127.0.0.1')
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Gemini calls dominate request latency and cost, so structured results are
+# stored per (Gmail message id, hash of the combined text). Entries made with
+# a different prompt template are treated as stale.
+EXTRACTION_CACHE_PATH = os.getenv("EXTRACTION_CACHE_PATH", "extraction_cache.sqlite3")
+EXTRACTION_CACHE_TTL_DAYS = float(os.getenv("EXTRACTION_CACHE_TTL_DAYS", "30"))
+
+_lock = threading.Lock()
+_conn = None
+_cache_stats = {"hits": 0, "misses": 0, "stale": 0, "puts": 0}
+
+
+def text_digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(EXTRACTION_CACHE_PATH, check_same_thread=False)
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS extraction_cache ("
+            " message_id TEXT NOT NULL,"
+            " text_digest TEXT NOT NULL,"
+            " prompt_version TEXT NOT NULL,"
+            " result TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " PRIMARY KEY (message_id, text_digest))"
+        )
+        _conn.commit()
+    return _conn
+
+
+def get(message_id, text, prompt_version):
+    """Return the stored promotion dict for this message text, or None."""
+    digest = text_digest(text)
+    with _lock:
+        row = _get_conn().execute(
+            "SELECT result, prompt_version, created_at FROM extraction_cache"
+            " WHERE message_id = ? AND text_digest = ?",
+            (message_id, digest),
+        ).fetchone()
+        if row is None:
+            _cache_stats["misses"] += 1
+            return None
+        result, version, created_at = row
+        if version != prompt_version or time.time() - created_at > EXTRACTION_CACHE_TTL_DAYS * 24 * 3600:
+            _cache_stats["stale"] += 1
+            _cache_stats["misses"] += 1
+            return None
+        _cache_stats["hits"] += 1
+    return json.loads(result)
+
+
+def put(message_id, text, prompt_version, result):
+    with _lock:
+        conn = _get_conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO extraction_cache"
+            " (message_id, text_digest, prompt_version, result, created_at) VALUES (?, ?, ?, ?, ?)",
+            (message_id, text_digest(text), prompt_version, json.dumps(result), time.time()),
+        )
+        conn.commit()
+        _cache_stats["puts"] += 1
+
+
+def invalidate(prompt_version=None):
+    """
+    Drop expired entries and, if prompt_version is given, every entry
+    made with a different prompt template.
+    """
+    cutoff = time.time() - EXTRACTION_CACHE_TTL_DAYS * 24 * 3600
+    with _lock:
+        conn = _get_conn()
+        removed = conn.execute("DELETE FROM extraction_cache WHERE created_at < ?", (cutoff,)).rowcount
+        if prompt_version is not None:
+            removed += conn.execute(
+                "DELETE FROM extraction_cache WHERE prompt_version != ?", (prompt_version,)
+            ).rowcount
+        conn.commit()
+    return removed
+
+
+def get_cache_stats():
+    with _lock:
+        stats = dict(_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
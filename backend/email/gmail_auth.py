@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+logger = logging.getLogger(__name__)
+
+# Credentials are loaded once per process and refreshed a few minutes before
+# they expire, and each thread keeps the Gmail client it built (the client's
+# HTTP connection isn't thread-safe), so a request no longer re-reads the
+# token and rebuilds the discovery client. Tokens are stored as JSON, one
+# per account when several mailboxes are served.
+SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
+GMAIL_TOKEN_PATH = os.getenv('GMAIL_TOKEN_PATH', 'token.json')
+LEGACY_TOKEN_PATH = 'token.pickle'
+REFRESH_MARGIN_SECONDS = int(os.getenv('GMAIL_REFRESH_MARGIN_SECONDS', '300'))
+# Set to serve several mailboxes: one <email address>.json token per account.
+# Unset, the process serves the single account in GMAIL_TOKEN_PATH, named 'me'.
+GMAIL_TOKENS_DIR = os.getenv('GMAIL_TOKENS_DIR')
+DEFAULT_ACCOUNT = 'me'
+# Gmail clients (one per account) each thread keeps; the least recently used is dropped
+SERVICE_CACHE_SIZE = int(os.getenv('GMAIL_SERVICE_CACHE_SIZE', '32'))
+
+_lock = threading.Lock()
+_credentials = {}  # token path -> credentials
+_token_locks = {}  # token path -> lock held while loading or refreshing it
+_local = threading.local()
+
+_stats_lock = threading.Lock()
+_auth_stats = {'loads': 0, 'refreshes': 0, 'authorizations': 0, 'service_builds': 0,
+               'service_hits': 0, 'build_seconds': 0.0}
+
+
+def _count(key, amount=1):
+    with _stats_lock:
+        _auth_stats[key] += amount
+
+
+def save_credentials(creds, token_path=GMAIL_TOKEN_PATH):
+    # Write to a temp file and rename so a crash never leaves a torn token file
+    tmp_path = token_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(creds.to_json())
+    os.replace(tmp_path, token_path)
+
+
+def load_credentials(token_path=GMAIL_TOKEN_PATH):
+    """Stored credentials, or None. A token.pickle from older versions is converted once."""
+    if os.path.exists(token_path):
+        with open(token_path, 'r') as f:
+            return Credentials.from_authorized_user_info(json.load(f), SCOPES)
+    if token_path == GMAIL_TOKEN_PATH and os.path.exists(LEGACY_TOKEN_PATH):
+        with open(LEGACY_TOKEN_PATH, 'rb') as token:
+            creds = pickle.load(token)
+        save_credentials(creds, token_path)
+        logger.info("Converted %s to %s", LEGACY_TOKEN_PATH, token_path)
+        return creds
+    return None
+
+
+def _expiring(creds):
+    # google-auth keeps expiry as a naive UTC datetime
+    if creds.expiry is None:
+        return False
+    return creds.expiry - datetime.utcnow() < timedelta(seconds=REFRESH_MARGIN_SECONDS)
+
+
+def list_accounts():
+    """The accounts this process syncs."""
+    if not GMAIL_TOKENS_DIR:
+        return [DEFAULT_ACCOUNT]
+    if not os.path.isdir(GMAIL_TOKENS_DIR):
+        return []
+    return sorted(name[:-len('.json')] for name in os.listdir(GMAIL_TOKENS_DIR) if name.endswith('.json'))
+
+
+def account_for(mailbox):
+    """The account a push for mailbox belongs to, or None if it isn't one of ours."""
+    if not GMAIL_TOKENS_DIR:
+        return DEFAULT_ACCOUNT
+    try:
+        return mailbox if mailbox and os.path.exists(token_path_for(mailbox)) else None
+    except ValueError:
+        return None
+
+
+def token_path_for(account):
+    if not GMAIL_TOKENS_DIR or account == DEFAULT_ACCOUNT:
+        return GMAIL_TOKEN_PATH
+    if os.path.basename(account) != account:
+        raise ValueError(f"invalid account name: {account!r}")
+    return os.path.join(GMAIL_TOKENS_DIR, account + '.json')
+
+
+def _token_lock(token_path):
+    with _lock:
+        return _token_locks.setdefault(token_path, threading.Lock())
+
+
+def get_credentials(client_secrets_file, token_path=GMAIL_TOKEN_PATH):
+    """
+    The process-wide credentials for token_path, refreshed ahead of expiry.
+    Runs the browser consent flow only when there is no usable token.
+    """
+    # One lock per token, so a slow refresh for one account doesn't hold up the others
+    with _token_lock(token_path):
+        creds = _credentials.get(token_path)
+        if creds is None:
+            creds = load_credentials(token_path)
+            _count('loads')
+        if creds and creds.refresh_token and (not creds.valid or _expiring(creds)):
+            creds.refresh(Request())
+            save_credentials(creds, token_path)
+            _count('refreshes')
+        elif not creds or not creds.valid:
+            if token_path != GMAIL_TOKEN_PATH:
+                # Extra accounts are added with authorize_account, never from a sync
+                raise RuntimeError(f"No usable Gmail token in {token_path}")
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_secrets_file(client_secrets_file, SCOPES)
+            creds = flow.run_local_server(port=8080)
+            save_credentials(creds, token_path)
+            _count('authorizations')
+        _credentials[token_path] = creds
+        return creds
+
+
+def authorize_account(client_secrets_file):
+    """
+    Runs the consent flow for another mailbox and stores its token under
+    GMAIL_TOKENS_DIR, named after the address. Returns the account name.
+    """
+    if not GMAIL_TOKENS_DIR:
+        raise RuntimeError("Set GMAIL_TOKENS_DIR to serve more than one mailbox")
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from googleapiclient.discovery import build
+    flow = InstalledAppFlow.from_client_secrets_file(client_secrets_file, SCOPES)
+    creds = flow.run_local_server(port=8080)
+    _count('authorizations')
+    service = build('gmail', 'v1', credentials=creds, cache_discovery=False)
+    account = service.users().getProfile(userId='me').execute()['emailAddress']
+    os.makedirs(GMAIL_TOKENS_DIR, exist_ok=True)
+    token_path = token_path_for(account)
+    save_credentials(creds, token_path)
+    with _lock:
+        _credentials.pop(token_path, None)
+    return account
+
+
+def get_service(client_secrets_file, token_path=GMAIL_TOKEN_PATH):
+    """This thread's Gmail client for token_path, built on first use."""
+    creds = get_credentials(client_secrets_file, token_path)
+    services = getattr(_local, 'services', None)
+    if services is None:
+        services = _local.services = OrderedDict()
+    cached = services.get(token_path)
+    # Refreshing updates the shared credentials in place, so a cached client stays valid
+    if cached is not None and cached[0] is creds:
+        services.move_to_end(token_path)
+        _count('service_hits')
+        return cached[1]
+    from googleapiclient.discovery import build
+    start = time.perf_counter()
+    service = build('gmail', 'v1', credentials=creds, cache_discovery=False)
+    _count('service_builds')
+    _count('build_seconds', time.perf_counter() - start)
+    services[token_path] = (creds, service)
+    services.move_to_end(token_path)
+    if len(services) > SERVICE_CACHE_SIZE:
+        services.popitem(last=False)
+    return service
+
+
+def get_auth_stats():
+    with _stats_lock:
+        return dict(_auth_stats)
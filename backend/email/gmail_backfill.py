@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+import gmail_fetch
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Backfill: import a user's existing promotions by paging through the whole
+# label. Message ids are handed to the extraction pipeline a fixed-size
+# chunk at a time, so memory stays flat however large the mailbox is, and
+# the position is checkpointed after every chunk so a restart resumes
+# where the last run stopped instead of starting over.
+BACKFILL_STATE_PATH = os.getenv('BACKFILL_STATE_PATH', 'backfill_state.json')
+BACKFILL_QUERY = os.getenv('BACKFILL_QUERY', 'category:promotions')
+BACKFILL_PAGE_SIZE = 500  # the most messages.list returns per page
+BACKFILL_CHUNK_SIZE = int(os.getenv('BACKFILL_CHUNK_SIZE', '25'))
+# Throughput cap, to stay inside Gmail and Gemini quotas; 0 disables it
+BACKFILL_MAX_MESSAGES_PER_MINUTE = float(os.getenv('BACKFILL_MAX_MESSAGES_PER_MINUTE', '120'))
+# A chunk that fails (or takes the process down) this many times in a row is
+# recorded in the state's skipped_ids and passed over, so one bad message
+# can't stall the backfill
+BACKFILL_MAX_CHUNK_ATTEMPTS = int(os.getenv('BACKFILL_MAX_CHUNK_ATTEMPTS', '3'))
+BACKFILL_RETRY_SECONDS = float(os.getenv('BACKFILL_RETRY_SECONDS', '30'))
+
+_stats_lock = threading.Lock()
+_backfill_stats = {
+    'running': False,
+    'processed': 0,
+    'chunks': 0,
+    'failed_chunks': 0,
+    'skipped_chunks': 0,
+    'throttled_seconds': 0.0,
+}
+
+
+def new_state():
+    # page_token is the page being worked on (None for the first page),
+    # page_offset how many of its messages are done and chunk_attempts how
+    # often the chunk at page_offset has failed
+    return {'page_token': None, 'page_offset': 0, 'processed': 0, 'completed': False,
+            'chunk_attempts': 0, 'skipped_ids': []}
+
+
+def load_state(state_path=BACKFILL_STATE_PATH):
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return new_state()
+    return dict(new_state(), **state)
+
+
+def save_state(state, state_path=BACKFILL_STATE_PATH):
+    # Write to a temp file and rename so a crash never leaves a torn state file
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def list_page(service, page_token=None):
+    """One page of the label: (message ids, next page token or None)."""
+    kwargs = {'userId': 'me', 'q': BACKFILL_QUERY, 'maxResults': BACKFILL_PAGE_SIZE}
+    if page_token:
+        kwargs['pageToken'] = page_token
+    with metrics.span('gmail_list'):
+        response = gmail_fetch.execute(service.users().messages().list(**kwargs))
+    return [m['id'] for m in response.get('messages', [])], response.get('nextPageToken')
+
+
+def _wait(seconds, stop_event):
+    """Sleeps for seconds, or less if stop_event is set meanwhile."""
+    if stop_event is not None:
+        stop_event.wait(seconds)
+    else:
+        time.sleep(seconds)
+
+
+def _throttle(started, processed, max_per_minute, stop_event=None):
+    """Sleep until processing `processed` messages since `started` is within the cap."""
+    if not max_per_minute:
+        return
+    wait = started + processed * 60.0 / max_per_minute - time.monotonic()
+    if wait > 0:
+        with _stats_lock:
+            _backfill_stats['throttled_seconds'] += wait
+        _wait(wait, stop_event)
+
+
+def run_backfill(service, process_chunk, state_path=BACKFILL_STATE_PATH, chunk_size=None,
+                 max_per_minute=None, stop_event=None):
+    """
+    Pages through every message matching BACKFILL_QUERY, calling
+    process_chunk(message_ids) for each chunk of up to chunk_size ids, and
+    checkpoints after each one. Resumes from the checkpoint in state_path.
+    process_chunk returns how many of the messages failed (or None); a
+    chunk that raises or reports failures is retried after
+    BACKFILL_RETRY_SECONDS, and skipped once it has been tried
+    BACKFILL_MAX_CHUNK_ATTEMPTS times. stop_event ends the run between
+    chunks. Returns the saved state.
+    """
+    chunk_size = chunk_size or BACKFILL_CHUNK_SIZE
+    max_per_minute = BACKFILL_MAX_MESSAGES_PER_MINUTE if max_per_minute is None else max_per_minute
+    state = load_state(state_path)
+    if state['completed']:
+        logger.info("Backfill already completed")
+        return state
+
+    with _stats_lock:
+        _backfill_stats['running'] = True
+    started = time.monotonic()
+    processed_this_run = 0
+    try:
+        while not (stop_event and stop_event.is_set()):
+            try:
+                message_ids, next_page_token = list_page(service, state['page_token'])
+            except HttpError as e:
+                if e.resp.status != 400 or not state['page_token']:
+                    raise
+                # The saved page token expired; start over, repeats are merged on save
+                logger.warning("Backfill page token expired, restarting from the first page")
+                state['page_token'], state['page_offset'] = None, 0
+                continue
+            while state['page_offset'] < len(message_ids):
+                if stop_event and stop_event.is_set():
+                    return state
+                chunk = message_ids[state['page_offset']:state['page_offset'] + chunk_size]
+                if state['chunk_attempts'] >= BACKFILL_MAX_CHUNK_ATTEMPTS:
+                    logger.error("Backfill chunk failed %d times, skipping %s", state['chunk_attempts'], chunk)
+                    state['skipped_ids'].extend(chunk)
+                    with _stats_lock:
+                        _backfill_stats['skipped_chunks'] += 1
+                else:
+                    # Counted before the chunk runs, so a chunk that takes the process down is skipped too
+                    state['chunk_attempts'] += 1
+                    save_state(state, state_path)
+                    try:
+                        failures = process_chunk(chunk)
+                    except Exception:
+                        logger.exception("Backfill chunk failed (attempt %d of %d)",
+                                         state['chunk_attempts'], BACKFILL_MAX_CHUNK_ATTEMPTS)
+                        failures = len(chunk)
+                    else:
+                        if failures:
+                            logger.warning("Backfill: %d messages of the chunk failed (attempt %d of %d)",
+                                           failures, state['chunk_attempts'], BACKFILL_MAX_CHUNK_ATTEMPTS)
+                    if failures:
+                        with _stats_lock:
+                            _backfill_stats['failed_chunks'] += 1
+                        if state['chunk_attempts'] < BACKFILL_MAX_CHUNK_ATTEMPTS:
+                            _wait(BACKFILL_RETRY_SECONDS, stop_event)
+                        continue
+                    state['processed'] += len(chunk)
+                    processed_this_run += len(chunk)
+                    with _stats_lock:
+                        _backfill_stats['processed'] += len(chunk)
+                        _backfill_stats['chunks'] += 1
+                    logger.info("Backfill: %d messages processed", state['processed'])
+                state['page_offset'] += len(chunk)
+                state['chunk_attempts'] = 0
+                save_state(state, state_path)
+                _throttle(started, processed_this_run, max_per_minute, stop_event)
+            if not next_page_token:
+                state['completed'] = True
+                save_state(state, state_path)
+                logger.info("Backfill completed: %d messages", state['processed'])
+                return state
+            state['page_token'] = next_page_token
+            state['page_offset'] = 0
+            save_state(state, state_path)
+        return state
+    finally:
+        with _stats_lock:
+            _backfill_stats['running'] = False
+
+
+def get_backfill_stats(state_path=BACKFILL_STATE_PATH):
+    with _stats_lock:
+        stats = dict(_backfill_stats)
+    state = load_state(state_path)
+    stats['total_processed'] = state['processed']
+    stats['skipped_messages'] = len(state['skipped_ids'])
+    stats['completed'] = state['completed']
+    return stats
@@ -0,0 +1,204 @@
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from googleapiclient.errors import HttpError
+
+from mime_walker import MessageParts
+
+logger = logging.getLogger(__name__)
+
+# Gmail allows up to 100 calls per batch, but large batches are the first to
+# get rate limited, so keep them small and retry throttled calls with backoff.
+GMAIL_BATCH_SIZE = int(os.getenv('GMAIL_BATCH_SIZE', '20'))
+GMAIL_MAX_RETRIES = int(os.getenv('GMAIL_MAX_RETRIES', '5'))
+GMAIL_BACKOFF_BASE_SECONDS = float(os.getenv('GMAIL_BACKOFF_BASE_SECONDS', '0.5'))
+METADATA_HEADERS = ['From', 'Subject', 'Date']
+# Gmail's per-user limit; a metered block is paced to stay under it
+GMAIL_USER_UNITS_PER_SECOND = int(os.getenv('GMAIL_USER_UNITS_PER_SECOND', '250'))
+# Pacing is a token bucket per account holding this share of the limit, refilled
+# at the rest of it, so no one-second window sees more than the limit. Kept
+# below 1, or nothing would be left to refill at.
+GMAIL_PACE_BURST_FRACTION = min(max(float(os.getenv('GMAIL_PACE_BURST_FRACTION', '0.2')), 0.0), 0.9)
+
+# Gmail quota units charged per call; a call inside a batch costs the same
+QUOTA_UNITS = {
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.attachments.get': 5,
+    'gmail.users.history.list': 2,
+    'gmail.users.getProfile': 1,
+}
+DEFAULT_QUOTA_UNITS = 5
+
+_quota_meter = contextvars.ContextVar('gmail_quota_meter', default=None)
+_meter_lock = threading.Lock()
+_pacers = {}  # account -> token bucket, kept across metered blocks
+
+
+def new_counts():
+    """Per-fetch request counters, filled in by the functions below."""
+    return {'http_requests': 0, 'sub_requests': 0, 'retries': 0, 'failures': 0}
+
+
+def _pacer(units_per_second, account):
+    burst = units_per_second * GMAIL_PACE_BURST_FRACTION
+    with _meter_lock:
+        pacer = _pacers.get(account) if account is not None else None
+        if pacer is None:
+            pacer = {'tokens': burst, 'updated': time.monotonic()}
+            if account is not None:
+                _pacers[account] = pacer
+        pacer['rate'] = units_per_second - burst
+        pacer['capacity'] = burst
+    return pacer
+
+
+@contextmanager
+def metered(units_per_second=None, account=None):
+    """
+    Adds up the quota units of the Gmail calls made inside the block,
+    including from threads started with asyncio.to_thread (they copy the
+    context). Yields a dict whose 'units' is the running total. With
+    units_per_second, calls wait as needed so that no one-second window
+    sees more units than that. The budget is account's, shared with its
+    earlier and concurrent blocks; without account it lasts for the block.
+    """
+    pacer = _pacer(units_per_second, account) if units_per_second else None
+    meter = {'units': 0, 'pacer': pacer}
+    token = _quota_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        _quota_meter.reset(token)
+
+
+def _charge(request):
+    meter = _quota_meter.get()
+    if meter is None:
+        return
+    units = QUOTA_UNITS.get(getattr(request, 'methodId', None), DEFAULT_QUOTA_UNITS)
+    with _meter_lock:
+        meter['units'] += units
+        pacer = meter['pacer']
+        if pacer is None:
+            return
+        # The units are taken now, even if that overdraws the bucket; the call
+        # waits until the refill has paid them back
+        now = time.monotonic()
+        pacer['tokens'] = min(pacer['capacity'], pacer['tokens'] + (now - pacer['updated']) * pacer['rate']) - units
+        pacer['updated'] = now
+        wait = -pacer['tokens'] / pacer['rate']
+    if wait > 0:
+        time.sleep(wait)
+
+
+def execute(request):
+    """Runs a single Gmail request, counting it against the current meter."""
+    _charge(request)
+    return request.execute()
+
+
+def _is_retryable(exception):
+    if not isinstance(exception, HttpError):
+        return False
+    status = exception.resp.status
+    if status in (429, 500, 502, 503, 504):
+        return True
+    if status == 403:
+        content = (exception.content or b'').lower()
+        return b'ratelimitexceeded' in content
+    return False
+
+
+def execute_batched(service, calls, counts=None):
+    """
+    Runs a dict of {key: request} through Gmail batch HTTP requests,
+    GMAIL_BATCH_SIZE calls at a time, retrying throttled calls with
+    exponential backoff. Returns ({key: response}, [keys of calls that
+    kept failing]). A 404 isn't a failure: the item is gone, and is just
+    left out of both.
+    """
+    if counts is None:
+        counts = new_counts()
+    results = {}
+    failed = []
+    pending = dict(calls)
+    attempt = 0
+    while pending:
+        retry = {}
+        keys = list(pending)
+        for start in range(0, len(keys), GMAIL_BATCH_SIZE):
+            chunk = keys[start:start + GMAIL_BATCH_SIZE]
+            index = {str(i): key for i, key in enumerate(chunk)}
+
+            def callback(request_id, response, exception, index=index):
+                key = index[request_id]
+                if exception is None:
+                    results[key] = response
+                elif _is_retryable(exception) and attempt < GMAIL_MAX_RETRIES:
+                    retry[key] = calls[key]
+                else:
+                    counts['failures'] += 1
+                    logger.warning("Gmail request %s failed: %s", key, exception)
+                    if not (isinstance(exception, HttpError) and exception.resp.status == 404):
+                        failed.append(key)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id, key in index.items():
+                batch.add(pending[key], request_id=request_id)
+                _charge(pending[key])
+            batch.execute()
+            counts['http_requests'] += 1
+            counts['sub_requests'] += len(chunk)
+        if retry:
+            attempt += 1
+            counts['retries'] += len(retry)
+            delay = GMAIL_BACKOFF_BASE_SECONDS * (2 ** (attempt - 1))
+            time.sleep(delay + random.uniform(0, delay))
+        pending = retry
+    return results, failed
+
+
+def fetch_messages(service, message_ids, needs_full=None, counts=None):
+    """
+    Fetches messages in two batched passes: format='metadata' for all of them,
+    then format='full' only for those where needs_full(metadata) is true.
+    Returns (full messages in the order of message_ids, ids whose fetch
+    failed), so callers can tell a failed fetch from a deleted message.
+    """
+    users = service.users()
+    metadata, failed = execute_batched(service, {
+        message_id: users.messages().get(userId='me', id=message_id, format='metadata', metadataHeaders=METADATA_HEADERS)
+        for message_id in message_ids
+    }, counts)
+    wanted = [
+        message_id for message_id in message_ids
+        if message_id in metadata and (needs_full is None or needs_full(metadata[message_id]))
+    ]
+    full, failed_full = execute_batched(service, {
+        message_id: users.messages().get(userId='me', id=message_id, format='full')
+        for message_id in wanted
+    }, counts)
+    return [full[message_id] for message_id in wanted if message_id in full], failed + failed_full
+
+
+def fetch_attachments(service, messages, counts=None, mime_prefix='image/'):
+    """
+    Fetches the body of every attachment of the given type that isn't
+    inlined in the given messages, batched across messages.
+    Returns ({(message_id, attachment_id): data}, [keys whose fetch failed]).
+    """
+    users = service.users()
+    calls = {}
+    for msg in messages:
+        for part in MessageParts(msg).attachments(mime_prefix):
+            if not part.has_data and part.attachment_id:
+                key = (msg['id'], part.attachment_id)
+                calls[key] = users.messages().attachments().get(userId='me', messageId=key[0], id=key[1])
+    responses, failed = execute_batched(service, calls, counts)
+    return {key: response['data'] for key, response in responses.items()}, failed
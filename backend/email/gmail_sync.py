@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import threading
+
+from googleapiclient.errors import HttpError
+
+import gmail_fetch
+
+logger = logging.getLogger(__name__)
+
+# Incremental sync: instead of re-listing the newest promotions on every push,
+# remember the mailbox historyId we last synced to and ask Gmail only for the
+# messages added since then.
+GMAIL_SYNC_STATE_PATH = os.getenv('GMAIL_SYNC_STATE_PATH', 'gmail_sync_state.json')
+# With several accounts each one keeps its historyId in its own file here
+GMAIL_SYNC_STATE_DIR = os.getenv('GMAIL_SYNC_STATE_DIR', 'gmail_sync_state')
+PROMOTIONS_LABEL = 'CATEGORY_PROMOTIONS'
+PROMOTIONS_QUERY = 'category:promotions'
+FULL_SYNC_MAX_RESULTS = int(os.getenv('GMAIL_FULL_SYNC_MAX_RESULTS', '3'))
+
+_locks_lock = threading.Lock()
+_state_locks = {}  # state path -> lock, so different accounts sync in parallel
+
+
+def state_path_for(account):
+    """Where account's historyId is kept; the default account uses GMAIL_SYNC_STATE_PATH."""
+    if account == 'me':
+        return GMAIL_SYNC_STATE_PATH
+    os.makedirs(GMAIL_SYNC_STATE_DIR, exist_ok=True)
+    return os.path.join(GMAIL_SYNC_STATE_DIR, account + '.json')
+
+
+def _state_lock(state_path):
+    with _locks_lock:
+        return _state_locks.setdefault(state_path, threading.Lock())
+
+
+def load_history_id(state_path=GMAIL_SYNC_STATE_PATH):
+    try:
+        with open(state_path, 'r') as f:
+            return json.load(f).get('historyId')
+    except (OSError, ValueError):
+        return None
+
+
+def save_history_id(history_id, state_path=GMAIL_SYNC_STATE_PATH):
+    # Write to a temp file and rename so a crash never leaves a torn state file
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'historyId': str(history_id)}, f)
+    os.replace(tmp_path, state_path)
+
+
+def full_sync(service):
+    """
+    Lists the newest promotions the old way and returns their ids together
+    with the mailbox historyId to resume incremental sync from.
+    """
+    # Read the historyId first so nothing that arrives during the listing is missed
+    history_id = gmail_fetch.execute(service.users().getProfile(userId='me'))['historyId']
+    results = gmail_fetch.execute(
+        service.users().messages().list(userId='me', maxResults=FULL_SYNC_MAX_RESULTS, q=PROMOTIONS_QUERY))
+    message_ids = [m['id'] for m in results.get('messages', [])]
+    return message_ids, history_id
+
+
+def history_sync(service, start_history_id):
+    """
+    Pages through users.history.list from start_history_id and returns the
+    ids of promotions added since then along with the newest historyId.
+    Raises HttpError 404 if start_history_id has expired.
+    """
+    message_ids = []
+    seen = set()
+    history_id = start_history_id
+    page_token = None
+    while True:
+        kwargs = {
+            'userId': 'me',
+            'startHistoryId': start_history_id,
+            'historyTypes': ['messageAdded'],
+            'labelId': PROMOTIONS_LABEL,
+        }
+        if page_token:
+            kwargs['pageToken'] = page_token
+        response = gmail_fetch.execute(service.users().history().list(**kwargs))
+        for record in response.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message_id = added['message']['id']
+                if message_id not in seen:
+                    seen.add(message_id)
+                    message_ids.append(message_id)
+        history_id = response.get('historyId', history_id)
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+    return message_ids, history_id
+
+
+def list_new_message_ids(service, state_path=GMAIL_SYNC_STATE_PATH):
+    """
+    Returns the ids of promotions that arrived since the last sync and the
+    historyId they bring the mailbox up to. The historyId isn't stored
+    here: pass it to commit_history_id once the messages are processed, so
+    a sync that fails part way lists them again next time. Falls back to a
+    full sync when there is no stored historyId yet or Gmail says it has
+    expired.
+    """
+    with _state_lock(state_path):
+        start_history_id = load_history_id(state_path)
+    if start_history_id is None:
+        logger.info("No stored historyId, running a full sync")
+        return full_sync(service)
+    try:
+        return history_sync(service, start_history_id)
+    except HttpError as e:
+        if e.resp.status != 404:
+            raise
+        logger.warning("historyId %s expired, running a full sync", start_history_id)
+        return full_sync(service)
+
+
+def commit_history_id(history_id, state_path=GMAIL_SYNC_STATE_PATH):
+    """Stores history_id as synced, unless a sync that finished first got further."""
+    with _state_lock(state_path):
+        stored = load_history_id(state_path)
+        if stored is not None and int(stored) > int(history_id):
+            return
+        save_history_id(history_id, state_path)
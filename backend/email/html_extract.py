@@ -0,0 +1,119 @@
+import re
+from html.parser import HTMLParser
+
+# lxml's parser is written in C; fall back to the stdlib parser when it isn't installed
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# One streaming pass over the email HTML collects everything the pipeline
+# needs (image sources, links with their text, visible text) without
+# building a document tree.
+HIDDEN_TAGS = frozenset(["script", "style", "head", "title", "noscript", "template"])
+BLOCK_TAGS = frozenset([
+    "p", "div", "br", "tr", "td", "th", "li", "ul", "ol", "table",
+    "h1", "h2", "h3", "h4", "h5", "h6", "center", "section", "hr",
+])
+WHITESPACE_RE = re.compile(r"[ \t\r\f\v]+")
+BLANK_LINES_RE = re.compile(r"\s*\n\s*")
+
+
+class HtmlContent:
+    def __init__(self, images, links, text):
+        self.images = images  # img src values, in document order
+        self.links = links  # (href, link text) pairs, in document order
+        self.text = text  # visible text with block boundaries as newlines
+
+
+class _Collector:
+    """Parser target shared by the lxml and stdlib parsers."""
+
+    def __init__(self):
+        self.images = []
+        self.links = []
+        self.chunks = []
+        self.hidden_depth = 0
+        self.link_href = None
+        self.link_chunks = []
+
+    def start(self, tag, attrib):
+        tag = tag.lower()
+        if tag in HIDDEN_TAGS:
+            self.hidden_depth += 1
+        elif tag == "img":
+            src = attrib.get("src")
+            if src:
+                self.images.append(src.strip())
+            alt = attrib.get("alt")
+            if alt and self.link_href is not None:
+                self.link_chunks.append(alt)
+        elif tag == "a":
+            self.link_href = (attrib.get("href") or "").strip()
+            self.link_chunks = []
+        if tag in BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def end(self, tag):
+        tag = tag.lower()
+        if tag in HIDDEN_TAGS:
+            self.hidden_depth = max(0, self.hidden_depth - 1)
+        elif tag == "a" and self.link_href is not None:
+            if self.link_href:
+                label = WHITESPACE_RE.sub(" ", " ".join(self.link_chunks)).strip()
+                self.links.append((self.link_href, label))
+            self.link_href = None
+        if tag in BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def data(self, data):
+        if self.hidden_depth:
+            return
+        self.chunks.append(data)
+        if self.link_href is not None:
+            self.link_chunks.append(data)
+
+    def close(self):
+        text = WHITESPACE_RE.sub(" ", "".join(self.chunks))
+        text = BLANK_LINES_RE.sub("\n", text).strip()
+        return HtmlContent(self.images, self.links, text)
+
+
+class _StdlibParser(HTMLParser):
+    def __init__(self, collector):
+        super().__init__(convert_charrefs=True)
+        self.collector = collector
+
+    def handle_starttag(self, tag, attrs):
+        self.collector.start(tag, dict(attrs))
+        if tag in ("img", "br", "hr"):
+            self.collector.end(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.collector.start(tag, dict(attrs))
+        self.collector.end(tag)
+
+    def handle_endtag(self, tag):
+        if tag not in ("img", "br", "hr"):
+            self.collector.end(tag)
+
+    def handle_data(self, data):
+        self.collector.data(data)
+
+
+def extract_html(html_content, use_lxml=True):
+    """Parse email HTML once and return its images, links and visible text."""
+    if not html_content:
+        return HtmlContent([], [], "")
+    collector = _Collector()
+    if use_lxml and etree is not None:
+        parser = etree.HTMLParser(target=collector, recover=True)
+        try:
+            return etree.fromstring(html_content, parser)
+        except (etree.XMLSyntaxError, ValueError):
+            # Nothing parseable; fall through to the forgiving stdlib parser
+            collector = _Collector()
+    parser = _StdlibParser(collector)
+    parser.feed(html_content)
+    parser.close()
+    return collector.close()
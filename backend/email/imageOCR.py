@@ -1,78 +1,237 @@
-import easyocr
+import logging
+import os
+import queue
 import re
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Readers are expensive to build (detection + recognition models are loaded
+# from disk), so each worker process keeps a small pool of warm readers that
+# request threads borrow one at a time.
+OCR_LANGUAGES = ["en"]
+OCR_READER_POOL_SIZE = max(1, int(os.getenv("OCR_READER_POOL_SIZE", "1")))
+
+_reader_pool = None
+_reader_pool_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_ocr_stats = {
+    "model_loads": 0,
+    "model_load_seconds": 0.0,
+    "images": 0,
+    "ocr_seconds": 0.0,
+    "last_image_seconds": 0.0,
+}
+
+
+# All promo code shapes folded into one precompiled alternation
+PROMO_CODE_RE = re.compile(
+    r"(?:"
+    r"[A-Z0-9]{4,}"  # All caps with numbers, at least 4 chars
+    r"|[A-Z]{2,}\d+"  # Letters followed by numbers
+    r"|[A-Z0-9]+OFF"  # Anything ending with OFF
+    r"|SAVE\d+"  # SAVE followed by numbers
+    r"|\d+OFF"  # Numbers followed by OFF
+    r"|[A-Z]+\d+[A-Z]+"  # Mix of letters and numbers
+    r")\Z"
+)
+
+# Tokens are runs of letters/digits; a hyphen or underscore inside a token
+# (SAVE-20, SPRING_30) is kept together so split codes still match
+TOKEN_RE = re.compile(r"[A-Za-z0-9]+(?:[-_][A-Za-z0-9]+)*")
+TOKEN_JOINERS_RE = re.compile(r"[-_]")
+HAS_DIGIT_RE = re.compile(r"\d")
+HAS_ALPHA_RE = re.compile(r"[A-Za-z]")
+
+# Keywords that often precede or follow promo codes
+PROMO_INDICATORS = frozenset([
+    "code",
+    "coupon",
+    "promo",
+    "use",
+    "enter",
+    "discount",
+    "save",
+    "off",
+    "extra",
+    "special",
+    "offer",
+])
+
+# Indicators that introduce a code ("use code X", "enter X") weigh more than
+# ones that merely sit next to it ("X for 20% off")
+STRONG_PROMO_INDICATORS = frozenset(["code", "coupon", "promo", "use", "enter"])
+
+PROMO_MIN_SCORE = 0.35
+MAX_DETECTED_CODES = 5
 
 
 def is_likely_promo_code(text):
-    # Common promo code patterns
-    patterns = [
-        r"^[A-Z0-9]{4,}$",  # All caps with numbers, at least 4 chars
-        r"^[A-Z]{2,}\d+$",  # Letters followed by numbers
-        r"^[A-Z0-9]+OFF$",  # Anything ending with OFF
-        r"^SAVE\d+$",  # SAVE followed by numbers
-        r"^\d+OFF$",  # Numbers followed by OFF
-        r"^[A-Z]+\d+[A-Z]+$",  # Mix of letters and numbers
-    ]
-
-    # Clean the text
-    text = text.strip().upper()
-
-    # Check if it matches any promo code pattern
-    return any(re.match(pattern, text) for pattern in patterns)
+    # Clean the text and check it against every promo code pattern at once
+    return PROMO_CODE_RE.match(TOKEN_JOINERS_RE.sub("", text.strip().upper())) is not None
+
+
+def _block_height(bbox):
+    ys = [point[1] for point in bbox]
+    return max(ys) - min(ys)
+
+
+def _score_token(token, context, prominence, confidence):
+    """
+    Rough likelihood that a token is a promo code: letters mixed with digits
+    count most, a neighbouring "code"/"use"/... adds context, and bigger,
+    confidently read text ranks above fine print.
+    """
+    has_digit = HAS_DIGIT_RE.search(token) is not None
+    has_alpha = HAS_ALPHA_RE.search(token) is not None
+    if has_digit and has_alpha:
+        score = 0.5
+    elif not has_alpha:
+        score = 0.05  # digits only: years, prices, phone numbers
+    elif token.isupper():
+        score = 0.1  # FREESHIP-style codes, but also SALE / TODAY
+    else:
+        score = 0.0  # ordinary lowercase words
+        context *= 0.5
+    score += context + 0.2 * prominence
+    return score * (0.5 + 0.5 * confidence)
+
+
+def _scan_words(tokens, prominence, confidence, found):
+    lowered = [token.lower() for token in tokens]
+    last = len(tokens) - 1
+    for i, token in enumerate(tokens):
+        if lowered[i] in PROMO_INDICATORS:
+            continue
+        # Joiners are ignored for matching only; the code is reported as written
+        code = token.upper()
+        bare = TOKEN_JOINERS_RE.sub("", code)
+        previous = lowered[i - 1] if i > 0 else ""
+        following = lowered[i + 1] if i < last else ""
+        if previous in STRONG_PROMO_INDICATORS:
+            context = 0.3
+        elif previous in PROMO_INDICATORS or following in PROMO_INDICATORS:
+            context = 0.15
+        else:
+            context = 0.0
+        # Most promo codes are at least 4 chars
+        if PROMO_CODE_RE.match(bare) is None and not (context and len(bare) >= 4):
+            continue
+        score = _score_token(token, context, prominence, confidence)
+        if score > found.get(code, 0.0):
+            found[code] = score
+
+
+def scan_promo_codes(image_blocks, body_text=""):
+    """
+    Single pass over OCR results and email body text.
+    image_blocks is a list with one list of (bbox, text, prob) blocks per
+    image. Returns [(code, score)] above PROMO_MIN_SCORE, best first.
+    """
+    found = {}
+    for blocks in image_blocks:
+        tallest = max((_block_height(bbox) for bbox, _, _ in blocks), default=0)
+        for bbox, text, prob in blocks:
+            prominence = _block_height(bbox) / tallest if tallest else 0.0
+            _scan_words(TOKEN_RE.findall(text), prominence, prob, found)
+    if body_text:
+        # Body text has no layout, so treat it as average prominence
+        _scan_words(TOKEN_RE.findall(body_text), 0.5, 1.0, found)
+    ranked = sorted(found.items(), key=lambda item: item[1], reverse=True)
+    return [(code, score) for code, score in ranked if score >= PROMO_MIN_SCORE]
 
 
 def extract_promo_codes(text_blocks):
-    promo_codes = []
-
-    # Keywords that often precede or follow promo codes
-    promo_indicators = [
-        "code",
-        "coupon",
-        "promo",
-        "use",
-        "enter",
-        "discount",
-        "save",
-        "off",
-        "extra",
-        "special",
-        "offer",
+    return [code for code, _ in scan_promo_codes([text_blocks])]
+
+
+def format_detected_codes(codes):
+    """The hint the Gemini prompt looks for, or an empty string."""
+    if not codes:
+        return ""
+    return "[DETECTED_PROMO_CODES: " + ", ".join(codes[:MAX_DETECTED_CODES]) + "]"
+
+
+def warm_reader_pool(size=None):
+    """
+    Build the process-wide reader pool if it doesn't exist yet.
+    Safe to call from several threads; only the first call loads models.
+    """
+    global _reader_pool
+    if _reader_pool is not None:
+        return _reader_pool
+    with _reader_pool_lock:
+        if _reader_pool is None:
+            # Imported here so the promo code scanner can be used without torch
+            import easyocr
+
+            pool = queue.Queue()
+            for _ in range(size or OCR_READER_POOL_SIZE):
+                start = time.perf_counter()
+                pool.put(easyocr.Reader(OCR_LANGUAGES))
+                elapsed = time.perf_counter() - start
+                with _stats_lock:
+                    _ocr_stats["model_loads"] += 1
+                    _ocr_stats["model_load_seconds"] += elapsed
+            _reader_pool = pool
+    return _reader_pool
+
+
+@contextmanager
+def borrow_reader():
+    """Check a reader out of the pool for the duration of one OCR call."""
+    pool = warm_reader_pool()
+    reader = pool.get()
+    try:
+        yield reader
+    finally:
+        pool.put(reader)
+
+
+def get_ocr_stats():
+    with _stats_lock:
+        stats = dict(_ocr_stats)
+    stats["avg_image_seconds"] = (
+        stats["ocr_seconds"] / stats["images"] if stats["images"] else 0.0
+    )
+    stats["idle_readers"] = _reader_pool.qsize() if _reader_pool is not None else 0
+    return stats
+
+
+def read_blocks(image):
+    """OCR an image into plain-Python (bbox, text, prob) blocks."""
+    # EasyOCR accepts a file path, encoded image bytes or a NumPy array
+    start = time.perf_counter()
+    with borrow_reader() as reader:
+        results = reader.readtext(image)
+    elapsed = time.perf_counter() - start
+    with _stats_lock:
+        _ocr_stats["images"] += 1
+        _ocr_stats["ocr_seconds"] += elapsed
+        _ocr_stats["last_image_seconds"] = elapsed
+    return [
+        ([[float(x), float(y)] for x, y in bbox], str(text), float(prob))
+        for bbox, text, prob in results
     ]
 
-    for bbox, text, prob in text_blocks:
-        # Split into words and check each
-        words = text.strip().split()
-
-        for i, word in enumerate(words):
-            # Clean the word
-            word = re.sub(r"[^\w\s-]", "", word).strip()
-
-            # Skip empty words
-            if not word:
-                continue
-
-            # Check if it's likely a promo code
-            if is_likely_promo_code(word):
-                promo_codes.append(word.upper())
-                continue
 
-            # Check surrounding context
-            if i > 0 and words[i - 1].lower() in promo_indicators:
-                if len(word) >= 4:  # Most promo codes are at least 4 chars
-                    promo_codes.append(word.upper())
-            elif i < len(words) - 1 and words[i + 1].lower() in promo_indicators:
-                if len(word) >= 4:
-                    promo_codes.append(word.upper())
+def summarize_blocks(blocks):
+    # Concatenate the words into a single string
+    full_text = " ".join([text for (bbox, text, prob) in blocks])
+    sentence = full_text.split(".")[0] + "."
+    logger.debug("OCR summary: %d words, %d chars", len(blocks), len(sentence))
 
-    return promo_codes
+    return sentence
 
 
-def classify_words(image_path):
-    reader = easyocr.Reader(["en"])
-    results = reader.readtext(image_path)
+def classify_words(image):
+    return summarize_blocks(read_blocks(image))
 
-    # Concatenate the words into a single string
-    full_text = " ".join([text for (bbox, text, prob) in results])
-    sentence = full_text.split(".")[0] + "."
-    print(f" {sentence}")
 
-    return sentence
+def ocr_image(image):
+    """OCR result kept for the pipeline: the summary text plus the raw blocks."""
+    blocks = read_blocks(image)
+    return {"text": summarize_blocks(blocks), "blocks": blocks}
@@ -0,0 +1,286 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# External inline images are fetched through one pooled session, several at a
+# time but only a few per host, with timeouts and a hard size cap. Responses
+# are cached on disk and revalidated with ETag / Last-Modified, so tracking
+# pixels and repeated banners aren't downloaded again.
+IMAGE_DOWNLOAD_WORKERS = int(os.getenv('IMAGE_DOWNLOAD_WORKERS', '8'))
+IMAGE_PER_HOST_LIMIT = int(os.getenv('IMAGE_PER_HOST_LIMIT', '4'))
+IMAGE_CONNECT_TIMEOUT = float(os.getenv('IMAGE_CONNECT_TIMEOUT', '3'))
+IMAGE_READ_TIMEOUT = float(os.getenv('IMAGE_READ_TIMEOUT', '10'))
+IMAGE_MAX_BYTES = int(os.getenv('IMAGE_MAX_BYTES', str(5 * 1024 * 1024)))
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', 'image_cache')
+# How long a cached image is used without revalidating when the server
+# doesn't send Cache-Control: max-age
+IMAGE_CACHE_FRESH_SECONDS = int(os.getenv('IMAGE_CACHE_FRESH_SECONDS', '3600'))
+# The disk cache is trimmed every so many stores: entries unused for
+# IMAGE_CACHE_MAX_AGE_DAYS go first, then the least recently used until
+# it fits in IMAGE_CACHE_MAX_BYTES
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(500 * 1024 * 1024)))
+IMAGE_CACHE_MAX_AGE_DAYS = float(os.getenv('IMAGE_CACHE_MAX_AGE_DAYS', '30'))
+EVICT_EVERY_STORES = 100
+CHUNK_SIZE = 64 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+_evict_lock = threading.Lock()
+_stores_since_evict = 0
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_download_stats = {
+    'requests': 0,
+    'fresh_hits': 0,
+    'not_modified': 0,
+    'downloaded': 0,
+    'bytes': 0,
+    'too_large': 0,
+    'errors': 0,
+    'cache_write_errors': 0,
+    'evictions': 0,
+}
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def _count(key, amount=1):
+    with _stats_lock:
+        _download_stats[key] += amount
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=IMAGE_DOWNLOAD_WORKERS, pool_maxsize=IMAGE_DOWNLOAD_WORKERS)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def get_executor():
+    """One download pool for the process, shared by every fetch."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=IMAGE_DOWNLOAD_WORKERS, thread_name_prefix='image-download')
+    return _executor
+
+
+def _host_limit(url):
+    host = urlparse(url).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(IMAGE_PER_HOST_LIMIT)
+        return _host_limits[host]
+
+
+def _cache_paths(url, cache_dir):
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.body'), os.path.join(cache_dir, key + '.json')
+
+
+def _load_cached(url, cache_dir):
+    body_path, meta_path = _cache_paths(url, cache_dir)
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        with open(body_path, 'rb') as f:
+            return meta, f.read()
+    except (OSError, ValueError):
+        return None, None
+
+
+def _touch_cached(url, cache_dir):
+    # An entry's newest mtime is when it was last used
+    try:
+        os.utime(_cache_paths(url, cache_dir)[1])
+    except OSError:
+        pass
+
+
+def _store_cached(url, cache_dir, meta, body):
+    """Best effort: a full disk or read-only cache dir just means no caching."""
+    global _stores_since_evict
+    body_path, meta_path = _cache_paths(url, cache_dir)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for path, mode, data in ((body_path, 'wb', body), (meta_path, 'w', meta)):
+            tmp_path = path + '.tmp'
+            with open(tmp_path, mode) as f:
+                if mode == 'w':
+                    json.dump(data, f)
+                else:
+                    f.write(data)
+            os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not cache image in %s: %s", cache_dir, e)
+        _count('cache_write_errors')
+        return
+    with _stats_lock:
+        _stores_since_evict += 1
+        evict = _stores_since_evict >= EVICT_EVERY_STORES
+        if evict:
+            _stores_since_evict = 0
+    if evict:
+        evict_cache(cache_dir)
+
+
+def evict_cache(cache_dir=None, now=None):
+    """
+    Removes cache entries unused for IMAGE_CACHE_MAX_AGE_DAYS, then the
+    least recently used ones until the cache fits in IMAGE_CACHE_MAX_BYTES.
+    Returns the number of entries removed.
+    """
+    cache_dir = cache_dir or IMAGE_CACHE_DIR
+    now = time.time() if now is None else now
+    if not _evict_lock.acquire(blocking=False):
+        return 0  # another thread is already trimming it
+    try:
+        entries = {}  # key -> [last used, bytes, paths]
+        try:
+            names = os.listdir(cache_dir)
+        except OSError:
+            return 0
+        for name in names:
+            path = os.path.join(cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entry = entries.setdefault(name.split('.', 1)[0], [0.0, 0, []])
+            entry[0] = max(entry[0], stat.st_mtime)
+            entry[1] += stat.st_size
+            entry[2].append(path)
+        cutoff = now - IMAGE_CACHE_MAX_AGE_DAYS * 24 * 3600
+        total = sum(entry[1] for entry in entries.values())
+        evicted = 0
+        for last_used, size, paths in sorted(entries.values(), key=lambda entry: entry[0]):
+            if last_used >= cutoff and total <= IMAGE_CACHE_MAX_BYTES:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+            evicted += 1
+    finally:
+        _evict_lock.release()
+    _count('evictions', evicted)
+    return evicted
+
+
+def _max_age(headers):
+    match = re.search(r'max-age=(\d+)', headers.get('Cache-Control', ''))
+    if match:
+        return int(match.group(1))
+    return IMAGE_CACHE_FRESH_SECONDS
+
+
+def _read_capped(response, max_bytes):
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise ImageTooLarge(f'{length} bytes')
+    chunks = []
+    total = 0
+    for chunk in response.iter_content(CHUNK_SIZE):
+        total += len(chunk)
+        if total > max_bytes:
+            raise ImageTooLarge(f'more than {max_bytes} bytes')
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def download_image(url, cache_dir=None, max_bytes=None):
+    """
+    Returns the image bytes for url, or None if it couldn't be fetched.
+    Serves from the disk cache while fresh and revalidates it otherwise.
+    """
+    cache_dir = cache_dir or IMAGE_CACHE_DIR
+    max_bytes = max_bytes or IMAGE_MAX_BYTES
+    meta, cached_body = _load_cached(url, cache_dir)
+    now = time.time()
+    if meta is not None and now < meta.get('fresh_until', 0):
+        _count('fresh_hits')
+        _touch_cached(url, cache_dir)
+        return cached_body
+
+    headers = {}
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        with _host_limit(url):
+            _count('requests')
+            with metrics.span('image_download'), get_session().get(
+                    url, headers=headers, stream=True,
+                    timeout=(IMAGE_CONNECT_TIMEOUT, IMAGE_READ_TIMEOUT)) as response:
+                if response.status_code == 304 and meta is not None:
+                    _count('not_modified')
+                    meta['fresh_until'] = now + _max_age(response.headers)
+                    _store_cached(url, cache_dir, meta, cached_body)
+                    return cached_body
+                if response.status_code != 200:
+                    logger.warning("Failed to download image from %s: HTTP %s", urlparse(url).netloc, response.status_code)
+                    _count('errors')
+                    return None
+                body = _read_capped(response, max_bytes)
+                response_headers = response.headers
+    except ImageTooLarge as e:
+        logger.info("Skipping image from %s: %s", urlparse(url).netloc, e)
+        _count('too_large')
+        return None
+    except requests.RequestException as e:
+        logger.warning("Failed to download inline image from %s. Error: %s", urlparse(url).netloc, e)
+        _count('errors')
+        return None
+
+    _count('downloaded')
+    _count('bytes', len(body))
+    meta = {
+        'etag': response_headers.get('ETag'),
+        'last_modified': response_headers.get('Last-Modified'),
+        'fresh_until': now + _max_age(response_headers),
+    }
+    if 'no-store' not in response_headers.get('Cache-Control', ''):
+        _store_cached(url, cache_dir, meta, body)
+    return body
+
+
+def download_images(urls, cache_dir=None):
+    """Download several images concurrently; returns bytes or None per url, in order."""
+    if not urls:
+        return []
+    return list(get_executor().map(lambda url: download_image(url, cache_dir), urls))
+
+
+def get_download_stats():
+    with _stats_lock:
+        return dict(_download_stats)
@@ -0,0 +1,135 @@
+import io
+import os
+import struct
+import threading
+
+import numpy as np
+from PIL import Image
+
+# Cheap checks that run before an image is sent to OCR. Tracking pixels and
+# spacers are rejected from the header alone; everything else is downscaled
+# to grayscale and scored by how much of it looks like text edges.
+TRIAGE_MIN_SIDE = int(os.getenv('TRIAGE_MIN_SIDE', '24'))
+TRIAGE_MIN_AREA = int(os.getenv('TRIAGE_MIN_AREA', str(64 * 64)))
+TRIAGE_MIN_EDGE_DENSITY = float(os.getenv('TRIAGE_MIN_EDGE_DENSITY', '0.03'))
+TRIAGE_SCORE_SIDE = 256
+EDGE_THRESHOLD = 40
+HISTOGRAM_BUCKET = 0.02
+HISTOGRAM_BUCKETS = 15
+
+_stats_lock = threading.Lock()
+_triage_stats = {
+    'checked': 0,
+    'passed': 0,
+    'skipped_tiny': 0,
+    'skipped_low_score': 0,
+    'skipped_undecodable': 0,
+    'score_histogram': [0] * HISTOGRAM_BUCKETS,
+}
+
+
+def read_dimensions(data):
+    """
+    Returns (width, height) from the PNG, GIF, JPEG, BMP or WebP header,
+    or None if the format isn't recognized.
+    """
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+        return struct.unpack('<HH', data[6:10])
+    if data[:2] == b'BM' and len(data) >= 26:
+        width, height = struct.unpack('<ii', data[18:26])
+        return width, abs(height)
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP' and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b'VP8X':
+            width = int.from_bytes(data[24:27], 'little') + 1
+            height = int.from_bytes(data[27:30], 'little') + 1
+            return width, height
+        if chunk == b'VP8 ':
+            width, height = struct.unpack('<HH', data[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b'VP8L' and len(data) >= 25:
+            bits = int.from_bytes(data[21:25], 'little')
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        return None
+    if data[:2] == b'\xff\xd8':
+        return _jpeg_dimensions(data)
+    return None
+
+
+def _jpeg_dimensions(data):
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+            i += 1 if marker == 0xFF else 2
+            continue
+        length = struct.unpack('>H', data[i + 2:i + 4])[0]
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height
+        i += 2 + length
+    return None
+
+
+def text_score(data):
+    """
+    Fraction of pixels on a strong horizontal or vertical intensity edge,
+    measured on a grayscale copy no larger than TRIAGE_SCORE_SIDE.
+    Text-heavy banners score high; photos and flat fills score low.
+    """
+    image = Image.open(io.BytesIO(data))
+    # JPEG can decode straight to a reduced size, which is most of the saving
+    image.draft('L', (TRIAGE_SCORE_SIDE, TRIAGE_SCORE_SIDE))
+    image = image.convert('L')
+    image.thumbnail((TRIAGE_SCORE_SIDE, TRIAGE_SCORE_SIDE))
+    pixels = np.asarray(image, dtype=np.int16)
+    if pixels.shape[0] < 2 or pixels.shape[1] < 2:
+        return 0.0
+    dx = np.abs(np.diff(pixels, axis=1)) > EDGE_THRESHOLD
+    dy = np.abs(np.diff(pixels, axis=0)) > EDGE_THRESHOLD
+    edges = dx[:-1, :] | dy[:, :-1]
+    return float(edges.mean())
+
+
+def _record(outcome, score=None):
+    with _stats_lock:
+        _triage_stats['checked'] += 1
+        _triage_stats[outcome] += 1
+        if score is not None:
+            bucket = min(int(score / HISTOGRAM_BUCKET), HISTOGRAM_BUCKETS - 1)
+            _triage_stats['score_histogram'][bucket] += 1
+
+
+def should_ocr(data):
+    """Returns (True, score) if the image likely has text, else (False, reason)."""
+    dimensions = read_dimensions(data)
+    if dimensions is not None:
+        width, height = dimensions
+        if min(width, height) < TRIAGE_MIN_SIDE or width * height < TRIAGE_MIN_AREA:
+            _record('skipped_tiny')
+            return False, f'{width}x{height} is too small to hold text'
+    try:
+        score = text_score(data)
+    except Exception as e:
+        _record('skipped_undecodable')
+        return False, f'could not decode image ({str(e)})'
+    if score < TRIAGE_MIN_EDGE_DENSITY:
+        _record('skipped_low_score', score)
+        return False, f'text score {score:.3f} below {TRIAGE_MIN_EDGE_DENSITY}'
+    _record('passed', score)
+    return True, score
+
+
+def get_triage_stats():
+    with _stats_lock:
+        stats = dict(_triage_stats)
+        stats['score_histogram'] = list(_triage_stats['score_histogram'])
+    stats['pass_rate'] = stats['passed'] / stats['checked'] if stats['checked'] else 0.0
+    stats['score_bucket_width'] = HISTOGRAM_BUCKET
+    return stats
@@ -0,0 +1,301 @@
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Syncs many mailboxes from one process. Every account waits in one of two
+# queues: pushes (the webhook said it has new mail) are served before
+# staleness polls (nothing synced for STALE_AFTER_SECONDS), each oldest
+# first. Gmail quota is budgeted with token buckets, one per account and
+# one for the whole project: a sync reserves the units its account used
+# last time and settles up when it finishes, so a mailbox that burns its
+# budget waits for it to refill while the others carry on. An account is
+# synced by at most one worker at a time.
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', '4'))
+# Gmail allows 250 units per user per second and 1,200,000 per project per
+# minute; the defaults keep well under both
+ACCOUNT_QUOTA_UNITS_PER_SECOND = float(os.getenv('ACCOUNT_QUOTA_UNITS_PER_SECOND', '10'))
+ACCOUNT_QUOTA_BURST = float(os.getenv('ACCOUNT_QUOTA_BURST', '1000'))
+GLOBAL_QUOTA_UNITS_PER_SECOND = float(os.getenv('GLOBAL_QUOTA_UNITS_PER_SECOND', '10000'))
+GLOBAL_QUOTA_BURST = float(os.getenv('GLOBAL_QUOTA_BURST', '20000'))
+# Poll a mailbox that hasn't been synced for this long, in case a push was lost
+STALE_AFTER_SECONDS = float(os.getenv('STALE_AFTER_SECONDS', '900'))
+# A failed sync is retried this soon, as a staleness poll
+RETRY_AFTER_SECONDS = float(os.getenv('SYNC_RETRY_AFTER_SECONDS', '60'))
+# Units reserved for an account's first sync; later ones use a moving average
+DEFAULT_SYNC_COST = 50
+MIN_SYNC_COST = 5
+COST_SMOOTHING = 0.3
+
+PUSH = 0
+STALE = 1
+
+
+class TokenBucket:
+    """Quota units refilling at rate per second, up to capacity. Charges may overdraw it."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount units are available; a cost above capacity waits for a full bucket."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def charge(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+
+class _Account:
+    def __init__(self, name, bucket):
+        self.name = name
+        self.bucket = bucket
+        self.estimate = DEFAULT_SYNC_COST
+        self.entry = None  # (queue, seq) of the entry that stands for this account
+        self.requested_at = None  # when the push being waited on arrived
+        self.running = False
+        self.dirty = False  # pushed while syncing, so sync again afterwards
+        self.syncs = 0
+        self.failures = 0
+        self.units = 0
+
+
+class MailboxScheduler:
+    """
+    Runs sync_fn(account) on worker threads. sync_fn returns the Gmail
+    quota units the sync used (or None if it didn't count them).
+    """
+
+    def __init__(self, sync_fn, workers=SCHEDULER_WORKERS,
+                 account_rate=ACCOUNT_QUOTA_UNITS_PER_SECOND, account_burst=ACCOUNT_QUOTA_BURST,
+                 global_rate=GLOBAL_QUOTA_UNITS_PER_SECOND, global_burst=GLOBAL_QUOTA_BURST,
+                 stale_after=STALE_AFTER_SECONDS, clock=time.monotonic, dedupe_size=10000):
+        self.sync_fn = sync_fn
+        self.workers = workers
+        self.account_rate = account_rate
+        self.account_burst = account_burst
+        self.stale_after = stale_after
+        self.clock = clock
+        self.dedupe_size = dedupe_size
+        self._global = TokenBucket(global_rate, global_burst, clock)
+        self._cond = threading.Condition()
+        self._accounts = {}
+        self._queues = {PUSH: [], STALE: []}  # heaps of (due, seq, account)
+        self._seq = itertools.count()
+        self._seen_ids = OrderedDict()
+        self._threads = []
+        self._stopping = False
+        self._stats = {
+            "pushes": 0,
+            "duplicates": 0,
+            "coalesced": 0,
+            "syncs": 0,
+            "stale_syncs": 0,
+            "failures": 0,
+            "quota_deferrals": 0,
+            "units": 0,
+            "lag_seconds_total": 0.0,
+            "lag_seconds_max": 0.0,
+            "push_syncs": 0,
+        }
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"sync-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """Stops the workers once their current syncs finish."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join()
+
+    def add_account(self, account, first_sync_in=None):
+        """
+        Registers account. Its first staleness poll is spread over
+        stale_after unless first_sync_in (seconds) is given, so thousands
+        of accounts added at startup don't all sync at once.
+        """
+        with self._cond:
+            self._add(account, first_sync_in)
+
+    def _add(self, account, first_sync_in=None):
+        state = self._accounts.get(account)
+        if state is None:
+            state = self._accounts[account] = _Account(
+                account, TokenBucket(self.account_rate, self.account_burst, self.clock))
+            if first_sync_in is None:
+                first_sync_in = random.uniform(0, self.stale_after)
+            self._enqueue(state, STALE, self.clock() + first_sync_in)
+        return state
+
+    def _enqueue(self, state, queue, due):
+        seq = next(self._seq)
+        state.entry = (queue, seq)  # any older entry for the account is now skipped
+        heapq.heappush(self._queues[queue], (due, seq, state.name))
+        self._cond.notify()
+
+    def push(self, account, pubsub_message_id=None):
+        """Asks for a sync of account after a webhook push. Returns 'queued', 'coalesced' or 'duplicate'."""
+        with self._cond:
+            self._stats["pushes"] += 1
+            if pubsub_message_id is not None:
+                if pubsub_message_id in self._seen_ids:
+                    self._stats["duplicates"] += 1
+                    return "duplicate"
+                self._seen_ids[pubsub_message_id] = True
+                if len(self._seen_ids) > self.dedupe_size:
+                    self._seen_ids.popitem(last=False)
+            state = self._add(account, first_sync_in=self.stale_after)
+            if state.running:
+                # The running sync may have started before this history existed
+                state.dirty = True
+                self._stats["coalesced"] += 1
+                return "coalesced"
+            if state.entry is not None and state.entry[0] == PUSH:
+                self._stats["coalesced"] += 1
+                return "coalesced"
+            state.requested_at = self.clock()
+            self._enqueue(state, PUSH, state.requested_at)
+            return "queued"
+
+    def _pop_ready(self, now):
+        """The next due account with budget for its sync, or None."""
+        if self._global.wait_time(MIN_SYNC_COST) > 0:
+            return None
+        for queue in (PUSH, STALE):
+            heap = self._queues[queue]
+            while heap and heap[0][0] <= now:
+                _, seq, name = heapq.heappop(heap)
+                state = self._accounts[name]
+                if state.entry != (queue, seq):
+                    continue
+                wait = max(state.bucket.wait_time(state.estimate), self._global.wait_time(state.estimate))
+                if wait > 0:
+                    # Over budget: come back once it has refilled, behind whoever is due before then
+                    self._stats["quota_deferrals"] += 1
+                    self._enqueue(state, queue, now + wait)
+                    continue
+                state.entry = None
+                return state
+        return None
+
+    def _idle_timeout(self, now):
+        dues = [heap[0][0] for heap in self._queues.values() if heap]
+        if not dues:
+            return None
+        return max(0.001, min(dues) - now, self._global.wait_time(MIN_SYNC_COST))
+
+    def _take(self):
+        """Blocks until an account is due and within budget, and reserves its sync."""
+        with self._cond:
+            while not self._stopping:
+                now = self.clock()
+                state = self._pop_ready(now)
+                if state is None:
+                    self._cond.wait(self._idle_timeout(now))
+                    continue
+                state.running = True
+                state.bucket.charge(state.estimate)
+                self._global.charge(state.estimate)
+                if state.requested_at is not None:
+                    lag = now - state.requested_at
+                    state.requested_at = None
+                    self._stats["push_syncs"] += 1
+                    self._stats["lag_seconds_total"] += lag
+                    self._stats["lag_seconds_max"] = max(self._stats["lag_seconds_max"], lag)
+                else:
+                    self._stats["stale_syncs"] += 1
+                return state
+            return None
+
+    def _finish(self, state, units, failed):
+        with self._cond:
+            now = self.clock()
+            state.running = False
+            state.syncs += 1
+            self._stats["syncs"] += 1
+            if units is not None:
+                # Settle the reservation against what the sync really used
+                state.bucket.charge(units - state.estimate)
+                self._global.charge(units - state.estimate)
+                state.estimate = max(MIN_SYNC_COST, (1 - COST_SMOOTHING) * state.estimate + COST_SMOOTHING * units)
+                state.units += units
+                self._stats["units"] += units
+            if failed:
+                state.failures += 1
+                self._stats["failures"] += 1
+            if state.dirty:
+                state.dirty = False
+                state.requested_at = now
+                self._enqueue(state, PUSH, now)
+            else:
+                self._enqueue(state, STALE, now + (RETRY_AFTER_SECONDS if failed else self.stale_after))
+            self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            state = self._take()
+            if state is None:
+                return
+            units = None
+            failed = False
+            try:
+                units = self.sync_fn(state.name)
+            except Exception:
+                logger.exception("Error syncing mailbox %s", state.name)
+                failed = True
+            self._finish(state, units, failed)
+
+    def wait_idle(self, timeout=None):
+        """Blocks until no push is waiting and no sync is running. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while any(state.running or (state.entry is not None and state.entry[0] == PUSH)
+                      for state in self._accounts.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            accounts = list(self._accounts.values())
+            stats["accounts"] = len(accounts)
+            stats["running"] = sum(state.running for state in accounts)
+            stats["queued_pushes"] = sum(state.entry is not None and state.entry[0] == PUSH for state in accounts)
+            stats["global_quota_units"] = self._global.tokens
+            stats["busiest_accounts"] = [
+                {"account": state.name, "units": state.units, "syncs": state.syncs, "failures": state.failures}
+                for state in heapq.nlargest(5, accounts, key=lambda state: state.units)
+            ]
+        push_syncs = stats["push_syncs"]
+        stats["avg_lag_seconds"] = stats["lag_seconds_total"] / push_syncs if push_syncs else 0.0
+        return stats
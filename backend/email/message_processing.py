@@ -1,23 +1,30 @@
+import logging
 import os
 import re
 import json
-import google.generativeai as genai
+import hashlib
+import threading
 from dotenv import load_dotenv
+import extraction_cache
+import metrics
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+MODEL_NAME = "gemini-1.5-flash"
 
+_model = None
+_model_lock = threading.Lock()
 
-def process_message(message_text):
-    try:
-        # Clean and prepare the message text
-        cleaned_text = re.sub(r"\s+", " ", message_text).strip()
+# Model calls in flight at once across every fetch in the process, so many
+# mailboxes syncing together share one pool of requests to the API
+LLM_MAX_CONCURRENT_CALLS = int(os.getenv("LLM_MAX_CONCURRENT_CALLS", "4"))
+_call_slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENT_CALLS)
 
-        # Prompt for Gemini
-        prompt = f"""You are a promotion extraction assistant. Your task is to carefully analyze the email content and extract specific promotional details into a structured format.
+# Shared by the single-email and batched prompts
+EXTRACTION_INSTRUCTIONS = """You are a promotion extraction assistant. Your task is to carefully analyze the email content and extract specific promotional details into a structured format.
 
         Follow these detailed instructions:
         1. Company Identification:
@@ -90,21 +97,9 @@ def process_message(message_text):
            - "Shop now: https://nike.com/sale" -> Link to Promo: "https://nike.com/sale"
            - "Visit bit.ly/sale24" -> Link to Promo: "bit.ly/sale24"
 
-        Return the information in this exact JSON format:
-        {{
-            "Company": "company name",
-            "Category": "category",
-            "Promo message": "promotion details",
-            "Promo code": "code or empty string",
-            "Bar code": "barcode or empty string",
-            "Expiration Date": "YYYY-MM-DD",
-            "Link to Promo": "URL or empty string"
-        }}
-
-        Email text:
-        {cleaned_text}
+"""
 
-        Important Guidelines:
+EXTRACTION_GUIDELINES = """        Important Guidelines:
         1. Be thorough - scan the entire email including headers and footers
         2. Handle edge cases:
            - Multiple promotions? Choose the most valuable one
@@ -121,41 +116,255 @@ def process_message(message_text):
            - Double-check detected promo codes from images
         """
 
+# Prompt for Gemini
+PROMPT_TEMPLATE = EXTRACTION_INSTRUCTIONS + """        Return the information in this exact JSON format:
+        {{
+            "Company": "company name",
+            "Category": "category",
+            "Promo message": "promotion details",
+            "Promo code": "code or empty string",
+            "Bar code": "barcode or empty string",
+            "Expiration Date": "YYYY-MM-DD",
+            "Link to Promo": "URL or empty string"
+        }}
+
+        Email text:
+        {cleaned_text}
+
+""" + EXTRACTION_GUIDELINES
+
+BATCH_PROMPT_HEADER = EXTRACTION_INSTRUCTIONS + """        You will be given several emails, each starting with a line like "=== EMAIL 3 ===".
+        Extract one promotion per email and return a JSON array with exactly one object per email, in the same order, in this exact format:
+        [
+            {
+                "Email": 3,
+                "Company": "company name",
+                "Category": "category",
+                "Promo message": "promotion details",
+                "Promo code": "code or empty string",
+                "Bar code": "barcode or empty string",
+                "Expiration Date": "YYYY-MM-DD",
+                "Link to Promo": "URL or empty string"
+            }
+        ]
+        Treat every email on its own: never copy details from one email into another.
+
+""" + EXTRACTION_GUIDELINES
+
+REQUIRED_FIELDS = [
+    "Company",
+    "Category",
+    "Promo message",
+    "Promo code",
+    "Bar code",
+    "Expiration Date",
+    "Link to Promo",
+]
+
+# Batched extraction limits: a rough input token budget per request
+# (~4 characters per token) and a cap on emails packed into one request.
+LLM_BATCH_TOKEN_BUDGET = int(os.getenv("LLM_BATCH_TOKEN_BUDGET", "12000"))
+LLM_BATCH_MAX_EMAILS = int(os.getenv("LLM_BATCH_MAX_EMAILS", "10"))
+
+# Cached extractions made with a different prompt or model are stale
+PROMPT_VERSION = hashlib.sha256(
+    (MODEL_NAME + PROMPT_TEMPLATE + BATCH_PROMPT_HEADER).encode("utf-8")
+).hexdigest()[:16]
+
+
+def get_model():
+    """
+    The Gemini model, configured on first use. Importing generativeai takes
+    a quarter of a second, so processes that never call the model skip it.
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                import google.generativeai as genai
+
+                # Configure Gemini API
+                genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+                _model = genai.GenerativeModel(MODEL_NAME)
+    return _model
+
+
+def generate(model, prompt, emails=1):
+    """One model call, waiting for a free slot when LLM_MAX_CONCURRENT_CALLS are in flight."""
+    with _call_slots, metrics.span("llm_call", emails=emails):
+        return model.generate_content(prompt)
+
+
+def clean_text(message_text):
+    return re.sub(r"\s+", " ", message_text).strip()
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def strip_json_fences(text):
+    json_str = text.strip()
+    if json_str.startswith("```json"):
+        json_str = json_str[7:-3]  # Remove ```json and ``` markers
+    elif json_str.startswith("```"):
+        json_str = json_str[3:-3]
+    return json_str.strip()
+
+
+def fill_required_fields(result):
+    for field in REQUIRED_FIELDS:
+        if field not in result:
+            result[field] = ""
+    return result
+
+
+def process_message(message_text, message_id=None, model=None):
+    try:
+        # Clean and prepare the message text
+        cleaned_text = clean_text(message_text)
+
+        # Skip the model entirely if this exact message was extracted before
+        if message_id is not None:
+            cached = extraction_cache.get(message_id, cleaned_text, PROMPT_VERSION)
+            if cached is not None:
+                return cached
+
+        # Fill the email text into the prompt
+        prompt = PROMPT_TEMPLATE.format(cleaned_text=cleaned_text)
+
         # Generate response using Gemini
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        response = model.generate_content(prompt)
+        if model is None:
+            model = get_model()
+        response = generate(model, prompt)
 
         # Parse the response
         try:
-            # Extract JSON from the response
-            json_str = response.text.strip()
-            if json_str.startswith("```json"):
-                json_str = json_str[7:-3]  # Remove ```json and ``` markers
-            elif json_str.startswith("{"):
-                json_str = json_str  # Already clean JSON
-
-            result = json.loads(json_str)
+            with metrics.span("json_parse"):
+                result = json.loads(strip_json_fences(response.text))
 
             # Validate required fields
-            required_fields = [
-                "Company",
-                "Category",
-                "Promo message",
-                "Promo code",
-                "Bar code",
-                "Expiration Date",
-                "Link to Promo",
-            ]
-            for field in required_fields:
-                if field not in result:
-                    result[field] = ""
+            fill_required_fields(result)
+
+            if message_id is not None:
+                extraction_cache.put(message_id, cleaned_text, PROMPT_VERSION, result)
 
             return result
 
         except json.JSONDecodeError as e:
-            print(f"Error parsing JSON: {e}")
+            logger.warning("Error parsing JSON: %s", e)
             return None
 
     except Exception as e:
-        print(f"Error processing message: {e}")
+        logger.error("Error processing message: %s", e)
         return None
+
+
+def pack_batches(cleaned_texts, token_budget=None, max_emails=None):
+    """
+    Greedily groups email indexes so that each batch's prompt stays within
+    the token budget. An email too large to share a request gets its own batch.
+    """
+    token_budget = token_budget or LLM_BATCH_TOKEN_BUDGET
+    max_emails = max_emails or LLM_BATCH_MAX_EMAILS
+    header_tokens = estimate_tokens(BATCH_PROMPT_HEADER)
+    batches = []
+    current = []
+    used = header_tokens
+    for index, text in enumerate(cleaned_texts):
+        cost = estimate_tokens(text) + 10  # room for the email separator line
+        if current and (used + cost > token_budget or len(current) >= max_emails):
+            batches.append(current)
+            current = []
+            used = header_tokens
+        current.append(index)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def build_batch_prompt(numbered_texts):
+    sections = [f"=== EMAIL {number} ===\n{text}" for number, text in numbered_texts]
+    return BATCH_PROMPT_HEADER + "\n        Emails:\n" + "\n\n".join(sections)
+
+
+def parse_batch_response(response_text, expected_numbers):
+    """
+    Parses the model's JSON array into {email number: promotion dict}.
+    Entries that are missing or malformed are simply absent from the result.
+    """
+    try:
+        with metrics.span("json_parse"):
+            entries = json.loads(strip_json_fences(response_text))
+    except json.JSONDecodeError as e:
+        logger.warning("Error parsing batch JSON: %s", e)
+        return {}
+    if not isinstance(entries, list):
+        return {}
+    results = {}
+    for position, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            continue
+        number = entry.pop("Email", None)
+        # Fall back to array position when the model drops the email number
+        if number not in expected_numbers:
+            number = expected_numbers[position] if position < len(expected_numbers) else None
+        if number is None or number in results:
+            continue
+        results[number] = fill_required_fields(entry)
+    return results
+
+
+def process_messages_batch(messages, token_budget=None, model=None):
+    """
+    Extracts promotions for several emails with as few model calls as possible.
+    messages is a list of (message_id, message_text); returns one promotion
+    dict (or None) per message, in order. Emails the batch response doesn't
+    cover are retried one at a time with process_message.
+    """
+    cleaned = [clean_text(text) for _, text in messages]
+    results = [None] * len(messages)
+
+    pending = []
+    for index, (message_id, _) in enumerate(messages):
+        if message_id is not None:
+            cached = extraction_cache.get(message_id, cleaned[index], PROMPT_VERSION)
+            if cached is not None:
+                results[index] = cached
+                continue
+        pending.append(index)
+
+    if pending and model is None:
+        model = get_model()
+
+    for batch in pack_batches([cleaned[index] for index in pending], token_budget):
+        indexes = [pending[position] for position in batch]
+        if len(indexes) == 1:
+            continue  # a lone email goes through the single-email prompt below
+        numbers = list(range(1, len(indexes) + 1))
+        prompt = build_batch_prompt(zip(numbers, [cleaned[index] for index in indexes]))
+        try:
+            response = generate(model, prompt, emails=len(indexes))
+            parsed = parse_batch_response(response.text, numbers)
+        except Exception as e:
+            logger.error("Error processing message batch: %s", e)
+            parsed = {}
+        for number, index in zip(numbers, indexes):
+            result = parsed.get(number)
+            if result is None:
+                continue
+            results[index] = result
+            message_id = messages[index][0]
+            if message_id is not None:
+                extraction_cache.put(message_id, cleaned[index], PROMPT_VERSION, result)
+
+    # Per-item fallback for anything the batch didn't produce
+    for index in pending:
+        if results[index] is None:
+            # The cache was already checked above, so don't look it up again
+            results[index] = process_message(messages[index][1], model=model)
+            message_id = messages[index][0]
+            if results[index] is not None and message_id is not None:
+                extraction_cache.put(message_id, cleaned[index], PROMPT_VERSION, results[index])
+    return results
@@ -0,0 +1,62 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Timing spans around each stage of a fetch (Gmail calls, decoding, image
+# downloads, OCR, HTML parsing, model calls, JSON parsing), kept as
+# histograms and served on /metrics in the Prometheus text format.
+METRIC_NAME = "coupn_stage_seconds"
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_histograms = {}  # stage -> [per-bucket counts..., +Inf count], sum
+
+
+def observe(stage, seconds):
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = [[0] * (len(BUCKETS) + 1), 0.0]
+        histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+
+
+@contextmanager
+def span(stage, **fields):
+    """Times the block and records it under stage; extra fields go to the debug log."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        observe(stage, seconds)
+        if logger.isEnabledFor(logging.DEBUG):
+            details = "".join(f" {key}={value}" for key, value in fields.items())
+            logger.debug("span stage=%s seconds=%.4f%s", stage, seconds, details)
+
+
+def _format_bound(bound):
+    return "+Inf" if bound is None else repr(float(bound))
+
+
+def render():
+    """All stage histograms in the Prometheus text exposition format."""
+    with _lock:
+        snapshot = {stage: (list(counts), total) for stage, (counts, total) in _histograms.items()}
+    lines = [
+        f"# HELP {METRIC_NAME} Time spent in each stage of fetching and extracting promotions.",
+        f"# TYPE {METRIC_NAME} histogram",
+    ]
+    for stage in sorted(snapshot):
+        counts, total = snapshot[stage]
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (None,), counts):
+            cumulative += count
+            lines.append(f'{METRIC_NAME}_bucket{{stage="{stage}",le="{_format_bound(bound)}"}} {cumulative}')
+        lines.append(f'{METRIC_NAME}_sum{{stage="{stage}"}} {total}')
+        lines.append(f'{METRIC_NAME}_count{{stage="{stage}"}} {cumulative}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,92 @@
+import base64
+import codecs
+import re
+
+import metrics
+
+CHARSET_RE = re.compile(r'charset\s*=\s*"?([\w.:-]+)"?', re.IGNORECASE)
+
+
+def decode_base64url(data):
+    # Gmail sometimes drops the padding
+    with metrics.span('base64_decode'):
+        return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class MimePart:
+    """
+    One leaf of a Gmail message payload. The body is only base64-decoded
+    the first time it is read.
+    """
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.mime_type = (payload.get('mimeType') or '').lower()
+        self.filename = payload.get('filename') or ''
+        self.headers = {h['name'].lower(): h['value'] for h in payload.get('headers', [])}
+        self.body = payload.get('body', {})
+        self._data = None
+
+    @property
+    def attachment_id(self):
+        return self.body.get('attachmentId')
+
+    @property
+    def has_data(self):
+        return 'data' in self.body
+
+    @property
+    def charset(self):
+        match = CHARSET_RE.search(self.headers.get('content-type', ''))
+        if match:
+            try:
+                return codecs.lookup(match.group(1)).name
+            except LookupError:
+                pass
+        return 'utf-8'
+
+    @property
+    def data(self):
+        """Decoded body bytes, or b'' if the body lives in a separate attachment."""
+        if self._data is None:
+            self._data = decode_base64url(self.body['data']) if self.has_data else b''
+        return self._data
+
+    def text(self):
+        return self.data.decode(self.charset, errors='replace')
+
+
+class MessageParts:
+    """
+    Walks a Gmail message payload once, however deeply the multiparts are
+    nested, and indexes the leaf parts by MIME type.
+    """
+
+    def __init__(self, msg):
+        self.parts = []
+        self.by_type = {}
+        self._walk(msg.get('payload', {}))
+
+    def _walk(self, payload):
+        children = payload.get('parts')
+        if children:
+            for child in children:
+                self._walk(child)
+            return
+        part = MimePart(payload)
+        self.parts.append(part)
+        self.by_type.setdefault(part.mime_type, []).append(part)
+
+    def first(self, mime_type):
+        """The first body part of this type that isn't an attachment."""
+        for part in self.by_type.get(mime_type, []):
+            if not part.filename and part.has_data:
+                return part
+        return None
+
+    def text(self, mime_type):
+        part = self.first(mime_type)
+        return part.text() if part is not None else ''
+
+    def attachments(self, mime_prefix=''):
+        return [part for part in self.parts if part.filename and part.mime_type.startswith(mime_prefix)]
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Retailers resend the same banners and logos constantly, so OCR results are
+# cached by a hash of the decoded image bytes: a small in-memory LRU in front
+# of a SQLite store that survives restarts.
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH", "ocr_cache.sqlite3")
+OCR_CACHE_MEMORY_ENTRIES = int(os.getenv("OCR_CACHE_MEMORY_ENTRIES", "1024"))
+OCR_CACHE_MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "50000"))
+OCR_CACHE_MAX_AGE_DAYS = float(os.getenv("OCR_CACHE_MAX_AGE_DAYS", "30"))
+EVICT_EVERY_PUTS = 100
+
+_lock = threading.Lock()
+_conn = None
+_memory = OrderedDict()
+_puts_since_evict = 0
+_cache_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "puts": 0, "evictions": 0}
+
+
+def image_digest(image_data):
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(OCR_CACHE_PATH, check_same_thread=False)
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_cache ("
+            " digest TEXT PRIMARY KEY,"
+            " text TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        _conn.execute("CREATE INDEX IF NOT EXISTS ocr_cache_last_used ON ocr_cache (last_used)")
+        _conn.commit()
+    return _conn
+
+
+def _max_age_seconds():
+    return OCR_CACHE_MAX_AGE_DAYS * 24 * 3600
+
+
+def _decode(value):
+    # Older rows hold just the summary text
+    try:
+        result = json.loads(value)
+    except ValueError:
+        result = None
+    if not isinstance(result, dict):
+        result = {"text": value, "blocks": []}
+    return result
+
+
+def _remember(digest, result, created_at):
+    _memory[digest] = (result, created_at)
+    _memory.move_to_end(digest)
+    while len(_memory) > OCR_CACHE_MEMORY_ENTRIES:
+        _memory.popitem(last=False)
+
+
+def get(digest):
+    """Return the cached OCR result for an image digest, or None on a miss."""
+    now = time.time()
+    with _lock:
+        entry = _memory.get(digest)
+        if entry is not None and now - entry[1] <= _max_age_seconds():
+            _memory.move_to_end(digest)
+            _cache_stats["memory_hits"] += 1
+            return entry[0]
+        _memory.pop(digest, None)
+
+        conn = _get_conn()
+        row = conn.execute(
+            "SELECT text, created_at FROM ocr_cache WHERE digest = ?", (digest,)
+        ).fetchone()
+        if row is None or now - row[1] > _max_age_seconds():
+            _cache_stats["misses"] += 1
+            return None
+        conn.execute("UPDATE ocr_cache SET last_used = ? WHERE digest = ?", (now, digest))
+        conn.commit()
+        result = _decode(row[0])
+        _remember(digest, result, row[1])
+        _cache_stats["disk_hits"] += 1
+        return result
+
+
+def put(digest, result):
+    global _puts_since_evict
+    now = time.time()
+    with _lock:
+        conn = _get_conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO ocr_cache (digest, text, created_at, last_used) VALUES (?, ?, ?, ?)",
+            (digest, json.dumps(result), now, now),
+        )
+        conn.commit()
+        _remember(digest, result, now)
+        _cache_stats["puts"] += 1
+        _puts_since_evict += 1
+        if _puts_since_evict >= EVICT_EVERY_PUTS:
+            _puts_since_evict = 0
+            _evict(conn, now)
+
+
+def _evict(conn, now):
+    """Drop entries older than the max age, then the least recently used past the size cap."""
+    cur = conn.execute("DELETE FROM ocr_cache WHERE created_at < ?", (now - _max_age_seconds(),))
+    evicted = cur.rowcount
+    cur = conn.execute(
+        "DELETE FROM ocr_cache WHERE digest IN ("
+        " SELECT digest FROM ocr_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+        (OCR_CACHE_MAX_ENTRIES,),
+    )
+    evicted += cur.rowcount
+    conn.commit()
+    _cache_stats["evictions"] += evicted
+
+
+def get_cache_stats():
+    with _lock:
+        stats = dict(_cache_stats)
+        stats["memory_entries"] = len(_memory)
+    lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+    stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+    return stats
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# OCR is CPU-bound and every image is independent, so images from a whole
+# fetch are recognized in batches on a process pool (one worker per core).
+OCR_WORKERS = max(1, int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1))))
+OCR_BATCH_SIZE = max(1, int(os.getenv("OCR_BATCH_SIZE", "4")))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_engine_stats = {
+    "runs": 0,
+    "batches": 0,
+    "images": 0,
+    "seconds": 0.0,
+    # Time spent on each image inside the workers, as the batches report it
+    "image_seconds": 0.0,
+    "last_image_seconds": 0.0,
+}
+# Latest imageOCR counters (model loads, idle readers) from each worker, by pid
+_worker_stats = {}
+
+
+def _init_worker():
+    # Several workers share the machine, so keep torch from spawning a full
+    # set of intra-op threads in each one.
+    try:
+        import torch
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+    if os.getenv("OCR_WARM_ON_STARTUP", "1") == "1":
+        from imageOCR import warm_reader_pool
+        warm_reader_pool()
+
+
+def _noop(_):
+    return os.getpid()
+
+
+def _ocr_batch(images):
+    """
+    Runs inside a worker process; each worker keeps its own warm readers.
+    The worker's stats live in its own memory, so the batch carries them
+    back: the seconds spent on each image and the worker's reader counters.
+    """
+    from imageOCR import get_ocr_stats, ocr_image
+
+    results = []
+    timings = []
+    for image in images:
+        start = time.perf_counter()
+        try:
+            results.append(ocr_image(image))
+        except Exception as e:
+            logger.warning("OCR failed for an image. Error: %s", e)
+            # Marked so the failure isn't cached as an image without text
+            results.append({"text": "", "blocks": [], "error": True})
+        timings.append(time.perf_counter() - start)
+    return {"results": results, "timings": timings, "pid": os.getpid(), "reader": get_ocr_stats()}
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ProcessPoolExecutor(max_workers=OCR_WORKERS, initializer=_init_worker)
+    return _executor
+
+
+def ocr_images(images):
+    """
+    OCR a list of images (encoded bytes, arrays or file paths) on the
+    process pool. Returns one {"text", "blocks"} result per input image,
+    in the same order; an image that failed also has "error": True.
+    """
+    if not images:
+        return []
+    start = time.perf_counter()
+    batches = _split(images)
+    reports = list(get_executor().map(_ocr_batch, batches))
+    _record_run(reports, len(images), time.perf_counter() - start)
+    return [result for report in reports for result in report["results"]]
+
+
+async def ocr_images_async(images):
+    """ocr_images for the async pipeline: awaits the process pool instead of blocking."""
+    if not images:
+        return []
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    batches = _split(images)
+    reports = await asyncio.gather(
+        *(loop.run_in_executor(get_executor(), _ocr_batch, batch) for batch in batches))
+    _record_run(reports, len(images), time.perf_counter() - start)
+    return [result for report in reports for result in report["results"]]
+
+
+def _split(images):
+    return [images[i:i + OCR_BATCH_SIZE] for i in range(0, len(images), OCR_BATCH_SIZE)]
+
+
+def _record_run(reports, images, elapsed):
+    metrics.observe("ocr", elapsed)
+    with _stats_lock:
+        _engine_stats["runs"] += 1
+        _engine_stats["batches"] += len(reports)
+        _engine_stats["images"] += images
+        _engine_stats["seconds"] += elapsed
+        for report in reports:
+            _engine_stats["image_seconds"] += sum(report["timings"])
+            if report["timings"]:
+                _engine_stats["last_image_seconds"] = report["timings"][-1]
+            _worker_stats[report["pid"]] = report["reader"]
+
+
+def warm_workers():
+    """Start the worker processes (and load their models) before the first request."""
+    executor = get_executor()
+    list(executor.map(_noop, range(OCR_WORKERS)))
+
+
+def get_engine_stats():
+    with _stats_lock:
+        stats = dict(_engine_stats)
+        workers = list(_worker_stats.values())
+    stats["workers"] = OCR_WORKERS
+    stats["batch_size"] = OCR_BATCH_SIZE
+    stats["avg_image_seconds"] = stats["image_seconds"] / stats["images"] if stats["images"] else 0.0
+    # Summed over the workers that have reported so far
+    stats["model_loads"] = sum(worker["model_loads"] for worker in workers)
+    stats["model_load_seconds"] = sum(worker["model_load_seconds"] for worker in workers)
+    stats["idle_readers"] = sum(worker["idle_readers"] for worker in workers)
+    return stats
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+    with _stats_lock:
+        _worker_stats.clear()
@@ -0,0 +1,318 @@
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+# Retailers resend the same offer several times a week. Emails are compared
+# by MinHash signatures of their normalized body text, with LSH banding so a
+# new email is only checked against likely matches; a near-duplicate reuses
+# the promotion already extracted instead of costing another model call.
+DEDUP_PATH = os.getenv("DEDUP_PATH", "dedup.sqlite3")
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.7"))
+DEDUP_MAX_AGE_DAYS = float(os.getenv("DEDUP_MAX_AGE_DAYS", "30"))
+# Emails are only matched against the same account's; a single-mailbox
+# install uses this one
+DEFAULT_ACCOUNT = "me"
+# Offers from the same company with the same code whose messages overlap
+# this much are merged into one promotion
+MESSAGE_SIMILARITY_THRESHOLD = 0.6
+SHINGLE_WORDS = 3
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+MERSENNE_PRIME = (1 << 61) - 1
+
+_rng = random.Random(1361)
+_PERMUTATIONS = [(_rng.randrange(1, MERSENNE_PRIME), _rng.randrange(0, MERSENNE_PRIME)) for _ in range(NUM_PERM)]
+
+URL_RE = re.compile(r"https?://\S+|www\.\S+")
+NON_WORD_RE = re.compile(r"[^a-z0-9%$]+")
+COMPANY_SUFFIX_RE = re.compile(r"\b(inc|llc|ltd|co|corp|corporation|company|the)\b")
+# Lines that open a retailer's footer (or sit in its header). Footers are the
+# same in every email a sender sends, so they would make different offers
+# look alike.
+FOOTER_RE = re.compile(
+    r"unsubscribe|you(?:'re| are) receiving|privacy policy|all rights reserved|\u00a9|copyright"
+    r"|manage (?:your )?(?:email )?preferences|view (?:this email )?(?:in|as a) (?:your |a )?(?:browser|web page)",
+    re.IGNORECASE,
+)
+DISCOUNT_RE = re.compile(r"\d{1,3}(?:\.\d+)?\s?%|\$\s?\d+(?:\.\d{2})?")
+
+_lock = threading.Lock()
+_conn = None
+_dedup_stats = {"checked": 0, "duplicates": 0, "in_fetch_duplicates": 0, "remembered": 0, "merged": 0,
+                "offer_mismatches": 0}
+
+
+def normalize_text(text):
+    """Lowercase, drop URLs (tracking links differ per send) and punctuation."""
+    text = URL_RE.sub(" ", (text or "").lower())
+    return NON_WORD_RE.sub(" ", text).strip()
+
+
+def shingles(text, size=SHINGLE_WORDS):
+    words = normalize_text(text).split()
+    if len(words) < size:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))} if words else set()
+    return {zlib.crc32(" ".join(words[i:i + size]).encode("utf-8")) for i in range(len(words) - size + 1)}
+
+
+def minhash(shingle_hashes):
+    return [
+        min((a * x + b) % MERSENNE_PRIME for x in shingle_hashes)
+        for a, b in _PERMUTATIONS
+    ]
+
+
+def similarity(signature_a, signature_b):
+    """Estimated Jaccard similarity of the two shingle sets."""
+    return sum(1 for a, b in zip(signature_a, signature_b) if a == b) / NUM_PERM
+
+
+def _band_keys(signature):
+    return [
+        (band, hashlib.sha1(json.dumps(signature[band * ROWS:(band + 1) * ROWS]).encode("utf-8")).hexdigest()[:16])
+        for band in range(BANDS)
+    ]
+
+
+def offer_text(text):
+    """The email text up to its footer, without header lines like "View in browser"."""
+    kept = []
+    for line in (text or "").splitlines():
+        if FOOTER_RE.search(line):
+            if any(kept_line.strip() for kept_line in kept):
+                break
+            continue
+        kept.append(line)
+    return "\n".join(kept)
+
+
+def signature_for(text):
+    hashes = shingles(offer_text(text))
+    return minhash(hashes) if hashes else None
+
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        conn = sqlite3.connect(DEDUP_PATH, check_same_thread=False)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(dedup_signatures)")]
+        schema = (
+            "CREATE TABLE IF NOT EXISTS dedup_signatures ("
+            " account TEXT NOT NULL,"
+            " message_id TEXT NOT NULL,"
+            " signature TEXT NOT NULL,"
+            " promotion_keys TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " PRIMARY KEY (account, message_id));"
+            "CREATE TABLE IF NOT EXISTS dedup_bands ("
+            " account TEXT NOT NULL,"
+            " band INTEGER NOT NULL,"
+            " band_hash TEXT NOT NULL,"
+            " message_id TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS dedup_bands_account_lookup ON dedup_bands (account, band, band_hash);"
+            "CREATE INDEX IF NOT EXISTS dedup_bands_message ON dedup_bands (account, message_id);"
+        )
+        if columns and "account" not in columns:
+            # Indexes made before multi-mailbox support hold the default account's emails
+            conn.executescript(
+                "BEGIN;"
+                "ALTER TABLE dedup_signatures RENAME TO dedup_signatures_old;"
+                "ALTER TABLE dedup_bands RENAME TO dedup_bands_old;"
+                "DROP INDEX IF EXISTS dedup_bands_lookup;" + schema +
+                f"INSERT INTO dedup_signatures SELECT '{DEFAULT_ACCOUNT}', message_id, signature,"
+                " promotion_keys, created_at FROM dedup_signatures_old;"
+                f"INSERT INTO dedup_bands SELECT '{DEFAULT_ACCOUNT}', band, band_hash, message_id FROM dedup_bands_old;"
+                "DROP TABLE dedup_signatures_old;"
+                "DROP TABLE dedup_bands_old;"
+                "COMMIT;"
+            )
+        else:
+            conn.executescript(schema)
+        _conn = conn
+    return _conn
+
+
+def find_similar(signature, candidates):
+    """Index into candidates (signatures) of the closest one above DEDUP_THRESHOLD, or None."""
+    best = None
+    for position, other in enumerate(candidates):
+        score = similarity(signature, other)
+        if score >= DEDUP_THRESHOLD and (best is None or score > best[1]):
+            best = (position, score)
+    return best[0] if best else None
+
+
+def find_duplicate(signature, exclude_message_id=None, account=DEFAULT_ACCOUNT):
+    """
+    Returns (message_id, promotion_keys, similarity) for account's most
+    similar stored email above DEDUP_THRESHOLD, or None. Other accounts'
+    emails never match, so their promotions stay theirs.
+    """
+    if signature is None:
+        return None
+    cutoff = time.time() - DEDUP_MAX_AGE_DAYS * 24 * 3600
+    with _lock:
+        _dedup_stats["checked"] += 1
+        conn = _get_conn()
+        candidates = set()
+        for band, band_hash in _band_keys(signature):
+            for (message_id,) in conn.execute(
+                "SELECT message_id FROM dedup_bands WHERE account = ? AND band = ? AND band_hash = ?",
+                (account, band, band_hash),
+            ):
+                candidates.add(message_id)
+        candidates.discard(exclude_message_id)
+        best = None
+        for message_id in candidates:
+            row = conn.execute(
+                "SELECT signature, promotion_keys, created_at FROM dedup_signatures"
+                " WHERE account = ? AND message_id = ?",
+                (account, message_id),
+            ).fetchone()
+            if row is None or row[2] < cutoff:
+                continue
+            score = similarity(signature, json.loads(row[0]))
+            if score >= DEDUP_THRESHOLD and (best is None or score > best[2]):
+                best = (message_id, json.loads(row[1]), score)
+        if best is not None:
+            _dedup_stats["duplicates"] += 1
+    return best
+
+
+def remember(message_id, signature, promotion_keys, account=DEFAULT_ACCOUNT):
+    """Index account's email signature along with the promotions extracted from it."""
+    if signature is None or not promotion_keys:
+        return
+    with _lock:
+        conn = _get_conn()
+        conn.execute("DELETE FROM dedup_bands WHERE account = ? AND message_id = ?", (account, message_id))
+        conn.execute(
+            "INSERT OR REPLACE INTO dedup_signatures (account, message_id, signature, promotion_keys, created_at)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (account, message_id, json.dumps(signature), json.dumps(list(promotion_keys)), time.time()),
+        )
+        conn.executemany(
+            "INSERT INTO dedup_bands (account, band, band_hash, message_id) VALUES (?, ?, ?, ?)",
+            [(account, band, band_hash, message_id) for band, band_hash in _band_keys(signature)],
+        )
+        conn.commit()
+        _dedup_stats["remembered"] += 1
+
+
+def evict_old():
+    cutoff = time.time() - DEDUP_MAX_AGE_DAYS * 24 * 3600
+    with _lock:
+        conn = _get_conn()
+        conn.execute(
+            "DELETE FROM dedup_bands WHERE (account, message_id) IN"
+            " (SELECT account, message_id FROM dedup_signatures WHERE created_at < ?)",
+            (cutoff,),
+        )
+        removed = conn.execute("DELETE FROM dedup_signatures WHERE created_at < ?", (cutoff,)).rowcount
+        conn.commit()
+    return removed
+
+
+def rename_promotion_keys(renamed):
+    """Points remembered emails at new promotion store keys ({old key: new key})."""
+    if not renamed:
+        return 0
+    updated = 0
+    with _lock:
+        conn = _get_conn()
+        for account, message_id, promotion_keys in conn.execute(
+                "SELECT account, message_id, promotion_keys FROM dedup_signatures").fetchall():
+            keys = json.loads(promotion_keys)
+            new_keys = list(dict.fromkeys(renamed.get(key, key) for key in keys))
+            if new_keys != keys:
+                conn.execute("UPDATE dedup_signatures SET promotion_keys = ? WHERE account = ? AND message_id = ?",
+                             (json.dumps(new_keys), account, message_id))
+                updated += 1
+        conn.commit()
+    return updated
+
+
+def normalize_company(company):
+    company = normalize_text(company)
+    return " ".join(COMPANY_SUFFIX_RE.sub(" ", company).split())
+
+
+def fingerprint(promotion):
+    """Normalized (Company, Promo code, offer text) identity of a promotion."""
+    parts = [
+        normalize_company(promotion.get("Company")),
+        (promotion.get("Promo code") or "").strip().upper(),
+        normalize_text(promotion.get("Promo message")),
+    ]
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def message_similarity(message_a, message_b):
+    """Jaccard similarity of word pairs; promo messages are too short for MinHash."""
+    a = shingles(message_a, size=2)
+    b = shingles(message_b, size=2)
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def discounts(text):
+    """Normalized discount amounts in text: {'20%', '$30'}."""
+    return {re.sub(r"\s", "", amount).replace(".00", "") for amount in DISCOUNT_RE.findall(text or "")}
+
+
+def same_offer(promotion, text, codes):
+    """
+    Whether a promotion extracted from an earlier email also fits this
+    one, whose text introduces codes: the code matches and so does the
+    discount, where either side states one.
+    """
+    code = (promotion.get("Promo code") or "").strip().upper()
+    if code:
+        if not re.search(r"(?<![\w-])" + re.escape(code) + r"(?![\w-])", text, re.IGNORECASE):
+            return False
+    elif codes:
+        return False
+    expected = discounts(promotion.get("Promo message"))
+    found = discounts(text)
+    return not (expected and found) or bool(expected & found)
+
+
+def merge(existing, new):
+    """Keep the later expiration date, and the newest non-empty link."""
+    merged = dict(existing)
+    for field, value in new.items():
+        if not merged.get(field):
+            merged[field] = value
+    if (new.get("Expiration Date") or "") > (existing.get("Expiration Date") or ""):
+        merged["Expiration Date"] = new["Expiration Date"]
+    if new.get("Link to Promo"):
+        merged["Link to Promo"] = new["Link to Promo"]
+    return merged
+
+
+def record_merge():
+    with _lock:
+        _dedup_stats["merged"] += 1
+
+
+def record_offer_mismatch():
+    with _lock:
+        _dedup_stats["offer_mismatches"] += 1
+
+
+def record_in_fetch_duplicate():
+    with _lock:
+        _dedup_stats["in_fetch_duplicates"] += 1
+
+
+def get_dedup_stats():
+    with _lock:
+        return dict(_dedup_stats)
@@ -0,0 +1,284 @@
+import datetime
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import promo_dedup
+
+logger = logging.getLogger(__name__)
+
+# Extracted promotions are kept in SQLite so the frontend can read deals
+# without re-running the Gmail + OCR + LLM pipeline.
+PROMOTION_STORE_PATH = os.getenv("PROMOTION_STORE_PATH", "promotions.sqlite3")
+PROMOTION_EVICT_INTERVAL_SECONDS = int(os.getenv("PROMOTION_EVICT_INTERVAL_SECONDS", "3600"))
+# Promotions without a usable expiration date are dropped after this long
+PROMOTION_MAX_AGE_DAYS = int(os.getenv("PROMOTION_MAX_AGE_DAYS", "180"))
+MAX_PAGE_SIZE = 100
+# Rows of a single-mailbox install belong to this account
+DEFAULT_ACCOUNT = "me"
+# Bumped when dedupe_key changes; older stores are re-keyed on open.
+# 1: keys are promo_dedup fingerprints (normalized company, code and
+# message), scoped by account
+STORE_VERSION = 1
+
+FIELDS = [
+    ("Company", "company"),
+    ("Category", "category"),
+    ("Promo message", "promo_message"),
+    ("Promo code", "promo_code"),
+    ("Bar code", "bar_code"),
+    ("Expiration Date", "expiration_date"),
+    ("Link to Promo", "link"),
+]
+DATE_RE = re.compile(r"(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})")
+
+_lock = threading.Lock()
+_conn = None
+_evictor = None
+_stop_evictor = threading.Event()
+
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(PROMOTION_STORE_PATH, check_same_thread=False)
+        _conn.row_factory = sqlite3.Row
+        _conn.executescript(
+            "CREATE TABLE IF NOT EXISTS promotions ("
+            " dedupe_key TEXT PRIMARY KEY,"
+            " message_id TEXT,"
+            " company TEXT,"
+            " category TEXT,"
+            " promo_message TEXT,"
+            " promo_code TEXT,"
+            " bar_code TEXT,"
+            " expiration_date TEXT,"
+            " link TEXT,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS promotions_company ON promotions (company COLLATE NOCASE);"
+            "CREATE INDEX IF NOT EXISTS promotions_category ON promotions (category);"
+            "CREATE INDEX IF NOT EXISTS promotions_expiration ON promotions (expiration_date);"
+            # Codes are stored as extracted and matched ignoring case; the
+            # old case-sensitive index couldn't serve that
+            "DROP INDEX IF EXISTS promotions_code;"
+            "CREATE INDEX IF NOT EXISTS promotions_code_nocase ON promotions (promo_code COLLATE NOCASE);"
+        )
+        columns = [row["name"] for row in _conn.execute("PRAGMA table_info(promotions)")]
+        if "account" not in columns:
+            # Stores created before multi-mailbox support hold the default account's rows
+            _conn.execute(f"ALTER TABLE promotions ADD COLUMN account TEXT NOT NULL DEFAULT '{DEFAULT_ACCOUNT}'")
+        _conn.execute("CREATE INDEX IF NOT EXISTS promotions_account ON promotions (account)")
+        if _conn.execute("PRAGMA user_version").fetchone()[0] < STORE_VERSION:
+            _rekey(_conn)
+            _conn.execute(f"PRAGMA user_version = {STORE_VERSION}")
+        _conn.commit()
+    return _conn
+
+
+def _rekey(conn):
+    """
+    Moves rows saved under an older dedupe_key to the current one, so
+    repeats of them are recognized again. Rows that now share a key are
+    merged, newest last.
+    """
+    renamed = {}
+    for row in conn.execute("SELECT * FROM promotions ORDER BY updated_at").fetchall():
+        key = dedupe_key(_to_promotion(row), row["account"])
+        if key == row["dedupe_key"]:
+            continue
+        existing = conn.execute("SELECT * FROM promotions WHERE dedupe_key = ?", (key,)).fetchone()
+        if existing is None:
+            conn.execute("UPDATE promotions SET dedupe_key = ? WHERE dedupe_key = ?", (key, row["dedupe_key"]))
+        else:
+            merged = promo_dedup.merge(_to_promotion(existing), _to_promotion(row))
+            conn.execute(
+                "UPDATE promotions SET expiration_date = ?, link = ?, updated_at = ? WHERE dedupe_key = ?",
+                (merged["Expiration Date"] or None, merged["Link to Promo"],
+                 max(existing["updated_at"], row["updated_at"]), key),
+            )
+            conn.execute("DELETE FROM promotions WHERE dedupe_key = ?", (row["dedupe_key"],))
+        renamed[row["dedupe_key"]] = key
+    if renamed:
+        logger.info("Re-keyed %d stored promotions", len(renamed))
+        # The dedup index refers to promotions by key too
+        promo_dedup.rename_promotion_keys(renamed)
+
+
+def normalize_date(value):
+    """'2025/03/15' or '2025-3-15' -> '2025-03-15'; None if it isn't a date."""
+    match = DATE_RE.search(value or "")
+    if not match:
+        return None
+    try:
+        return datetime.date(*(int(group) for group in match.groups())).isoformat()
+    except ValueError:
+        return None
+
+
+def dedupe_key(promotion, account=DEFAULT_ACCOUNT):
+    """The same offer from the same company is stored once per account."""
+    fingerprint = promo_dedup.fingerprint(promotion)
+    return fingerprint if account == DEFAULT_ACCOUNT else f"{account}:{fingerprint}"
+
+
+def _to_promotion(row):
+    promotion = {field: row[column] or "" for field, column in FIELDS}
+    promotion["id"] = row["dedupe_key"]
+    return promotion
+
+
+def _find_existing(conn, promotion, account):
+    """account's stored row for this offer: same fingerprint, or a near-identical message."""
+    row = conn.execute(
+        "SELECT * FROM promotions WHERE dedupe_key = ?", (dedupe_key(promotion, account),)
+    ).fetchone()
+    if row is not None:
+        return row
+    for row in conn.execute(
+        "SELECT * FROM promotions WHERE company = ? COLLATE NOCASE AND promo_code = ? COLLATE NOCASE AND account = ?",
+        (promotion.get("Company") or "", promotion.get("Promo code") or "", account),
+    ):
+        similarity = promo_dedup.message_similarity(row["promo_message"], promotion.get("Promo message"))
+        if similarity >= promo_dedup.MESSAGE_SIMILARITY_THRESHOLD:
+            return row
+    return None
+
+
+def save(promotions, account=DEFAULT_ACCOUNT):
+    """
+    Upserts account's (message_id, promotion dict) pairs and returns the
+    stored key of each. A repeat of a stored offer is merged into it,
+    keeping the later expiration date and the newest link.
+    """
+    now = time.time()
+    keys = []
+    with _lock:
+        conn = _get_conn()
+        for message_id, promotion in promotions:
+            promotion = dict(promotion)
+            promotion["Expiration Date"] = normalize_date(promotion.get("Expiration Date"))
+            existing = _find_existing(conn, promotion, account)
+            if existing is not None:
+                key = existing["dedupe_key"]
+                promotion = promo_dedup.merge(_to_promotion(existing), promotion)
+                promo_dedup.record_merge()
+            else:
+                key = dedupe_key(promotion, account)
+            values = [promotion.get(field) or "" for field, _ in FIELDS]
+            values[5] = values[5] or None
+            conn.execute(
+                "INSERT INTO promotions (dedupe_key, message_id, company, category, promo_message,"
+                " promo_code, bar_code, expiration_date, link, created_at, updated_at, account)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (dedupe_key) DO UPDATE SET"
+                " message_id = excluded.message_id, category = excluded.category,"
+                " bar_code = excluded.bar_code, expiration_date = excluded.expiration_date,"
+                " link = excluded.link, updated_at = excluded.updated_at",
+                [key, message_id] + values + [now, now, account],
+            )
+            keys.append(key)
+        conn.commit()
+    return keys
+
+
+def get_many(keys):
+    """Stored promotions for the given keys, in the same order; missing keys are skipped."""
+    promotions = []
+    with _lock:
+        conn = _get_conn()
+        for key in keys:
+            row = conn.execute("SELECT * FROM promotions WHERE dedupe_key = ?", (key,)).fetchone()
+            if row is not None:
+                promotion = _to_promotion(row)
+                del promotion["id"]
+                promotions.append(promotion)
+    return promotions
+
+
+def query(company=None, category=None, promo_code=None, expires_after=None, limit=20, offset=0, account=None):
+    """
+    Reads stored promotions, soonest-expiring first. Every filter is
+    optional and served by an index. Returns (promotions, next_offset);
+    next_offset is None on the last page.
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    offset = max(0, int(offset))
+    clauses = []
+    params = []
+    if account:
+        clauses.append("account = ?")
+        params.append(account)
+    if company:
+        clauses.append("company = ? COLLATE NOCASE")
+        params.append(company)
+    if category:
+        clauses.append("category = ?")
+        params.append(category)
+    if promo_code:
+        clauses.append("promo_code = ? COLLATE NOCASE")
+        params.append(promo_code)
+    if expires_after:
+        # Promotions without a known expiration date are kept in the results
+        clauses.append("(expiration_date >= ? OR expiration_date IS NULL)")
+        params.append(expires_after)
+    where = " WHERE " + " AND ".join(clauses) if clauses else ""
+    sql = (
+        "SELECT * FROM promotions" + where +
+        " ORDER BY expiration_date IS NULL, expiration_date, dedupe_key LIMIT ? OFFSET ?"
+    )
+    with _lock:
+        rows = _get_conn().execute(sql, params + [limit + 1, offset]).fetchall()
+    next_offset = offset + limit if len(rows) > limit else None
+    return [_to_promotion(row) for row in rows[:limit]], next_offset
+
+
+def evict_expired(today=None):
+    """Deletes promotions past their expiration date, or too old to have one."""
+    today = (today or datetime.date.today()).isoformat()
+    cutoff = time.time() - PROMOTION_MAX_AGE_DAYS * 24 * 3600
+    with _lock:
+        conn = _get_conn()
+        removed = conn.execute("DELETE FROM promotions WHERE expiration_date < ?", (today,)).rowcount
+        removed += conn.execute(
+            "DELETE FROM promotions WHERE expiration_date IS NULL AND updated_at < ?", (cutoff,)
+        ).rowcount
+        conn.commit()
+    return removed
+
+
+def _evict():
+    """Expired promotions, and the dedup index's signatures that are too old to match."""
+    try:
+        removed = evict_expired()
+        if removed:
+            logger.info("Evicted %d expired promotions", removed)
+        removed = promo_dedup.evict_old()
+        if removed:
+            logger.info("Evicted %d old dedup signatures", removed)
+    except sqlite3.Error as e:
+        logger.error("Error evicting promotions: %s", e)
+
+
+def _evict_loop():
+    while not _stop_evictor.wait(PROMOTION_EVICT_INTERVAL_SECONDS):
+        _evict()
+
+
+def start_evictor():
+    """Evict once now, then on a schedule in a background thread."""
+    global _evictor
+    if _evictor is not None:
+        return
+    _evict()
+    _evictor = threading.Thread(target=_evict_loop, name="promotion-evictor", daemon=True)
+    _evictor.start()
+
+
+def get_store_stats():
+    with _lock:
+        count = _get_conn().execute("SELECT COUNT(*) FROM promotions").fetchone()[0]
+    return {"promotions": count}
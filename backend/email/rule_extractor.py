@@ -0,0 +1,241 @@
+import datetime
+import re
+import threading
+
+from imageOCR import STRONG_PROMO_INDICATORS
+
+# Deterministic extraction for easy promotions ("Use code SAVE20 for 20% off,
+# ends 3/15"). It fills the same seven fields as the Gemini prompt and scores
+# how sure it is; only low-confidence emails go on to the model.
+RULE_MIN_CONFIDENCE = 0.8
+RULE_MIN_CODE_SCORE = 0.6
+
+# A code only counts when the text introduces it ("use code X", "enter X");
+# a lone mixed token is as likely a SKU, order number or model name (PS5)
+CODE_LEAD = r"\b(?:" + "|".join(sorted(STRONG_PROMO_INDICATORS)) + r")\W{1,4}"
+
+# Share of the confidence each field contributes when found
+FIELD_WEIGHTS = {
+    "Company": 0.15,
+    "Promo message": 0.3,
+    "Promo code": 0.25,
+    "Expiration Date": 0.15,
+    "Link to Promo": 0.1,
+    "Category": 0.05,
+}
+
+CATEGORY_KEYWORDS = {
+    "sports": ["nike", "adidas", "sneaker", "running", "gym", "fitness", "golf", "outdoor", "athletic"],
+    "clothing": ["apparel", "dress", "shirt", "jeans", "denim", "fashion", "jacket", "sweater", "wear"],
+    "electronic": ["laptop", "phone", "headphone", "electronics", "tablet", "camera", "gaming", "tech", "tv"],
+    "grocery": ["grocery", "groceries", "produce", "supermarket", "pantry", "organic"],
+    "dining": ["restaurant", "pizza", "burger", "coffee", "delivery", "menu", "meal", "dine"],
+    "travel": ["flight", "hotel", "airline", "trip", "vacation", "cruise", "booking", "rental car"],
+    "health": ["pharmacy", "vitamin", "health", "wellness", "supplement", "prescription"],
+    "cosmetics": ["beauty", "makeup", "skincare", "fragrance", "cosmetic", "lipstick"],
+    "music": ["music", "concert", "album", "vinyl", "playlist", "tickets"],
+    "books": ["book", "books", "kindle", "audiobook", "novel", "reading"],
+    "retail": ["store", "home", "furniture", "decor", "department", "kitchen"],
+}
+
+GENERIC_SUBDOMAINS = {"mail", "email", "e", "em", "news", "newsletter", "info", "marketing",
+                      "promo", "promotions", "offers", "stores", "shop", "reply", "m", "t", "us"}
+SECOND_LEVEL_SUFFIXES = {"co", "com", "net", "org", "ac"}
+
+SENDER_RE = re.compile(r'^\s*"?([^"<]*?)"?\s*<([^>]+)>\s*$')
+OFFER_RE = re.compile(
+    r"(\d{1,2}\s?%\s?off"
+    r"|\$\s?\d+(?:\.\d{2})?\s?off"
+    r"|buy\s+one,?\s+get\s+one[\w\s%]*"
+    r"|bogo\b[\w\s%]*"
+    r"|free\s+shipping)",
+    re.IGNORECASE,
+)
+SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+BARCODE_RE = re.compile(r"\b(?:scan|present|show)\b[^\d]{0,40}(\d{12,13})\b", re.IGNORECASE)
+URL_RE = re.compile(r"https?://[^\s<>\"')\]]+")
+CTA_RE = re.compile(r"shop|redeem|claim|get (?:the )?deal|buy now|order now|book now|learn more|see offer|use code",
+                    re.IGNORECASE)
+UNWANTED_LINK_RE = re.compile(r"unsubscribe|preferences|privacy|mailto:|view.*browser|\.(?:png|jpe?g|gif)\b",
+                              re.IGNORECASE)
+
+MONTHS = {name: i for i, name in enumerate(
+    ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], 1)}
+EXPIRY_LEAD = r"(?:ends?|expires?|expiring|valid\s+(?:until|through|thru)|offer\s+ends|until|through|thru|by)"
+EXPIRY_ISO_RE = re.compile(EXPIRY_LEAD + r"[^\d\n]{0,20}(\d{4})-(\d{1,2})-(\d{1,2})", re.IGNORECASE)
+EXPIRY_NUMERIC_RE = re.compile(EXPIRY_LEAD + r"[^\d\n]{0,20}(\d{1,2})/(\d{1,2})(?:/(\d{2,4}))?", re.IGNORECASE)
+EXPIRY_NAMED_RE = re.compile(
+    EXPIRY_LEAD + r"[^\n]{0,20}?\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?\s+(\d{1,2})"
+    r"(?:st|nd|rd|th)?(?:,?\s+(\d{4}))?", re.IGNORECASE)
+EXPIRY_RELATIVE_RE = re.compile(r"\b(?:ends?|expires?)\s+(tonight|today|tomorrow|in\s+(\d+)\s+days?)",
+                                re.IGNORECASE)
+
+_stats_lock = threading.Lock()
+# rule_miss: emails the rules tried but weren't confident about, so they
+# went on to the model as well
+_path_stats = {"rule": 0, "llm": 0, "rule_miss": 0, "rule_seconds": 0.0, "llm_seconds": 0.0,
+               "rule_miss_seconds": 0.0}
+
+
+def company_from_sender(sender):
+    """'Nike <news@email.nike.com>' -> 'Nike'; 'deals@stores.macys.com' -> 'Macys'."""
+    if not sender:
+        return ""
+    match = SENDER_RE.match(sender)
+    if match:
+        name, address = match.group(1).strip(), match.group(2)
+        if name and "@" not in name:
+            return name
+    else:
+        address = sender.strip()
+    domain = address.rsplit("@", 1)[-1].lower().strip(">")
+    labels = [label for label in domain.split(".") if label]
+    if len(labels) < 2:
+        return ""
+    labels = labels[:-1]  # drop the TLD
+    if len(labels) > 1 and labels[-1] in SECOND_LEVEL_SUFFIXES:
+        labels = labels[:-1]  # example.co.uk
+    labels = [label for label in labels if label not in GENERIC_SUBDOMAINS] or labels
+    return labels[-1].replace("-", " ").title()
+
+
+def classify_category(company, text):
+    haystack = (company + " " + text).lower()
+    best, best_hits = "", 0
+    for category, keywords in CATEGORY_KEYWORDS.items():
+        hits = sum(1 for keyword in keywords if re.search(r"\b" + keyword, haystack))
+        if hits > best_hits:
+            best, best_hits = category, hits
+    return best
+
+
+def find_offer(text):
+    """The first sentence that states a concrete offer, trimmed to ~15 words."""
+    for sentence in SENTENCE_SPLIT_RE.split(text):
+        if OFFER_RE.search(sentence):
+            words = sentence.split()
+            return " ".join(words[:15]).strip(" .,;:")
+    return ""
+
+
+def _build_date(year, month, day):
+    try:
+        return datetime.date(year, month, day)
+    except ValueError:
+        return None
+
+
+def find_expiration(text, today=None):
+    """Returns an explicit expiration as YYYY-MM-DD, or '' if none is stated."""
+    today = today or datetime.date.today()
+    date = None
+    match = EXPIRY_ISO_RE.search(text)
+    if match:
+        date = _build_date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+    if date is None:
+        match = EXPIRY_NAMED_RE.search(text)
+        if match:
+            year = int(match.group(3)) if match.group(3) else today.year
+            date = _build_date(year, MONTHS[match.group(1).lower()[:3]], int(match.group(2)))
+            if date is not None and not match.group(3) and date < today:
+                date = _build_date(year + 1, date.month, date.day)
+    if date is None:
+        match = EXPIRY_NUMERIC_RE.search(text)
+        if match:
+            year = today.year
+            if match.group(3):
+                year = int(match.group(3))
+                year += 2000 if year < 100 else 0
+            date = _build_date(year, int(match.group(1)), int(match.group(2)))
+            if date is not None and not match.group(3) and date < today:
+                date = _build_date(year + 1, date.month, date.day)
+    if date is None:
+        match = EXPIRY_RELATIVE_RE.search(text)
+        if match:
+            word = match.group(1).lower()
+            if word in ("tonight", "today"):
+                date = today
+            elif word == "tomorrow":
+                date = today + datetime.timedelta(days=1)
+            else:
+                date = today + datetime.timedelta(days=int(match.group(2)))
+    return date.isoformat() if date else ""
+
+
+def find_cta_link(links, text):
+    """
+    The first call-to-action link from the email's (href, link text) pairs,
+    else the first useful URL in the text.
+    """
+    fallback = ""
+    for href, label in links:
+        if not href.startswith("http") or UNWANTED_LINK_RE.search(href):
+            continue
+        if CTA_RE.search(label):
+            return href
+        fallback = fallback or href
+    if fallback:
+        return fallback
+    for url in URL_RE.findall(text):
+        if not UNWANTED_LINK_RE.search(url):
+            return url
+    return ""
+
+
+def is_introduced_code(code, text):
+    """True if code follows a "code"/"use"/"enter"/... in text."""
+    return re.search(CODE_LEAD + re.escape(code) + r"(?![\w-])", text, re.IGNORECASE) is not None
+
+
+def extract(sender, text, links=(), detected_codes=(), today=None):
+    """
+    Fills the promotion schema without a model.
+    links are the (href, link text) pairs from extract_html and
+    detected_codes is the ranked [(code, score)] list from scan_promo_codes.
+    Returns (promotion dict, confidence between 0 and 1).
+    """
+    today = today or datetime.date.today()
+    company = company_from_sender(sender)
+    code = ""
+    for candidate, score in detected_codes:
+        if score < RULE_MIN_CODE_SCORE:
+            break
+        if is_introduced_code(candidate, text):
+            code = candidate
+            break
+    barcode = BARCODE_RE.search(text)
+    result = {
+        "Company": company,
+        "Category": classify_category(company, text),
+        "Promo message": find_offer(text),
+        "Promo code": code,
+        "Bar code": barcode.group(1) if barcode else "",
+        "Expiration Date": find_expiration(text, today),
+        "Link to Promo": find_cta_link(links, text),
+    }
+    confidence = sum(weight for field, weight in FIELD_WEIGHTS.items() if result[field])
+
+    # Same defaults the prompt asks the model for
+    if not result["Category"]:
+        result["Category"] = "misc"
+    if not result["Expiration Date"]:
+        result["Expiration Date"] = (today + datetime.timedelta(days=90)).isoformat()
+    return result, round(confidence, 2)
+
+
+def record_path(path, seconds, count=1):
+    """Tally emails handled by the 'rule' or 'llm' path (or missed by the rules) and the time spent there."""
+    with _stats_lock:
+        _path_stats[path] += count
+        _path_stats[path + "_seconds"] += seconds
+
+
+def get_path_stats():
+    with _stats_lock:
+        stats = dict(_path_stats)
+    total = stats["rule"] + stats["llm"]
+    stats["rule_share"] = stats["rule"] / total if total else 0.0
+    stats["avg_rule_seconds"] = stats["rule_seconds"] / stats["rule"] if stats["rule"] else 0.0
+    stats["avg_llm_seconds"] = stats["llm_seconds"] / stats["llm"] if stats["llm"] else 0.0
+    stats["avg_rule_miss_seconds"] = stats["rule_miss_seconds"] / stats["rule_miss"] if stats["rule_miss"] else 0.0
+    return stats
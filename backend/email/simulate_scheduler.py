@@ -0,0 +1,262 @@
+"""
+Simulation: many mailboxes synced by one MailboxScheduler against a fake
+Gmail backend. Most accounts get an occasional promotion; a few heavy
+ones get a burst of mail on every push. Each sync runs the real
+incremental sync and batched fetch (gmail_sync, gmail_fetch) on the fake
+service, then holds a slot of a shared extraction pool per message, the
+way every account's fetch shares the OCR processes and model calls.
+
+The same traffic is replayed with the quota budgets switched off and on;
+the report shows how long light accounts wait for their mail and how
+much quota the heavy ones take.
+
+    python simulate_scheduler.py [accounts] [seconds]
+"""
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import gmail_fetch
+import gmail_sync
+import mailbox_scheduler
+
+GMAIL_LATENCY = 0.02  # per HTTP round trip (a batch counts as one)
+EXTRACT_SECONDS = 0.01  # per message, in the shared pool
+EXTRACT_SLOTS = 4
+WORKERS = 8
+HEAVY_ACCOUNTS = 5
+HEAVY_PUSH_INTERVAL = 0.1  # seconds between pushes to a heavy account
+HEAVY_MESSAGES_PER_PUSH = 10
+LIGHT_PUSHES_PER_SECOND = 20  # across all light accounts
+STALE_AFTER_SECONDS = 10
+DRAIN_SECONDS = 3  # after the traffic stops, before the workers are stopped
+GMAIL_USER_LIMIT = 250  # units per user per second
+
+
+class FakeMailbox:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.history_id = 1
+        self.added = []  # (history id, message id)
+        self.arrived = {}  # message id -> arrival time
+
+    def deliver(self, count):
+        with self.lock:
+            for _ in range(count):
+                self.history_id += 1
+                message_id = f"{self.name}-{self.history_id}"
+                self.added.append((self.history_id, message_id))
+                self.arrived[message_id] = time.monotonic()
+
+
+class QuotaLog:
+    """Units each account (and the project) spent in each second, as Gmail would count them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.per_account = defaultdict(lambda: defaultdict(int))
+        self.total = defaultdict(int)
+
+    def record(self, account, units):
+        second = int(time.monotonic())
+        with self.lock:
+            self.per_account[account][second] += units
+            self.total[second] += units
+
+
+class FakeRequest:
+    def __init__(self, service, method_id, fn):
+        self.service = service
+        self.methodId = method_id
+        self.fn = fn
+
+    def execute(self):
+        time.sleep(GMAIL_LATENCY)
+        self.service.charge(self)
+        return self.fn()
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.calls = []
+
+    def add(self, request, request_id):
+        self.calls.append((request_id, request))
+
+    def execute(self):
+        time.sleep(GMAIL_LATENCY)
+        for request_id, request in self.calls:
+            self.service.charge(request)
+            self.callback(request_id, request.fn(), None)
+
+
+class FakeGmail:
+    """Just enough of the Gmail API for gmail_sync and gmail_fetch."""
+
+    def __init__(self, mailbox, quota_log):
+        self.mailbox = mailbox
+        self.quota_log = quota_log
+
+    def charge(self, request):
+        units = gmail_fetch.QUOTA_UNITS.get(request.methodId, gmail_fetch.DEFAULT_QUOTA_UNITS)
+        self.quota_log.record(self.mailbox.name, units)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return self
+
+    def getProfile(self, userId):
+        return FakeRequest(self, 'gmail.users.getProfile', lambda: {'historyId': str(self.mailbox.history_id)})
+
+    def list(self, userId, startHistoryId=None, historyTypes=None, labelId=None, pageToken=None,
+             q=None, maxResults=100):
+        mailbox = self.mailbox
+        if startHistoryId is None:
+            def newest():
+                with mailbox.lock:
+                    return {'messages': [{'id': message_id} for _, message_id in mailbox.added[-maxResults:]]}
+            return FakeRequest(self, 'gmail.users.messages.list', newest)
+
+        def since():
+            with mailbox.lock:
+                added = [(h, m) for h, m in mailbox.added if h > int(startHistoryId)]
+                return {
+                    'history': [{'messagesAdded': [{'message': {'id': m}}]} for _, m in added],
+                    'historyId': str(mailbox.history_id),
+                }
+        return FakeRequest(self, 'gmail.users.history.list', since)
+
+    def get(self, userId, id, format=None, metadataHeaders=None):
+        message = {'id': id, 'labelIds': ['CATEGORY_PROMOTIONS'], 'payload': {'mimeType': 'text/plain', 'body': {}}}
+        return FakeRequest(self, 'gmail.users.messages.get', lambda: message)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+class Simulation:
+    def __init__(self, accounts, budgets):
+        # Each run starts from fresh mailboxes, so it needs its own stored historyIds
+        gmail_sync.GMAIL_SYNC_STATE_DIR = tempfile.mkdtemp(prefix="sim_sync_state_")
+        self.quota_log = QuotaLog()
+        self.mailboxes = {f"user{i}@example.com": None for i in range(accounts)}
+        for name in self.mailboxes:
+            self.mailboxes[name] = FakeMailbox(name)
+        self.heavy = set(list(self.mailboxes)[:HEAVY_ACCOUNTS])
+        self.extract_slots = threading.BoundedSemaphore(EXTRACT_SLOTS)
+        self.latencies = defaultdict(list)  # 'heavy' / 'light' -> seconds from arrival to synced
+        self.lock = threading.Lock()
+        rates = {} if budgets else {
+            'account_rate': 1e9, 'account_burst': 1e9, 'global_rate': 1e9, 'global_burst': 1e9}
+        self.scheduler = mailbox_scheduler.MailboxScheduler(
+            self.sync, workers=WORKERS, stale_after=STALE_AFTER_SECONDS, **rates)
+
+    def sync(self, account):
+        mailbox = self.mailboxes[account]
+        with gmail_fetch.metered(GMAIL_USER_LIMIT, account) as meter:
+            service = FakeGmail(mailbox, self.quota_log)
+            state_path = gmail_sync.state_path_for(account)
+            message_ids, history_id = gmail_sync.list_new_message_ids(service, state_path)
+            messages, failed = gmail_fetch.fetch_messages(service, message_ids, needs_full=lambda metadata: True)
+        for _ in messages:
+            with self.extract_slots:
+                time.sleep(EXTRACT_SECONDS)
+        if not failed:
+            gmail_sync.commit_history_id(history_id, state_path)
+        now = time.monotonic()
+        kind = 'heavy' if account in self.heavy else 'light'
+        with self.lock:
+            for message in messages:
+                arrived = mailbox.arrived.get(message['id'])
+                if arrived is not None:
+                    self.latencies[kind].append(now - arrived)
+        return meter['units']
+
+    def traffic(self, seconds, seed):
+        """(time, account, messages) events, the same for both runs with the same seed."""
+        rng = random.Random(seed)
+        events = []
+        for account in self.heavy:
+            t = rng.uniform(0, HEAVY_PUSH_INTERVAL)
+            while t < seconds:
+                events.append((t, account, HEAVY_MESSAGES_PER_PUSH))
+                t += HEAVY_PUSH_INTERVAL
+        light = [account for account in self.mailboxes if account not in self.heavy]
+        t = rng.expovariate(LIGHT_PUSHES_PER_SECOND)
+        while t < seconds:
+            events.append((t, rng.choice(light), 1))
+            t += rng.expovariate(LIGHT_PUSHES_PER_SECOND)
+        return sorted(events)
+
+    def run(self, seconds, seed=1):
+        # Sync every account once up front so their historyIds are stored
+        for account in self.mailboxes:
+            state_path = gmail_sync.state_path_for(account)
+            _, history_id = gmail_sync.list_new_message_ids(FakeGmail(self.mailboxes[account], QuotaLog()), state_path)
+            gmail_sync.commit_history_id(history_id, state_path)
+            self.scheduler.add_account(account)
+        self.scheduler.start()
+        start = time.monotonic()
+        for number, (at, account, count) in enumerate(self.traffic(seconds, seed)):
+            delay = start + at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.mailboxes[account].deliver(count)
+            self.scheduler.push(account, f"pubsub-{number}")
+        # Heavy accounts may still owe quota, so only wait a little for the rest
+        self.scheduler.wait_idle(timeout=DRAIN_SECONDS)
+        self.scheduler.stop()
+        return time.monotonic() - start
+
+    def delivered(self, kind):
+        accounts = self.heavy if kind == 'heavy' else set(self.mailboxes) - self.heavy
+        return sum(len(self.mailboxes[account].arrived) for account in accounts)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def report(label, sim, elapsed):
+    stats = sim.scheduler.get_stats()
+    log = sim.quota_log
+    heavy_units = sum(sum(log.per_account[account].values()) for account in sim.heavy)
+    over_limit = sum(
+        1 for seconds in log.per_account.values() for units in seconds.values() if units > GMAIL_USER_LIMIT)
+    print(f"{label}  ({elapsed:.1f} s, {stats['syncs']} syncs, {stats['quota_deferrals']} quota deferrals)")
+    for kind in ('light', 'heavy'):
+        values = sim.latencies[kind]
+        print(f"  {kind} mail  {len(values):6d}/{sim.delivered(kind):<6d} synced, after p50 {percentile(values, 0.5):6.2f} s"
+              f"  p95 {percentile(values, 0.95):6.2f} s  max {percentile(values, 1.0):6.2f} s")
+    print(f"  heavy accounts  {heavy_units / elapsed / len(sim.heavy):7.0f} units/s each")
+    print(f"  whole project   {max(log.total.values() or [0]):7d} units in the busiest second")
+    print(f"  account-seconds over Gmail's {GMAIL_USER_LIMIT} units/s per-user limit: {over_limit}")
+
+
+def main():
+    accounts = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 15
+    print(f"{accounts} accounts ({HEAVY_ACCOUNTS} heavy), {WORKERS} sync workers, "
+          f"{EXTRACT_SLOTS} shared extraction slots, {seconds:.0f} s of traffic\n")
+    for label, budgets in (("no quota budgets", False), ("per-account and global budgets", True)):
+        sim = Simulation(accounts, budgets)
+        elapsed = sim.run(seconds)
+        report(label, sim, elapsed)
+
+
+if __name__ == "__main__":
+    main()
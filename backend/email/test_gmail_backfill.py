@@ -0,0 +1,179 @@
+import base64
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import gmail_backfill
+
+# deep_search refuses to import without client secrets; the repo's own will do
+os.environ.setdefault('OAUTH2_CLIENT_SECRETS_FILE', os.path.join(os.path.dirname(__file__), 'oauthhacknyu.json'))
+
+
+def email(message_id):
+    text = f"Hi there, new arrivals just landed in store {message_id}. Come take a look."
+    return {
+        'id': message_id,
+        'labelIds': ['CATEGORY_PROMOTIONS'],
+        'payload': {
+            'mimeType': 'text/plain',
+            'headers': [{'name': 'From', 'value': 'Shop <news@mail.shop.com>'}],
+            'body': {'data': base64.urlsafe_b64encode(text.encode()).decode()},
+        },
+    }
+
+
+class Call:
+    methodId = 'gmail.users.messages.get'
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self):
+        return self.fn()
+
+
+class Batch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.calls = []
+
+    def add(self, call, request_id):
+        self.calls.append((request_id, call))
+
+    def execute(self):
+        for request_id, call in self.calls:
+            self.callback(request_id, call.execute(), None)
+
+
+class FakeGmail:
+    """The promotions label, a page at a time, and batched gets of its messages."""
+
+    def __init__(self, message_ids, page_size=4):
+        self.message_ids = message_ids
+        self.page_size = page_size
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId, q=None, maxResults=None, pageToken=None):
+        start = int(pageToken or 0)
+        end = start + self.page_size
+        page = {'messages': [{'id': message_id} for message_id in self.message_ids[start:end]]}
+        if end < len(self.message_ids):
+            page['nextPageToken'] = str(end)
+        return Call(lambda: page)
+
+    def get(self, userId, id, format=None, metadataHeaders=None):
+        return Call(lambda: email(id))
+
+    def new_batch_http_request(self, callback):
+        return Batch(callback)
+
+
+@pytest.fixture
+def state_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(gmail_backfill, 'BACKFILL_RETRY_SECONDS', 0.0)
+    return str(tmp_path / 'backfill_state.json')
+
+
+def run(service, process_chunk, state_path):
+    return gmail_backfill.run_backfill(service, process_chunk, state_path=state_path, chunk_size=2,
+                                       max_per_minute=0)
+
+
+def test_chunks_reporting_failures_are_retried_then_skipped(state_path):
+    calls = []
+
+    def process_chunk(message_ids):
+        calls.append(message_ids)
+        return 1 if 'm3' in message_ids else 0
+
+    state = run(FakeGmail([f"m{i}" for i in range(6)]), process_chunk, state_path)
+
+    assert calls == [['m0', 'm1']] + [['m2', 'm3']] * gmail_backfill.BACKFILL_MAX_CHUNK_ATTEMPTS + [['m4', 'm5']]
+    assert state['completed']
+    assert state['processed'] == 4
+    assert state['skipped_ids'] == ['m2', 'm3']
+
+
+class Killed(BaseException):
+    """Stands in for the process dying mid-chunk (OOM kill, SIGKILL)."""
+
+
+def test_a_chunk_that_takes_the_process_down_is_skipped_after_restarts(state_path):
+    service = FakeGmail(['m0', 'm1', 'm2'])
+    calls = []
+
+    def process_chunk(message_ids):
+        calls.append(message_ids)
+        if 'm0' in message_ids:
+            raise Killed()
+
+    for attempt in range(1, gmail_backfill.BACKFILL_MAX_CHUNK_ATTEMPTS + 1):
+        with pytest.raises(Killed):
+            run(service, process_chunk, state_path)
+        assert gmail_backfill.load_state(state_path)['chunk_attempts'] == attempt
+
+    state = run(service, process_chunk, state_path)
+    assert calls == [['m0', 'm1']] * gmail_backfill.BACKFILL_MAX_CHUNK_ATTEMPTS + [['m2']]
+    assert state['skipped_ids'] == ['m0', 'm1']
+    assert state['processed'] == 1
+
+
+class FakeModel:
+    def __init__(self, working):
+        self.working = working
+        self.calls = 0
+
+    def generate_content(self, prompt):
+        self.calls += 1
+        if not self.working:
+            raise RuntimeError("model unavailable")
+        return SimpleNamespace(text=json.dumps({'Company': 'Shop', 'Category': 'retail'}))
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    import deep_search
+    import extraction_cache
+    import promo_dedup
+    import promotion_store
+
+    for module, name in [(extraction_cache, 'EXTRACTION_CACHE_PATH'), (promo_dedup, 'DEDUP_PATH'),
+                         (promotion_store, 'PROMOTION_STORE_PATH')]:
+        monkeypatch.setattr(module, name, str(tmp_path / f"{name.lower()}.sqlite3"))
+        monkeypatch.setattr(module, '_conn', None)
+    monkeypatch.setattr(deep_search, 'PIPELINE_MODE', 'async')
+    monkeypatch.setattr(deep_search, 'PIPELINE_EXTRACT_LINGER_SECONDS', 0.0)
+    monkeypatch.setattr(deep_search, 'RULE_FAST_PATH', False)
+    monkeypatch.setattr(deep_search, 'get_debug_dir', lambda: None)
+    # The backfill state goes to its default, relative path
+    monkeypatch.chdir(tmp_path)
+    return deep_search
+
+
+@pytest.mark.parametrize('working', [True, False])
+def test_async_backfill_retries_chunks_that_failed_extraction(pipeline, state_path, monkeypatch, working):
+    import message_processing
+
+    model = FakeModel(working)
+    monkeypatch.setattr(message_processing, 'get_model', lambda: model)
+    service = FakeGmail(['m0', 'm1'])
+    monkeypatch.setattr(pipeline, 'get_service', lambda account=None: service)
+
+    state = pipeline.run_backfill()
+
+    assert state['completed']
+    if working:
+        assert state['processed'] == 2
+        assert state['skipped_ids'] == []
+    else:
+        # The pipeline swallows the model errors, but the chunk still counts as failed
+        assert state['processed'] == 0
+        assert state['skipped_ids'] == ['m0', 'm1']
+        assert model.calls >= gmail_backfill.BACKFILL_MAX_CHUNK_ATTEMPTS
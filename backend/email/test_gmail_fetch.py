@@ -0,0 +1,246 @@
+import importlib
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import gmail_fetch
+
+
+def http_error(status, content=b''):
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+class FakeGmail:
+    """
+    Local stand-in for the Gmail API: users.messages.get through batch HTTP
+    requests. failures maps (message id, format) to the errors its next
+    calls raise, one per call.
+    """
+
+    def __init__(self, messages, failures=None):
+        self.messages_by_id = messages
+        self.failures = {key: list(errors) for key, errors in (failures or {}).items()}
+        self.batches = []  # [(format, message id)] of every batch HTTP request
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, userId, id, format=None, metadataHeaders=None):
+        return Call(self, id, format)
+
+    def new_batch_http_request(self, callback):
+        return Batch(self, callback)
+
+
+class Call:
+    methodId = 'gmail.users.messages.get'
+
+    def __init__(self, service, message_id, format):
+        self.service = service
+        self.message_id = message_id
+        self.format = format
+
+    def execute(self):
+        errors = self.service.failures.get((self.message_id, self.format))
+        if errors:
+            raise errors.pop(0)
+        if self.message_id not in self.service.messages_by_id:
+            raise http_error(404)
+        message = self.service.messages_by_id[self.message_id]
+        if self.format == 'full':
+            return message
+        return {'id': message['id'], 'labelIds': message['labelIds']}
+
+
+class Batch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.calls = []
+
+    def add(self, call, request_id):
+        self.calls.append((request_id, call))
+
+    def execute(self):
+        self.service.batches.append([(call.format, call.message_id) for _, call in self.calls])
+        for request_id, call in self.calls:
+            try:
+                response, exception = call.execute(), None
+            except HttpError as e:
+                response, exception = None, e
+            self.callback(request_id, response, exception)
+
+
+def mailbox(count, promotions=None):
+    promotions = range(count) if promotions is None else promotions
+    return {
+        f"m{i}": {
+            'id': f"m{i}",
+            'labelIds': ['CATEGORY_PROMOTIONS'] if i in promotions else ['INBOX'],
+            'payload': {'mimeType': 'text/plain', 'body': {}},
+        }
+        for i in range(count)
+    }
+
+
+def is_promotion(metadata):
+    return 'CATEGORY_PROMOTIONS' in metadata['labelIds']
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(gmail_fetch, 'GMAIL_BACKOFF_BASE_SECONDS', 0.0)
+
+
+def test_calls_are_split_into_batches(monkeypatch):
+    monkeypatch.setattr(gmail_fetch, 'GMAIL_BATCH_SIZE', 20)
+    service = FakeGmail(mailbox(45))
+    counts = gmail_fetch.new_counts()
+
+    messages, failed = gmail_fetch.fetch_messages(service, list(service.messages_by_id), counts=counts)
+
+    assert [message['id'] for message in messages] == [f"m{i}" for i in range(45)]
+    assert failed == []
+    assert [len(batch) for batch in service.batches] == [20, 20, 5, 20, 20, 5]
+    assert counts == {'http_requests': 6, 'sub_requests': 90, 'retries': 0, 'failures': 0}
+
+
+def test_only_wanted_messages_are_fetched_in_full():
+    service = FakeGmail(mailbox(6, promotions={1, 4}))
+
+    messages, _ = gmail_fetch.fetch_messages(service, list(service.messages_by_id), needs_full=is_promotion)
+
+    assert [message['id'] for message in messages] == ['m1', 'm4']
+    assert all('payload' in message for message in messages)
+    metadata, full = service.batches
+    assert {format for format, _ in metadata} == {'metadata'}
+    assert full == [('full', 'm1'), ('full', 'm4')]
+
+
+@pytest.mark.parametrize('error', [
+    http_error(429),
+    http_error(500),
+    http_error(503),
+    http_error(403, b'{"error": {"errors": [{"reason": "rateLimitExceeded"}]}}'),
+])
+def test_throttled_calls_are_retried(error):
+    service = FakeGmail(mailbox(3), failures={('m1', 'metadata'): [error, error], ('m2', 'full'): [error]})
+    counts = gmail_fetch.new_counts()
+
+    messages, failed = gmail_fetch.fetch_messages(service, ['m0', 'm1', 'm2'], counts=counts)
+
+    # Results keep the order asked for, whichever attempt they arrived in
+    assert [message['id'] for message in messages] == ['m0', 'm1', 'm2']
+    assert failed == []
+    # Only the failed calls go out again
+    assert service.batches == [
+        [('metadata', 'm0'), ('metadata', 'm1'), ('metadata', 'm2')],
+        [('metadata', 'm1')],
+        [('metadata', 'm1')],
+        [('full', 'm0'), ('full', 'm1'), ('full', 'm2')],
+        [('full', 'm2')],
+    ]
+    assert counts['retries'] == 3
+    assert counts['failures'] == 0
+
+
+def test_other_errors_are_not_retried():
+    service = FakeGmail(mailbox(2), failures={('m0', 'metadata'): [http_error(403, b'forbidden')]})
+    counts = gmail_fetch.new_counts()
+
+    messages, failed = gmail_fetch.fetch_messages(service, ['m0', 'm1', 'gone'], counts=counts)
+
+    assert [message['id'] for message in messages] == ['m1']
+    # A deleted message (404) is simply not there; the forbidden one failed
+    assert failed == ['m0']
+    assert len(service.batches) == 2
+    assert counts['retries'] == 0
+    assert counts['failures'] == 2
+
+
+def test_retries_give_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(gmail_fetch, 'GMAIL_MAX_RETRIES', 2)
+    service = FakeGmail(mailbox(2), failures={('m0', 'metadata'): [http_error(429)] * 5})
+    counts = gmail_fetch.new_counts()
+
+    messages, failed = gmail_fetch.fetch_messages(service, ['m0', 'm1'], counts=counts)
+
+    assert [message['id'] for message in messages] == ['m1']
+    assert failed == ['m0']
+    assert sum(('metadata', 'm0') in batch for batch in service.batches) == 3
+    assert counts['retries'] == 2
+    assert counts['failures'] == 1
+
+
+def test_failed_full_fetches_are_reported():
+    service = FakeGmail(mailbox(3), failures={('m2', 'full'): [http_error(500)] * 10})
+
+    messages, failed = gmail_fetch.fetch_messages(service, ['m0', 'm1', 'm2'])
+
+    assert [message['id'] for message in messages] == ['m0', 'm1']
+    assert failed == ['m2']
+
+
+def test_metered_counts_quota_units():
+    service = FakeGmail(mailbox(4, promotions={0}))
+
+    with gmail_fetch.metered() as meter:
+        gmail_fetch.fetch_messages(service, list(service.messages_by_id), needs_full=is_promotion)
+
+    # Four metadata gets and one full get, 5 units each
+    assert meter['units'] == 25
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.mark.parametrize('burst_fraction', [0.0, 0.2, 0.9])
+def test_metered_blocks_share_the_accounts_pace(monkeypatch, burst_fraction):
+    clock = FakeClock()
+    monkeypatch.setattr(gmail_fetch, 'time', clock)
+    monkeypatch.setattr(gmail_fetch, 'GMAIL_PACE_BURST_FRACTION', burst_fraction)
+    monkeypatch.setattr(gmail_fetch, '_pacers', {})
+    service = FakeGmail(mailbox(30))
+    sent = []  # (time, units) of every call, as Gmail would see them
+
+    def execute(request):
+        sent.append((clock.now, 5))
+        return request.execute()
+
+    # Back-to-back syncs of one account, each well over a second's worth of units
+    for _ in range(3):
+        with gmail_fetch.metered(100, account='a@example.com') as meter:
+            for message_id in service.messages_by_id:
+                gmail_fetch._charge(service.get(userId='me', id=message_id))
+                execute(service.get(userId='me', id=message_id))
+        assert meter['units'] == 150
+
+    for start, _ in sent:
+        assert sum(units for at, units in sent if start <= at < start + 1) <= 100
+    # The pace stays close to the limit rather than far under it
+    assert clock.now - 1000.0 < 450 / (100 * (1 - burst_fraction)) + 0.1
+
+
+@pytest.mark.parametrize('value, fraction', [('1', 0.9), ('5', 0.9), ('-1', 0.0), ('0.5', 0.5)])
+def test_burst_fraction_is_clamped(monkeypatch, value, fraction):
+    monkeypatch.setenv('GMAIL_PACE_BURST_FRACTION', value)
+    try:
+        importlib.reload(gmail_fetch)
+        assert gmail_fetch.GMAIL_PACE_BURST_FRACTION == fraction
+        with gmail_fetch.metered(100, account='a@example.com'):
+            gmail_fetch.execute(FakeGmail(mailbox(1)).get(userId='me', id='m0'))
+    finally:
+        monkeypatch.delenv('GMAIL_PACE_BURST_FRACTION')
+        importlib.reload(gmail_fetch)
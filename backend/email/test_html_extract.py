@@ -0,0 +1,101 @@
+import pytest
+
+import html_extract
+from html_extract import extract_html
+
+bs4 = pytest.importorskip("bs4")
+
+PARSERS = [
+    pytest.param(True, id="lxml", marks=pytest.mark.skipif(html_extract.etree is None, reason="lxml not installed")),
+    pytest.param(False, id="stdlib"),
+]
+
+NEWSLETTER = """<!DOCTYPE html>
+<html><head><title>Spring Sale</title>
+<style>.hero { color: #ff0000; } td { padding: 0 }</style>
+<script>var tracking = "<div>not text</div>";</script>
+</head><body>
+<table width="600"><tr><td class="hero">
+  <a href="https://shop.example.com/sale?utm_source=email&amp;id=1"><img src="https://cdn.example.com/hero.jpg" alt="Spring sale"></a>
+  <h1>Spring Sale &mdash; 20% off</h1>
+  <p>Use code <b>SPRING20</b> at checkout.&nbsp;Ends 3/31.</p>
+</td></tr>
+<tr><td><ul><li>Jackets</li><li>Boots &amp; shoes</li></ul></td></tr>
+<tr><td><a href="https://shop.example.com/unsubscribe">Unsubscribe</a> | <a href="mailto:help@example.com">Help</a></td></tr>
+</table>
+<noscript>Enable images</noscript>
+</body></html>"""
+
+MALFORMED = """<html><body>
+<div><p>Flash deal: <i>$15 off
+<p>Use code FLASH15 <span>today<div>only</span>
+<img src=https://cdn.example.com/a.png alt=banner><IMG SRC="https://cdn.example.com/b.png">
+</td></tr></table>
+<a href=https://shop.example.com/deal>Shop <em>now</a>
+<!-- a comment <p>hidden</p> -->
+<STYLE>p { color: red }</STYLE>
+<p>Last line &copy; 2024"""
+
+
+def link_label(a):
+    # extract_html also counts an image's alt text as link text, so an image link has a label
+    alts = [img.get("alt") for img in a.find_all("img") if img.get("alt")]
+    return " ".join(alts + [a.get_text(" ", strip=True)])
+
+
+def old_bs4(html):
+    """Images, links and text the way the BeautifulSoup code got them."""
+    soup = bs4.BeautifulSoup(html, "html.parser")
+    images = [img.get("src") for img in soup.find_all("img") if img.get("src")]
+    links = [(a.get("href"), link_label(a)) for a in soup.find_all("a") if a.get("href")]
+    for tag in soup(list(html_extract.HIDDEN_TAGS)):
+        tag.decompose()
+    return images, links, soup.get_text("\n", strip=True)
+
+
+def words(text):
+    return text.split()
+
+
+@pytest.mark.parametrize("use_lxml", PARSERS)
+@pytest.mark.parametrize("html", [NEWSLETTER, MALFORMED], ids=["newsletter", "malformed"])
+def test_matches_the_bs4_output(html, use_lxml):
+    images, links, text = old_bs4(html)
+    content = extract_html(html, use_lxml=use_lxml)
+    assert content.images == images
+    assert [href for href, _ in content.links] == [href for href, _ in links]
+    assert [words(label) for _, label in content.links] == [words(label) for _, label in links]
+    assert words(content.text) == words(text)
+
+
+@pytest.mark.parametrize("use_lxml", PARSERS)
+def test_script_style_and_head_are_not_text(use_lxml):
+    text = extract_html(NEWSLETTER, use_lxml=use_lxml).text
+    for hidden in ["color", "tracking", "not text", "Spring Sale\n", "Enable images"]:
+        assert hidden not in text
+    assert text.startswith("Spring Sale — 20% off")
+
+
+@pytest.mark.parametrize("use_lxml", PARSERS)
+def test_blocks_become_lines(use_lxml):
+    text = extract_html(NEWSLETTER, use_lxml=use_lxml).text
+    assert text.splitlines() == [
+        "Spring Sale — 20% off",
+        "Use code SPRING20 at checkout. Ends 3/31.",
+        "Jackets",
+        "Boots & shoes",
+        "Unsubscribe | Help",
+    ]
+
+
+@pytest.mark.parametrize("use_lxml", PARSERS)
+def test_link_text_includes_image_alt(use_lxml):
+    links = extract_html(NEWSLETTER, use_lxml=use_lxml).links
+    assert links[0] == ("https://shop.example.com/sale?utm_source=email&id=1", "Spring sale")
+
+
+@pytest.mark.parametrize("use_lxml", PARSERS)
+def test_empty_and_textless_html(use_lxml):
+    assert extract_html("", use_lxml=use_lxml).text == ""
+    content = extract_html("<html><head><style>p {}</style></head></html>", use_lxml=use_lxml)
+    assert (content.images, content.links, content.text) == ([], [], "")
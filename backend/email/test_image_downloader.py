@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import image_downloader
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 200
+
+
+class ImageHost(BaseHTTPRequestHandler):
+    """
+    /banner.png: an image with an ETag (answers If-None-Match with 304)
+    /pixel.gif?...: a fresh image every time, cacheable for a minute
+    /private.png: sent with Cache-Control: no-store
+    /huge.png: bigger than the tests' size cap
+    anything else: 404
+    """
+
+    requests = []
+
+    def do_GET(self):
+        ImageHost.requests.append((self.path, self.headers.get('If-None-Match')))
+        path = self.path.split('?')[0]
+        if path == '/banner.png':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('Cache-Control', 'max-age=60')
+                self.end_headers()
+                return
+            self.reply(PNG, ETag='"v1"', **{'Cache-Control': 'max-age=0'})
+        elif path == '/pixel.gif':
+            self.reply(PNG, **{'Cache-Control': 'max-age=60'})
+        elif path == '/private.png':
+            self.reply(PNG, **{'Cache-Control': 'no-store'})
+        elif path == '/huge.png':
+            self.reply(b'\x00' * 4096)
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def reply(self, body, **headers):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def host():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHost)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    ImageHost.requests = []
+    monkeypatch.setattr(image_downloader, 'IMAGE_CACHE_DIR', str(tmp_path / 'image_cache'))
+    monkeypatch.setattr(image_downloader, 'IMAGE_MAX_BYTES', 1024)
+    return str(tmp_path / 'image_cache')
+
+
+def cached_entries(cache_dir):
+    return sorted(name for name in os.listdir(cache_dir) if name.endswith('.json'))
+
+
+def test_fresh_images_come_from_the_cache(host, cache_dir):
+    url = host + '/pixel.gif?u=1'
+    assert image_downloader.download_image(url) == PNG
+    assert image_downloader.download_image(url) == PNG
+    assert len(ImageHost.requests) == 1
+
+
+def test_stale_images_are_revalidated(host, cache_dir):
+    url = host + '/banner.png'
+    assert image_downloader.download_image(url) == PNG
+    # max-age=0, so the next call asks again and gets a 304
+    assert image_downloader.download_image(url) == PNG
+    # The 304's max-age=60 makes the entry fresh
+    assert image_downloader.download_image(url) == PNG
+    assert ImageHost.requests == [('/banner.png', None), ('/banner.png', '"v1"')]
+
+
+def test_failures_return_none(host, cache_dir):
+    assert image_downloader.download_image(host + '/huge.png') is None
+    assert image_downloader.download_image(host + '/missing.png') is None
+    assert image_downloader.download_image('http://127.0.0.1:1/closed.png') is None
+    assert not os.path.exists(cache_dir)
+
+
+def test_no_store_responses_are_not_cached(host, cache_dir):
+    assert image_downloader.download_image(host + '/private.png') == PNG
+    assert not os.path.exists(cache_dir)
+
+
+def test_download_images_keeps_the_order(host, cache_dir):
+    urls = [host + f"/pixel.gif?u={i}" for i in range(20)] + [host + '/missing.png']
+    assert image_downloader.download_images(urls) == [PNG] * 20 + [None]
+    # Every call shares one pool
+    assert image_downloader.get_executor() is image_downloader.get_executor()
+
+
+def test_cache_write_failures_are_not_fatal(host, tmp_path):
+    blocker = tmp_path / 'not_a_dir'
+    blocker.write_text('')
+    before = image_downloader.get_download_stats()['cache_write_errors']
+    assert image_downloader.download_image(host + '/pixel.gif?u=w', cache_dir=str(blocker)) == PNG
+    assert image_downloader.get_download_stats()['cache_write_errors'] == before + 1
+
+
+def test_eviction_drops_entries_unused_for_the_max_age(host, cache_dir, monkeypatch):
+    urls = [host + f"/pixel.gif?u=age{i}" for i in range(3)]
+    for url in urls:
+        image_downloader.download_image(url)
+    old = time.time() - 40 * 24 * 3600
+    for path in image_downloader._cache_paths(urls[1], cache_dir):
+        os.utime(path, (old, old))
+    monkeypatch.setattr(image_downloader, 'IMAGE_CACHE_MAX_AGE_DAYS', 30)
+    assert image_downloader.evict_cache() == 1
+    assert len(cached_entries(cache_dir)) == 2
+    assert not any(os.path.exists(path) for path in image_downloader._cache_paths(urls[1], cache_dir))
+
+
+def test_eviction_keeps_the_most_recently_used_within_the_size_cap(host, cache_dir, monkeypatch):
+    urls = [host + f"/pixel.gif?u=lru{i}" for i in range(4)]
+    for i, url in enumerate(urls):
+        image_downloader.download_image(url)
+        body_path, meta_path = image_downloader._cache_paths(url, cache_dir)
+        used = time.time() - 100 + i
+        for path in (body_path, meta_path):
+            os.utime(path, (used, used))
+    # A fresh hit on the oldest entry makes it the most recently used
+    image_downloader.download_image(urls[0])
+    kept_bytes = sum(os.path.getsize(path) for url in (urls[0], urls[3])
+                     for path in image_downloader._cache_paths(url, cache_dir))
+    monkeypatch.setattr(image_downloader, 'IMAGE_CACHE_MAX_BYTES', kept_bytes)
+    assert image_downloader.evict_cache() == 2
+    kept = [url for url in urls if os.path.exists(image_downloader._cache_paths(url, cache_dir)[1])]
+    assert kept == [urls[0], urls[3]]
+
+
+def test_eviction_runs_every_so_many_stores(host, cache_dir, monkeypatch):
+    monkeypatch.setattr(image_downloader, 'EVICT_EVERY_STORES', 3)
+    monkeypatch.setattr(image_downloader, 'IMAGE_CACHE_MAX_BYTES', 0)
+    monkeypatch.setattr(image_downloader, '_stores_since_evict', 0)
+    for i in range(2):
+        image_downloader.download_image(host + f"/pixel.gif?u=n{i}")
+    assert len(cached_entries(cache_dir)) == 2
+    image_downloader.download_image(host + '/pixel.gif?u=n2')
+    assert cached_entries(cache_dir) == []
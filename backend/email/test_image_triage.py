@@ -0,0 +1,74 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import image_triage
+
+
+def encode(image, format='PNG'):
+    buffer = io.BytesIO()
+    image.save(buffer, format)
+    return buffer.getvalue()
+
+
+def banner(size=(600, 200)):
+    image = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(image)
+    for y in range(10, size[1] - 10, 16):
+        draw.text((10, y), 'USE CODE SAVE20 FOR 20% OFF EVERYTHING TODAY', fill='black')
+    return image
+
+
+def photo(size=(600, 200)):
+    # A smooth gradient, like sky or a studio backdrop
+    x = np.linspace(0, 255, size[0], dtype=np.float32)
+    y = np.linspace(0, 60, size[1], dtype=np.float32)[:, None]
+    return Image.fromarray((x[None, :] * 0.5 + y).astype(np.uint8), 'L')
+
+
+@pytest.mark.parametrize('format', ['PNG', 'GIF', 'BMP', 'JPEG', 'WEBP'])
+def test_read_dimensions_from_the_header(format):
+    data = encode(Image.new('RGB', (123, 45), 'red'), format)
+    assert image_triage.read_dimensions(data) == (123, 45)
+
+
+def test_unknown_formats_have_no_dimensions():
+    assert image_triage.read_dimensions(b'not an image') is None
+
+
+def test_text_banners_score_above_blank_and_smooth_images():
+    text = image_triage.text_score(encode(banner()))
+    blank = image_triage.text_score(encode(Image.new('RGB', (600, 200), 'white')))
+    smooth = image_triage.text_score(encode(photo()))
+    assert blank == 0.0
+    assert smooth < image_triage.TRIAGE_MIN_EDGE_DENSITY <= text
+
+
+def test_score_is_measured_on_a_downscaled_copy():
+    # The same banner at four times the size scores about the same
+    small = image_triage.text_score(encode(banner()))
+    large = image_triage.text_score(encode(banner().resize((2400, 800)), 'JPEG'))
+    assert large == pytest.approx(small, abs=0.05)
+
+
+def test_should_ocr():
+    assert image_triage.should_ocr(encode(banner()))[0]
+    wanted, reason = image_triage.should_ocr(encode(Image.new('RGB', (1, 1))))
+    assert not wanted and 'too small' in reason
+    wanted, reason = image_triage.should_ocr(encode(Image.new('RGB', (600, 200), 'white')))
+    assert not wanted and 'text score' in reason
+    # A header that promises a banner, cut off before the pixels
+    wanted, reason = image_triage.should_ocr(encode(banner())[:64])
+    assert not wanted and 'could not decode' in reason
+
+
+def test_stats_count_each_outcome():
+    before = image_triage.get_triage_stats()
+    image_triage.should_ocr(encode(banner()))
+    image_triage.should_ocr(encode(Image.new('RGB', (2, 2))))
+    after = image_triage.get_triage_stats()
+    assert after['checked'] == before['checked'] + 2
+    assert after['passed'] == before['passed'] + 1
+    assert after['skipped_tiny'] == before['skipped_tiny'] + 1
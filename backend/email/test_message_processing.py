@@ -0,0 +1,146 @@
+import json
+import re
+
+import pytest
+
+import extraction_cache
+import message_processing
+from message_processing import (
+    BATCH_PROMPT_HEADER,
+    estimate_tokens,
+    pack_batches,
+    parse_batch_response,
+    process_messages_batch,
+)
+
+EMAIL_RE = re.compile(r"=== EMAIL (\d+) ===\n(.*?)(?=\n\n=== EMAIL|\Z)", re.S)
+
+
+def promotion(company, **fields):
+    return dict({"Company": company, "Category": "retail", "Promo message": "20% off"}, **fields)
+
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    """
+    Answers prompts like Gemini would. A batch prompt gets a JSON array
+    with one entry per email, passed through answer_batch so a test can
+    drop, renumber or garble entries; a single-email prompt gets one object.
+    """
+
+    def __init__(self, answer_batch=None):
+        self.answer_batch = answer_batch or (lambda entries: json.dumps(entries))
+        self.batch_prompts = []
+        self.single_prompts = []
+
+    def generate_content(self, prompt):
+        if prompt.startswith(BATCH_PROMPT_HEADER):
+            self.batch_prompts.append(prompt)
+            entries = [dict(promotion(text.split()[0]), Email=int(number))
+                       for number, text in EMAIL_RE.findall(prompt)]
+            return Response(self.answer_batch(entries))
+        self.single_prompts.append(prompt)
+        company = prompt.split("Email text:")[1].split()[0]
+        return Response("```json\n" + json.dumps(promotion(company)) + "\n```")
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(extraction_cache, "EXTRACTION_CACHE_PATH", str(tmp_path / "extraction_cache.sqlite3"))
+    monkeypatch.setattr(extraction_cache, "_conn", None)
+
+
+def emails(*companies):
+    return [(f"id-{company}", f"{company}   sale:\n use code  SAVE20") for company in companies]
+
+
+def test_pack_batches_stays_within_the_token_budget():
+    header = estimate_tokens(BATCH_PROMPT_HEADER)
+    texts = ["x" * 400] * 7  # 101 tokens each, plus 10 for the separator
+    batches = pack_batches(texts, token_budget=header + 3 * 111, max_emails=10)
+    assert batches == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_pack_batches_caps_emails_per_batch():
+    assert pack_batches(["short"] * 5, token_budget=10 ** 6, max_emails=2) == [[0, 1], [2, 3], [4]]
+
+
+def test_pack_batches_gives_oversized_emails_their_own_batch():
+    header = estimate_tokens(BATCH_PROMPT_HEADER)
+    texts = ["small", "x" * 40000, "small", "small"]
+    assert pack_batches(texts, token_budget=header + 100, max_emails=10) == [[0], [1], [2, 3]]
+
+
+def test_parse_batch_response_by_email_number():
+    text = json.dumps([dict(promotion("B"), Email=2), dict(promotion("A"), Email=1)])
+    results = parse_batch_response(text, [1, 2])
+    assert results[1]["Company"] == "A"
+    assert results[2]["Company"] == "B"
+    # Missing fields are filled in and the email number is dropped
+    assert results[1]["Promo code"] == ""
+    assert "Email" not in results[1]
+
+
+def test_parse_batch_response_falls_back_to_position_when_misnumbered():
+    text = json.dumps([dict(promotion("A"), Email=7), promotion("B"), dict(promotion("C"), Email="3")])
+    results = parse_batch_response(text, [1, 2, 3])
+    assert {number: result["Company"] for number, result in results.items()} == {1: "A", 2: "B", 3: "C"}
+
+
+def test_parse_batch_response_keeps_the_first_of_duplicate_numbers():
+    text = json.dumps([dict(promotion("A"), Email=1), dict(promotion("A again"), Email=1)])
+    assert {number: result["Company"] for number, result in parse_batch_response(text, [1, 2]).items()} == {1: "A"}
+
+
+def test_parse_batch_response_partial_and_malformed():
+    text = "```json\n" + json.dumps([dict(promotion("A"), Email=1), "not an object"]) + "\n```"
+    assert list(parse_batch_response(text, [1, 2, 3])) == [1]
+    assert parse_batch_response('[{"Email": 1, "Company": ', [1]) == {}
+    assert parse_batch_response(json.dumps(promotion("A")), [1]) == {}
+
+
+def test_batch_makes_one_call_for_emails_that_fit():
+    model = FakeModel()
+    results = process_messages_batch(emails("A", "B", "C"), model=model)
+    assert [result["Company"] for result in results] == ["A", "B", "C"]
+    assert len(model.batch_prompts) == 1
+    assert model.single_prompts == []
+
+
+def test_batch_splits_calls_by_token_budget():
+    model = FakeModel()
+    messages = emails("A", "B", "C", "D")
+    cost = estimate_tokens(message_processing.clean_text(messages[0][1])) + 10
+    results = process_messages_batch(messages, token_budget=estimate_tokens(BATCH_PROMPT_HEADER) + 2 * cost,
+                                     model=model)
+    assert [result["Company"] for result in results] == ["A", "B", "C", "D"]
+    assert len(model.batch_prompts) == 2
+
+
+def test_emails_missing_from_the_batch_response_fall_back_one_at_a_time():
+    model = FakeModel(lambda entries: json.dumps([entry for entry in entries if entry["Company"] != "B"]))
+    results = process_messages_batch(emails("A", "B", "C"), model=model)
+    assert [result["Company"] for result in results] == ["A", "B", "C"]
+    assert len(model.single_prompts) == 1
+    assert "B sale" in model.single_prompts[0]
+
+
+def test_unparseable_batch_response_falls_back_for_every_email():
+    model = FakeModel(lambda entries: "Sorry, I can't help with that.")
+    results = process_messages_batch(emails("A", "B"), model=model)
+    assert [result["Company"] for result in results] == ["A", "B"]
+    assert len(model.single_prompts) == 2
+
+
+def test_results_are_cached_per_message():
+    process_messages_batch(emails("A", "B"), model=FakeModel())
+    model = FakeModel()
+    results = process_messages_batch(emails("A", "B", "C"), model=model)
+    assert [result["Company"] for result in results] == ["A", "B", "C"]
+    # Only C was left, and a lone email uses the single-email prompt
+    assert model.batch_prompts == []
+    assert len(model.single_prompts) == 1
@@ -0,0 +1,75 @@
+import pytest
+
+import promo_dedup
+
+# The same 70-word footer ends every email from this sender
+FOOTER = """
+You are receiving this email because you signed up for Outfitters Co. news and offers.
+Prices and availability are subject to change. Offers cannot be combined with other discounts,
+applied to previous purchases or redeemed for cash. Exclusions apply, see store for details.
+Outfitters Co., 1200 Harbor Street, Suite 400, Portland, OR 97209. Customer service 1-800-555-0199.
+Unsubscribe | Manage preferences | Privacy policy
+Copyright 2024 Outfitters Co. All rights reserved.
+"""
+
+SPRING = """View this email in your browser
+Spring sale: take 20% off all jackets with code SPRING20.
+Ends March 31. Shop now at outfitters.example.com/spring
+""" + FOOTER
+
+SHOES = """View this email in your browser
+Members only: $15 off running shoes with code RUN15.
+Through April 5. Shop the collection at outfitters.example.com/run
+""" + FOOTER
+
+
+@pytest.fixture(autouse=True)
+def empty_index(monkeypatch, tmp_path):
+    monkeypatch.setattr(promo_dedup, "DEDUP_PATH", str(tmp_path / "dedup.sqlite3"))
+    monkeypatch.setattr(promo_dedup, "_conn", None)
+
+
+def test_offer_text_drops_the_header_and_footer():
+    text = promo_dedup.offer_text(SPRING)
+    assert text.splitlines()[0].startswith("Spring sale")
+    assert "Unsubscribe" not in text
+    assert "Portland" not in text
+
+
+def test_two_offers_from_one_sender_are_not_duplicates():
+    # The shared footer alone made these look like one email
+    whole = promo_dedup.similarity(promo_dedup.minhash(promo_dedup.shingles(SPRING)),
+                                   promo_dedup.minhash(promo_dedup.shingles(SHOES)))
+    assert whole >= promo_dedup.DEDUP_THRESHOLD
+    spring = promo_dedup.signature_for(SPRING)
+    shoes = promo_dedup.signature_for(SHOES)
+    assert promo_dedup.similarity(spring, shoes) < promo_dedup.DEDUP_THRESHOLD
+
+    promo_dedup.remember("m1", spring, ["spring-key"])
+    assert promo_dedup.find_duplicate(shoes, exclude_message_id="m2") is None
+
+
+def test_a_resend_is_still_a_duplicate():
+    resend = SPRING.replace("outfitters.example.com/spring", "outfitters.example.com/spring?utm=2")
+    resend = resend.replace("Ends March 31.", "Ends March 31!")
+    promo_dedup.remember("m1", promo_dedup.signature_for(SPRING), ["spring-key"])
+    duplicate = promo_dedup.find_duplicate(promo_dedup.signature_for(resend), exclude_message_id="m2")
+    assert duplicate[:2] == ("m1", ["spring-key"])
+
+
+SPRING_PROMOTION = {"Company": "Outfitters", "Promo code": "SPRING20", "Promo message": "20% off all jackets"}
+
+
+def test_same_offer_needs_the_stored_code_and_discount():
+    assert promo_dedup.same_offer(SPRING_PROMOTION, SPRING, {"SPRING20"})
+    # A different code, or the same code with a different discount, is a different offer
+    assert not promo_dedup.same_offer(SPRING_PROMOTION, SHOES, {"RUN15"})
+    assert not promo_dedup.same_offer(SPRING_PROMOTION, SPRING.replace("20% off", "30% off"), {"SPRING20"})
+    # A stored offer without a code doesn't cover an email that introduces one
+    no_code = dict(SPRING_PROMOTION, **{"Promo code": ""})
+    assert not promo_dedup.same_offer(no_code, SPRING, {"SPRING20"})
+    assert promo_dedup.same_offer(no_code, SPRING.replace(" with code SPRING20", ""), set())
+
+
+def test_discounts_are_normalized():
+    assert promo_dedup.discounts("Save $15.00 or 20 % off, not 15") == {"$15", "20%"}
@@ -0,0 +1,70 @@
+import datetime
+
+import pytest
+
+import rule_extractor
+from imageOCR import scan_promo_codes
+
+TODAY = datetime.date(2024, 3, 1)
+
+
+def extract(sender, text, links=()):
+    return rule_extractor.extract(sender, text, links, scan_promo_codes([], body_text=text), today=TODAY)
+
+
+def test_introduced_code_takes_the_fast_path():
+    promotion, confidence = extract(
+        "Nike <news@email.nike.com>",
+        "Use code SAVE20 for 20% off running shoes. Offer ends 3/15. Shop now: https://nike.com/sale")
+    assert promotion["Promo code"] == "SAVE20"
+    assert promotion["Company"] == "Nike"
+    assert promotion["Expiration Date"] == "2024-03-15"
+    assert confidence >= rule_extractor.RULE_MIN_CONFIDENCE
+
+
+def test_hyphenated_code_after_enter():
+    promotion, _ = extract("deals@stores.macys.com", "Enter SPRING-30 at checkout for $30 off.")
+    assert promotion["Promo code"] == "SPRING-30"
+    assert promotion["Company"] == "Macys"
+
+
+@pytest.mark.parametrize("text", [
+    # A model name reads like a code but nothing introduces it
+    "Get 20% off PS5 bundles this week only. Shop now: https://sony.com/deals",
+    # Order numbers and SKUs
+    "Order #A12345B has shipped. Enjoy free shipping on your next order: https://shop.example.com",
+    "Item SKU 4K55TV2 is back in stock with 15% off. Ends 3/20. https://tv.example.com/deal",
+])
+def test_uninvited_tokens_are_not_codes(text):
+    assert scan_promo_codes([], body_text=text)  # the scanner still suggests them to the model
+    promotion, confidence = extract("Sony <deals@email.sony.com>", text)
+    assert promotion["Promo code"] == ""
+    # Without a code the email falls through to the model
+    assert confidence < rule_extractor.RULE_MIN_CONFIDENCE
+
+
+def test_code_must_follow_the_indicator_exactly():
+    assert rule_extractor.is_introduced_code("SAVE20", 'Promo code: "save20" today')
+    assert not rule_extractor.is_introduced_code("SAVE20", "Use SAVE200 today")
+    assert not rule_extractor.is_introduced_code("SAVE20", "SAVE20 is our code")
+
+
+@pytest.mark.parametrize("sender, company", [
+    ("Nike <news@email.nike.com>", "Nike"),
+    ("deals@stores.macys.com", "Macys"),
+    ("offers@mail.marks-spencer.co.uk", "Marks Spencer"),
+    ("", ""),
+])
+def test_company_from_sender(sender, company):
+    assert rule_extractor.company_from_sender(sender) == company
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Offer ends 2024-04-02.", "2024-04-02"),
+    ("Valid through March 9th", "2024-03-09"),
+    ("ends 1/15", "2025-01-15"),  # already past this year
+    ("Sale ends tomorrow!", "2024-03-02"),
+    ("No dates here", ""),
+])
+def test_find_expiration(text, expected):
+    assert rule_extractor.find_expiration(text, today=TODAY) == expected